@@ -0,0 +1,267 @@
+"""
+Fake ilovepdf API server, to benchmark the bot without the real API:
+
+    python -m benchmarks.fake_ilovepdf [--port 8099]
+                                       [--latency process=0.5 ...]
+                                       [--failures upload=0.01 ...]
+
+then run the bot with ILOVEPDF_URL=http://127.0.0.1:8099
+
+It answers auth, start, upload, process, download and delete (task),
+sleeping the latency of each endpoint and failing a share of its
+requests. The output of a task is its first uploaded file, a zip with
+OUTPUT_FILES copies of it for the tools returning one file per page, or
+a zip with each uploaded file (named after it) for a task of many files.
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+ENDPOINTS = ('auth', 'start', 'upload', 'process', 'download', 'delete')
+# tools whose output is a zip
+ZIP_TOOLS = ('pdfjpg', 'split')
+OUTPUT_FILES = 4
+
+
+def fake_token(ttl: int = 7200) -> str:
+    """
+    Return an unsigned JWT expiring in ttl seconds
+    """
+    def encode(data):
+        raw = json.dumps(data).encode()
+        return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+    return f"{encode({'alg': 'none'})}." \
+           f"{encode({'exp': int(time.time()) + ttl})}.fake"
+
+
+def multipart_file(body: bytes, content_type: str) -> bytes:
+    """
+    Return the content of the file field of a multipart/form-data body
+    """
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+    for part in body.split(f"--{boundary}".encode()):
+        head, _, content = part.partition(b'\r\n\r\n')
+        if b'name="file"' in head:
+            # the part ends with \r\n before the next boundary
+            return content[:-2]
+    return b''
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send(self, status: int, data: bytes = b'',
+              content_type: str = 'application/json',
+              headers: dict = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _json(self, data: dict, status: int = 200) -> None:
+        self._send(status, json.dumps(data).encode())
+
+    def _route(self, method: str):
+        path = self.path.split('?')[0].split('/')[2:]
+        body = self._body()
+        endpoint = 'delete' if path[0] == 'task' else path[0]
+        if endpoint not in ENDPOINTS:
+            self._json({'error': {'message': 'Not found'}}, 404)
+            return
+        server = self.server
+        server.count(endpoint)
+        time.sleep(server.latency.get(endpoint, 0))
+        if random.random() < server.failures.get(endpoint, 0):
+            server.count(f"{endpoint}_failed")
+            self._json({'error': {'message': 'Injected failure'}},
+                       server.failure_status)
+            return
+        getattr(self, f"_{endpoint}")(path, body)
+
+    def do_GET(self):
+        self._route('get')
+
+    def do_POST(self):
+        self._route('post')
+
+    def do_DELETE(self):
+        self._route('delete')
+
+    def _auth(self, path, body):
+        self._json({'token': fake_token()})
+
+    def _start(self, path, body):
+        task = uuid.uuid4().hex
+        self.server.tasks[task] = {'tool': path[1], 'uploads': {}}
+        self._json({'server': f"127.0.0.1:{self.server.server_port}",
+                    'task': task})
+
+    def _upload(self, path, body):
+        fields = self.headers.get('Content-Type', '')
+        task_id = re.search(rb'name="task"\r\n\r\n(\w+)', body)
+        task = self.server.tasks.get(task_id.group(1).decode()
+                                     if task_id else '')
+        if task is None:
+            self._json({'error': {'message': 'Unknown task'}}, 400)
+            return
+        server_filename = uuid.uuid4().hex
+        task['uploads'][server_filename] = multipart_file(body, fields)
+        self._json({'server_filename': server_filename})
+
+    def _process(self, path, body):
+        form = parse_qs(body.decode())
+        task = self.server.tasks.get(form.get('task', [''])[0])
+        # the files in the order of the process request
+        files = []
+        for num in range(len(task['uploads']) if task else 0):
+            server_filename = form.get(f"files[{num}][server_filename]")
+            if server_filename:
+                files.append((form.get(f"files[{num}][filename]", [''])[0],
+                              task['uploads'].get(server_filename[0])))
+        if not files or any(content is None for _, content in files):
+            self._json({'error': {'message': 'Unknown task'}}, 400)
+            return
+        task['processed'] = True
+        task['names'] = [name for name, _ in files]
+        task['files'] = [content for _, content in files]
+        self._json({'download_filename': 'output', 'filesize': 0,
+                    'output_filesize': len(task['files'][0]),
+                    'output_filenumber': 1, 'status': 'TaskSuccess'})
+
+    def _download(self, path, body):
+        task = self.server.tasks.get(path[1])
+        if task is None or not task.get('processed'):
+            self._json({'error': {'message': 'Unknown task'}}, 400)
+            return
+        data = task['files'][0]
+        if task['tool'] in ZIP_TOOLS:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as zip_ref:
+                for num in range(OUTPUT_FILES):
+                    zip_ref.writestr(f"output-{num + 1}.pdf", data)
+            data, content_type, ext = buffer.getvalue(), \
+                'application/zip', 'zip'
+        elif len(task['files']) > 1:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w') as zip_ref:
+                for name, content in zip(task['names'], task['files']):
+                    stem = name.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+                    zip_ref.writestr(f"{stem}.pdf", content)
+            data, content_type, ext = buffer.getvalue(), \
+                'application/zip', 'zip'
+        else:
+            content_type, ext = 'application/pdf', 'pdf'
+        self._send(200, data, content_type, {
+            'Content-Disposition':
+                f'attachment; filename="fake_output.{ext}"'})
+
+    def _delete(self, path, body):
+        self.server.tasks.pop(path[1], None)
+        self._json({})
+
+
+class FakeILovePdf(ThreadingHTTPServer):
+    """
+    Fake ilovepdf API server
+    :param port: (int) to listen on 127.0.0.1, 0 for any free port
+    :param latency: (dict) seconds slept by each endpoint, e.g.
+    {'process': 0.5}
+    :param failures: (dict) share (0 to 1) of the requests of each
+    endpoint answered with failure_status, e.g. {'upload': 0.01}
+    :param failure_status: (int) e.g. 500 or 429
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: dict = None,
+                 failures: dict = None, failure_status: int = 500):
+        super().__init__(('127.0.0.1', port), FakeHandler)
+        self.latency = latency or {}
+        self.failures = failures or {}
+        self.failure_status = failure_status
+        self.tasks = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def start(self) -> None:
+        """
+        Serve in a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='fake-ilovepdf', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def endpoint_values(values: list) -> dict:
+    """
+    Parse ['process=0.5', ...] into {'process': 0.5, ...}
+    """
+    parsed = {}
+    for value in values or []:
+        endpoint, _, number = value.partition('=')
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {endpoint}")
+        parsed[endpoint] = float(number)
+    return parsed
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', nargs='*', metavar='ENDPOINT=SECONDS',
+                        help=f"endpoints: {', '.join(ENDPOINTS)}")
+    parser.add_argument('--failures', nargs='*', metavar='ENDPOINT=SHARE')
+    parser.add_argument('--failure-status', type=int, default=500)
+    args = parser.parse_args(argv)
+    server = FakeILovePdf(args.port, endpoint_values(args.latency),
+                          endpoint_values(args.failures),
+                          args.failure_status)
+    print(f"fake ilovepdf listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
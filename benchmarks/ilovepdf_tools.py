@@ -0,0 +1,173 @@
+"""
+Benchmark the bot tools against a fake ilovepdf server (no API quota used):
+
+    python -m benchmarks.ilovepdf_tools [--tools compress split ...]
+                                        [--sizes 100k 1m 10m]
+                                        [--iterations 20] [--concurrency 4]
+                                        [--latency process=0.5 ...]
+                                        [--failures upload=0.01 ...]
+
+For each tool and input size it reports the p50, p95 and p99 latency of a
+job (start, upload, process, download and delete), the jobs/s and MB/s,
+and the failed jobs. Tools listed in LOCAL_TOOLS run locally, as in the bot.
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_ilovepdf import FakeILovePdf, endpoint_values
+
+# parameters the bot passes to each tool
+PARAMS = {
+    'officetopdf': ('docx',),
+    'protect': ('secret',),
+    'split': ('2',),
+    'rotate': ('90',),
+    'watermark': ('benchmark',),
+}
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse '100k', '1m' or '1048576' into bytes
+    """
+    units = {'k': 1024, 'm': 1024 * 1024}
+    size = size.lower()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def make_pdf(path: str, size: int) -> None:
+    """
+    Write a valid one page PDF file of about size bytes
+    """
+    from ilovepdf_bot.local import PdfStream
+
+    with open(path, 'wb') as f:
+        pdf = PdfStream(f)
+        catalog, pages = pdf.reserve(), pdf.reserve()
+        # comments make the content stream as large as needed
+        padding = b'%' + b'0' * 78 + b'\n'
+        content = b'BT /F1 24 Tf 72 720 Td (benchmark) Tj ET\n' + \
+            padding * max(0, (size - 700) // len(padding))
+        contents = pdf.write_stream('', [content], len(content))
+        page = pdf.write(f"<< /Type /Page /Parent {pages} 0 R "
+                         f"/MediaBox [0 0 612 792] /Contents {contents} 0 R "
+                         f"/Resources << /Font << /F1 << /Type /Font "
+                         f"/Subtype /Type1 /BaseFont /Helvetica >> >> >> >>")
+        pdf.write(f"<< /Type /Pages /Count 1 /Kids [{page} 0 R] >>", pages)
+        pdf.write(f"<< /Type /Catalog /Pages {pages} 0 R >>", catalog)
+        pdf.close(catalog)
+
+
+def percentile(values: list, share: float) -> float:
+    """
+    Return the nearest-rank percentile of values
+    """
+    values = sorted(values)
+    return values[max(0, int(round(share * len(values) + 0.5)) - 1)]
+
+
+def run_job(tool: str, input_path: str) -> float:
+    """
+    Run a tool as tool_job does, return its seconds (raise if it failed)
+    """
+    from ilovepdf_bot.commands import tools
+    from ilovepdf_bot.utils import result_file
+
+    spec = tools[tool]
+    params = PARAMS.get(tool, ())
+    folder = tempfile.mkdtemp(prefix='bench-')
+    try:
+        file_path = os.path.join(folder, 'file')
+        shutil.copyfile(input_path, f"{file_path}.{spec.ext or params[0]}")
+        os.mkdir(file_path)
+        start = time.perf_counter()
+        spec.run(file_path, *params)
+        elapsed = time.perf_counter() - start
+        if not result_file(file_path):
+            raise RuntimeError(f"{tool} returned no file")
+        return elapsed
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench(tool: str, input_path: str, iterations: int,
+          concurrency: int) -> tuple:
+    def job(_):
+        try:
+            return run_job(tool, input_path)
+        except Exception:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(job, range(iterations)))
+    wall = time.perf_counter() - start
+    latencies = [result for result in results if result is not None]
+    return latencies, len(results) - len(latencies), wall
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tools', nargs='*',
+                        default=['compress', 'pdfa', 'addpagenumbers',
+                                 'pdftojpg', 'protect', 'split', 'rotate',
+                                 'unlock', 'watermark', 'officetopdf'])
+    parser.add_argument('--sizes', nargs='*', default=['100k', '1m', '10m'])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', nargs='*', metavar='ENDPOINT=SECONDS')
+    parser.add_argument('--failures', nargs='*', metavar='ENDPOINT=SHARE')
+    parser.add_argument('--failure-status', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    server = FakeILovePdf(0, endpoint_values(args.latency),
+                          endpoint_values(args.failures),
+                          args.failure_status)
+    server.start()
+    # read by ilovepdf_bot.constants when it is imported
+    os.environ.update(ILOVEPDF_URL=server.url, PUBLIC_KEY='benchmark',
+                      CACHE_MAX_BYTES='0', RESULT_INDEX_PATH=':memory:',
+                      STATE_BACKEND='memory')
+
+    folder = tempfile.mkdtemp(prefix='bench-inputs-')
+    print(f"{'tool':<15}{'size':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'jobs/s':>9}{'MB/s':>8}{'failed':>8}")
+    try:
+        for size in args.sizes:
+            input_path = os.path.join(folder, f"{size}.pdf")
+            make_pdf(input_path, parse_size(size))
+            for tool in args.tools:
+                # pylovepdf prints the progress of every task
+                with contextlib.redirect_stdout(io.StringIO()):
+                    latencies, failed, wall = bench(
+                        tool, input_path, args.iterations, args.concurrency)
+                done = len(latencies)
+                if latencies:
+                    p50, p95, p99 = (percentile(latencies, share) * 1000
+                                     for share in (0.5, 0.95, 0.99))
+                else:
+                    p50 = p95 = p99 = float('nan')
+                mb = done * os.path.getsize(input_path) / 1024 / 1024
+                print(f"{tool:<15}{size:>8}{p50:>10.1f}{p95:>10.1f}"
+                      f"{p99:>10.1f}{done / wall:>9.2f}{mb / wall:>8.2f}"
+                      f"{failed:>8}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        server.stop()
+    from ilovepdf_bot.limiter import limiter
+    print(f"requests: {server.requests}")
+    print(f"ilovepdf concurrency: {limiter.stats()}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,456 @@
+"""
+Load test the bot: synthetic users walk through its conversations,
+their updates go through the real dispatcher and handlers, and a fake
+Bot API (no network) answers the bot calls with a latency:
+
+    python -m benchmarks.load [--users 200] [--ramp 10] [--think 0.5]
+                              [--mix split=1 imgtopdf=1 compress=1 ...]
+                              [--images 3] [--size 1m] [--forwarded 0.5]
+                              [--bot-latency sendDocument=0.3 ...]
+                              [--ilovepdf-latency process=0.5 ...]
+
+The ilovepdf tasks go to the fake ilovepdf server. It reports the updates
+processed per second, the conversation completion time of each flow, the
+utilization of the dispatcher, its run_async workers and the job workers,
+and the calls received by the fake Bot API.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import logging
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, JobQueue
+from telegram.utils.request import Request
+
+from benchmarks.fake_ilovepdf import FakeILovePdf, endpoint_values
+from benchmarks.ilovepdf_tools import make_pdf, parse_size, percentile
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'ilovepdfbot',
+            'username': 'ilovepdfbot'}
+# seconds the fake Bot API takes to answer each method
+BOT_LATENCY = {'getFile': 0.05, 'sendMessage': 0.05,
+               'sendChatAction': 0.02, 'sendDocument': 0.3,
+               'sendPhoto': 0.3, 'sendMediaGroup': 0.5}
+# messages ending a conversation
+LAST_MESSAGES = ('see you soon', 'An error occured', 'very busy',
+                 'taking me too long', 'too large', 'Action cancelled')
+
+
+def flows(images: int) -> dict:
+    """
+    Return the steps of each conversation: a command, a text,
+    ('pdf',) for a PDF document or ('jpg',) for an image document
+    (a second item is the caption of the document)
+    :param images: (int) sent in an imgtopdf conversation
+    """
+    return {
+        'split': ['/splitpdf', ('pdf',), '2'],
+        'imgtopdf': ['/imgtopdf'] + [('jpg',)] * images + ['done'],
+        'compress': ['/compress', ('pdf',)],
+        'rotate': ['/rotatepdf', ('pdf',), '90'],
+        'protect': ['/protectpdf', ('pdf',), 'secret'],
+        'watermark': ['/watermark', ('pdf',), 'load test'],
+        'caption': [('pdf', '/rotatepdf 90')],
+    }
+
+
+def make_jpg(path: str) -> None:
+    """
+    Write a small jpg image (a fake one without Pillow, enough for ilovepdf)
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        with open(path, 'wb') as f:
+            f.write(b'\xff\xd8\xff\xe0' + os.urandom(32 * 1024) + b'\xff\xd9')
+        return
+    Image.effect_noise((640, 480), 64).convert('RGB').save(path, 'JPEG')
+
+
+class FakeApi(Request):
+    """
+    Fake Bot API: answers the calls of a telegram.Bot after a latency,
+    recording the messages sent to each chat
+    :param latency: (dict) seconds to answer each method
+    :param files: (dict) file_id: (path, size) answered by getFile
+    """
+
+    def __init__(self, latency: dict, files: dict):
+        super().__init__(con_pool_size=8)
+        self.latency = latency
+        self.files = files
+        self.calls = defaultdict(list)
+        self.messages = defaultdict(list)
+        self.bytes_out = 0
+        self._ids = itertools.count(1)
+        self._changed = threading.Condition()
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        method = url.rsplit('/', 1)[1]
+        start = time.perf_counter()
+        time.sleep(self.latency.get(method, 0))
+        answer = getattr(self, f"_{method}", self._ok)(data)
+        self.calls[method].append(time.perf_counter() - start)
+        return answer
+
+    def retrieve(self, url: str, timeout: float = None) -> bytes:
+        raise RuntimeError(f"unexpected download of {url}")
+
+    def wait(self, chat_id: int, count: int, timeout: float) -> bool:
+        """
+        Wait until chat_id received more than count messages
+        :return: (bool) False if it timed out
+        """
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: len(self.messages[chat_id]) > count, timeout)
+
+    def _ok(self, data: dict) -> bool:
+        return True
+
+    def _getMe(self, data: dict) -> dict:
+        return BOT_USER
+
+    def _getFile(self, data: dict) -> dict:
+        path, size = self.files[data['file_id']]
+        return {'file_id': data['file_id'], 'file_unique_id': data['file_id'],
+                'file_size': size, 'file_path': path}
+
+    def _message(self, data: dict, **content) -> dict:
+        chat_id = int(data['chat_id'])
+        text = data.get('text') or data.get('caption') or ''
+        with self._changed:
+            self.messages[chat_id].append(text)
+            self._changed.notify_all()
+        return dict(message_id=next(self._ids), date=int(time.time()),
+                    chat={'id': chat_id, 'type': 'private'},
+                    **{'from': BOT_USER}, **content)
+
+    def _document(self) -> dict:
+        file_id = f"result-{next(self._ids)}"
+        return {'file_id': file_id, 'file_unique_id': file_id}
+
+    def _upload(self, media) -> None:
+        content = getattr(media, 'input_file_content', None)
+        if content is not None:
+            self.bytes_out += len(content)
+
+    def _sendMessage(self, data: dict) -> dict:
+        return self._message(data, text=data['text'])
+
+    def _sendDocument(self, data: dict) -> dict:
+        self._upload(data['document'])
+        return self._message(data, document=self._document())
+
+    def _sendPhoto(self, data: dict) -> dict:
+        self._upload(data['photo'])
+        return self._message(data, photo=[dict(self._document(),
+                                               width=1, height=1)])
+
+    def _sendMediaGroup(self, data: dict) -> list:
+        messages = []
+        for media in data['media']:
+            self._upload(media.media)
+            messages.append(self._message(dict(data, caption=media.caption),
+                                          document=self._document()))
+        return messages
+
+
+class TimedDispatcher(Dispatcher):
+    """
+    Dispatcher measuring the time spent handling updates in its thread
+    and running the handlers in its run_async workers
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # set on the subclass only, the @run_async handlers look it up
+        # on Dispatcher
+        Dispatcher._set_singleton(self)
+        self.busy = 0.0
+        self.async_busy = 0.0
+        self.processed = 0
+        self._timing = threading.Lock()
+
+    def process_update(self, update: object) -> None:
+        start = time.perf_counter()
+        try:
+            super().process_update(update)
+        finally:
+            self.busy += time.perf_counter() - start
+            self.processed += 1
+
+    def _run_async(self, func, *args, **kwargs):
+        def timed(*func_args, **func_kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*func_args, **func_kwargs)
+            finally:
+                with self._timing:
+                    self.async_busy += time.perf_counter() - start
+        timed.__name__ = getattr(func, '__name__', 'timed')
+        return super()._run_async(timed, *args, **kwargs)
+
+
+class User(threading.Thread):
+    """
+    Synthetic user walking through a conversation: it sends a step, waits
+    for the answer of the bot and thinks before the next one
+    """
+
+    def __init__(self, number: int, flow: str, steps: list, load):
+        super().__init__(name=f"user-{number}", daemon=True)
+        self.chat_id = 1000 + number
+        self.flow = flow
+        self.steps = steps
+        self.load = load
+        self.elapsed = None
+        self.status = 'timeout'
+
+    def update(self, step) -> Update:
+        load = self.load
+        message = {'message_id': next(load.ids), 'date': int(time.time()),
+                   'chat': {'id': self.chat_id, 'type': 'private'},
+                   'from': {'id': self.chat_id, 'is_bot': False,
+                            'first_name': self.name}}
+        if isinstance(step, tuple):
+            path, mime_type = load.inputs[step[0]]
+            file_id = f"{self.name}-{message['message_id']}"
+            size = os.path.getsize(path)
+            load.api.files[file_id] = (path, size)
+            # a forwarded file keeps its file_unique_id
+            unique_id = f"forwarded-{step[0]}" \
+                if random.random() < load.forwarded else file_id
+            message['document'] = {'file_id': file_id,
+                                   'file_unique_id': unique_id,
+                                   'file_name': os.path.basename(path),
+                                   'mime_type': mime_type, 'file_size': size}
+            if len(step) > 1:
+                message['caption'] = step[1]
+        else:
+            message['text'] = step
+            if step.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                        'length': len(step)}]
+        return Update.de_json({'update_id': next(load.ids),
+                               'message': message}, load.bot)
+
+    def run(self) -> None:
+        api = self.load.api
+        start = time.perf_counter()
+        for step in self.steps:
+            answered = len(api.messages[self.chat_id])
+            self.load.send(self.update(step))
+            if not api.wait(self.chat_id, answered, self.load.timeout):
+                return
+            time.sleep(random.uniform(0, 2 * self.load.think))
+        # the job answers with the result and a last message
+        deadline = time.monotonic() + self.load.timeout
+        while time.monotonic() < deadline:
+            messages = api.messages[self.chat_id]
+            last = [text for text in messages
+                    if any(end in text for end in LAST_MESSAGES)]
+            if last:
+                self.elapsed = time.perf_counter() - start
+                self.status = 'ok' if 'see you soon' in last[0] else 'failed'
+                return
+            api.wait(self.chat_id, len(messages), 1)
+
+
+class Load:
+    """
+    The bot under load: a dispatcher with the bot handlers fed with the
+    updates of the users, and the job engine
+    """
+
+    def __init__(self, args):
+        from bot import add_handlers
+
+        self.think = args.think
+        self.forwarded = args.forwarded
+        self.timeout = args.timeout
+        self.ids = itertools.count(1)
+        self.sent = 0
+        self.folder = tempfile.mkdtemp(prefix='load-')
+        self.inputs = {'pdf': (os.path.join(self.folder, 'input.pdf'),
+                               'application/pdf'),
+                       'jpg': (os.path.join(self.folder, 'input.jpg'),
+                               'image/jpeg')}
+        make_pdf(self.inputs['pdf'][0], parse_size(args.size))
+        make_jpg(self.inputs['jpg'][0])
+        self.api = FakeApi(dict(BOT_LATENCY, **args.bot_latency), {})
+        self.bot = Bot('123:load', request=self.api)
+        job_queue = JobQueue()
+        self.dispatcher = TimedDispatcher(self.bot, queue.Queue(),
+                                          workers=args.workers,
+                                          job_queue=job_queue)
+        job_queue.set_dispatcher(self.dispatcher)
+        add_handlers(self.dispatcher)
+        # a line per conversation timeout job otherwise
+        logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+    def send(self, update: Update) -> None:
+        self.sent += 1
+        self.dispatcher.update_queue.put(update)
+
+    def start(self) -> None:
+        from ilovepdf_bot.jobs import engine
+        from ilovepdf_bot.outbox import outbox
+        from ilovepdf_bot.prefetch import prefetcher
+        from ilovepdf_bot.raster import rasterizer
+
+        rasterizer.start()
+        engine.start()
+        outbox.start()
+        prefetcher.start()
+        self.dispatcher.job_queue.start()
+        ready = threading.Event()
+        threading.Thread(target=self.dispatcher.start, args=(ready,),
+                         name='dispatcher', daemon=True).start()
+        ready.wait()
+
+    def stop(self) -> None:
+        from ilovepdf_bot.jobs import engine
+        from ilovepdf_bot.outbox import outbox
+        from ilovepdf_bot.prefetch import prefetcher
+        from ilovepdf_bot.raster import rasterizer
+
+        self.dispatcher.stop()
+        self.dispatcher.job_queue.stop()
+        engine.stop(wait=False)
+        outbox.stop(timeout=1)
+        prefetcher.stop()
+        rasterizer.stop()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def sample(load: Load, samples: list, done: threading.Event) -> None:
+    """
+    Sample the job workers and the queues every 100ms
+    """
+    from ilovepdf_bot.jobs import engine
+
+    while not done.wait(0.1):
+        samples.append((engine.active, engine.depth,
+                        load.dispatcher.update_queue.qsize()))
+
+
+def report(load: Load, users: list, samples: list, wall: float,
+           workers: int) -> None:
+    from ilovepdf_bot.jobs import engine
+    from ilovepdf_bot.results import flights, index
+
+    dispatcher = load.dispatcher
+    print(f"users: {len(users)}, wall time: {wall:.1f}s")
+    print(f"updates: {load.sent} sent, {dispatcher.processed} processed, "
+          f"{dispatcher.processed / wall:.1f}/s")
+    print(f"\n{'flow':<12}{'ok':>6}{'failed':>8}{'timeout':>9}"
+          f"{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}")
+    by_flow = defaultdict(list)
+    for user in users:
+        by_flow[user.flow].append(user)
+    for flow, flow_users in sorted(by_flow.items()):
+        status = defaultdict(int)
+        for user in flow_users:
+            status[user.status] += 1
+        times = [user.elapsed for user in flow_users if user.status == 'ok']
+        p50, p95, p99 = (percentile(times, share) if times else float('nan')
+                         for share in (0.5, 0.95, 0.99))
+        print(f"{flow:<12}{status['ok']:>6}{status['failed']:>8}"
+              f"{status['timeout']:>9}{p50:>9.2f}{p95:>9.2f}{p99:>9.2f}")
+
+    active = [active for active, _, _ in samples] or [0]
+    print(f"\ndispatcher thread: {dispatcher.busy / wall:.0%} busy")
+    print(f"run_async workers: "
+          f"{dispatcher.async_busy / (wall * workers):.0%} busy "
+          f"({workers} workers)")
+    print(f"job workers: {sum(active) / len(active) / engine.workers:.0%} "
+          f"busy on average, {max(active)} of {engine.workers} at peak")
+    print(f"peak queues: {max((s[1] for s in samples), default=0)} jobs, "
+          f"{max((s[2] for s in samples), default=0)} updates")
+
+    print(f"\n{'bot api call':<18}{'calls':>7}{'mean s':>9}")
+    for method, latencies in sorted(load.api.calls.items()):
+        print(f"{method:<18}{len(latencies):>7}"
+              f"{sum(latencies) / len(latencies):>9.3f}")
+    print(f"uploaded: {load.api.bytes_out / 1024 / 1024:.1f} MB")
+    print(f"results reused: {index.hits}, "
+          f"jobs coalesced: {flights.stats()['coalesced']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ramp', type=float, default=10,
+                        help="seconds to start every user")
+    parser.add_argument('--think', type=float, default=0.5,
+                        help="mean seconds between the steps of a user")
+    parser.add_argument('--mix', nargs='*', default=['split=1', 'imgtopdf=1',
+                                                    'compress=1'],
+                        metavar='FLOW=WEIGHT',
+                        help=f"flows: {', '.join(flows(1))}")
+    parser.add_argument('--forwarded', type=float, default=0,
+                        help="share of the documents sent as the same "
+                             "forwarded file")
+    parser.add_argument('--images', type=int, default=3)
+    parser.add_argument('--size', default='1m', help="of the PDF files")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="run_async workers of the dispatcher")
+    parser.add_argument('--timeout', type=float, default=120,
+                        help="seconds a user waits for an answer")
+    parser.add_argument('--bot-latency', nargs='*', default=[],
+                        metavar='METHOD=SECONDS')
+    parser.add_argument('--ilovepdf-latency', nargs='*',
+                        metavar='ENDPOINT=SECONDS')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    args.bot_latency = {method: float(seconds) for method, _, seconds in
+                        (value.partition('=') for value in args.bot_latency)}
+    mix = {flow: float(weight) for flow, _, weight in
+           (value.partition('=') for value in args.mix)}
+    random.seed(args.seed)
+
+    server = FakeILovePdf(0, endpoint_values(args.ilovepdf_latency))
+    server.start()
+    # read by ilovepdf_bot.constants when it is imported
+    os.environ.update(ILOVEPDF_URL=server.url, PUBLIC_KEY='load',
+                      CACHE_MAX_BYTES='0', RESULT_INDEX_PATH=':memory:',
+                      STATE_BACKEND='memory')
+    load = Load(args)
+    steps = flows(args.images)
+    users = [User(number, flow, steps[flow], load) for number, flow in
+             enumerate(random.choices(list(mix), list(mix.values()),
+                                      k=args.users))]
+    samples, done = [], threading.Event()
+    # pylovepdf prints the progress of every task
+    with contextlib.redirect_stdout(io.StringIO()):
+        load.start()
+        threading.Thread(target=sample, args=(load, samples, done),
+                         daemon=True).start()
+        start = time.perf_counter()
+        for user in users:
+            user.start()
+            time.sleep(args.ramp / max(1, args.users))
+        for user in users:
+            user.join()
+        wall = time.perf_counter() - start
+        done.set()
+    report(load, users, samples, wall, args.workers)
+    load.stop()
+    server.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Compare the pages/sec of the local pdftojpg rasterizer with ilovepdf:
+
+    python -m benchmarks.pdftojpg file.pdf [--workers 4] [--dpi 150]
+                                           [--quality 85] [--remote]
+
+--remote also runs the ilovepdf tool (it needs PUBLIC_KEY in .env)
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+# the local engine is only used when it is selected
+os.environ['LOCAL_TOOLS'] = 'pdftojpg'
+
+from ilovepdf_bot.constants import RASTER_DPI, RASTER_QUALITY, RASTER_WORKERS
+from ilovepdf_bot.ilovepdf import love_pdftojpg
+from ilovepdf_bot.raster import Rasterizer, page_count
+
+
+def workspace(pdf_path: str) -> str:
+    """
+    Return a file path (without extension) with a copy of the PDF file
+    and its output folder, as the bot jobs have
+    """
+    file_path = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'file')
+    shutil.copyfile(pdf_path, f"{file_path}.pdf")
+    os.mkdir(file_path)
+    return file_path
+
+
+def bench_local(pdf_path: str, workers: int, dpi: int, quality: int) -> tuple:
+    rasterizer = Rasterizer(workers=workers, dpi=dpi, quality=quality)
+    # processes are started before timing, as the bot does
+    rasterizer.start()
+    file_path = workspace(pdf_path)
+    try:
+        start = time.perf_counter()
+        first = None
+        pages = 0
+        for _ in rasterizer.pages(file_path):
+            pages += 1
+            if first is None:
+                first = time.perf_counter() - start
+        return pages, time.perf_counter() - start, first
+    finally:
+        rasterizer.stop()
+        shutil.rmtree(os.path.dirname(file_path))
+
+
+def bench_remote(pdf_path: str) -> tuple:
+    file_path = workspace(pdf_path)
+    try:
+        start = time.perf_counter()
+        love_pdftojpg(file_path)
+        elapsed = time.perf_counter() - start
+        pages = 0
+        for name in os.listdir(file_path):
+            if name.endswith('.zip'):
+                with zipfile.ZipFile(os.path.join(file_path, name)) as z:
+                    pages += len(z.namelist())
+            else:
+                pages += 1
+        # nothing is sent before the zip is downloaded
+        return pages, elapsed, elapsed
+    finally:
+        shutil.rmtree(os.path.dirname(file_path))
+
+
+def report(name: str, pages: int, elapsed: float, first: float) -> None:
+    print(f"{name:<8} {pages:>6} pages {elapsed:>8.2f} s "
+          f"{pages / elapsed:>8.2f} pages/s  first page {first:.2f} s")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('pdf')
+    parser.add_argument('--workers', type=int, default=RASTER_WORKERS)
+    parser.add_argument('--dpi', type=int, default=RASTER_DPI)
+    parser.add_argument('--quality', type=int, default=RASTER_QUALITY)
+    parser.add_argument('--remote', action='store_true',
+                        help="also run the ilovepdf pdftojpg tool")
+    args = parser.parse_args(argv)
+
+    print(f"{args.pdf}: {page_count(args.pdf)} pages, {args.workers} "
+          f"workers, {args.dpi} dpi, quality {args.quality}")
+    report('local', *bench_local(args.pdf, args.workers, args.dpi,
+                                 args.quality))
+    if args.remote:
+        report('ilovepdf', *bench_remote(args.pdf))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
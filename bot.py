@@ -3,12 +3,24 @@ import os
 
 from telegram.ext import CommandHandler, Updater
 
-from ilovepdf_bot.commands import (addpagenumbers_handler, compress_handler,
-                                   imgtopdf_handler, officetopdf_handler,
-                                   pdfa_handler, pdftojpg_handler,
-                                   protectpdf_handler, rotatepdf_handler,
-                                   splitpdf_handler, unlockpdf_handler,
-                                   watermark_handler)
+from ilovepdf_bot.commands import (addpagenumbers_handler, caption_handler,
+                                   compress_handler, imgtopdf_handler,
+                                   officetopdf_handler, pdfa_handler,
+                                   pdftojpg_handler, protectpdf_handler,
+                                   rotatepdf_handler, splitpdf_handler,
+                                   unlockpdf_handler, watermark_handler)
+from ilovepdf_bot.constants import (BOT_MODE, METRICS_PORT,
+                                    POLL_BOOTSTRAP_RETRIES, POLL_READ_LATENCY,
+                                    POLL_TIMEOUT)
+from ilovepdf_bot.jobs import engine
+from ilovepdf_bot.metrics import MetricsServer
+from ilovepdf_bot.office import office_pool
+from ilovepdf_bot.outbox import outbox
+from ilovepdf_bot.prefetch import prefetcher
+from ilovepdf_bot.raster import rasterizer
+from ilovepdf_bot.state import StatePersistence, store
+from ilovepdf_bot.webhook import WebhookServer
+from ilovepdf_bot.workspace import workspaces
 
 token = os.getenv('BOT_TOKEN')
 
@@ -26,55 +38,110 @@ commands = ("🗄 /compress to compress a PDF file",
             "✂️ /splitpdf to split a PDF file according to a range",
             "🔑 /unlockpdf to unlock a protected PDF file",
             "💧 /watermark to apply a watermark to a PDF file",
+            "📎 or send the file with the command as caption, "
+            "e.g. /rotatepdf 180",
             "❤️ /donate")
 
 
 def start(update, context):
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text="I ♥ pdf, and you?")
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text="Please, use /help to know what can I do for you")
+    outbox.send(update.effective_chat.id, context.bot.send_message,
+                chat_id=update.effective_chat.id, text="I ♥ pdf, and you?")
+    outbox.send(update.effective_chat.id, context.bot.send_message,
+                chat_id=update.effective_chat.id, text="Please, use /help to know what can I do for you")
 
 
 def help(update, context):
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text="Please feel free to use my commands:")
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text='\n'.join(commands))
+    outbox.send(update.effective_chat.id, context.bot.send_message,
+                chat_id=update.effective_chat.id, text="Please feel free to use my commands:")
+    outbox.send(update.effective_chat.id, context.bot.send_message,
+                chat_id=update.effective_chat.id, text='\n'.join(commands))
 
 
 def donate(update, context):
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text="Is ilovepdfbot useful you?")
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text="Would you like to donate my mother a coffe? ♥")
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text="Please go to: https://www.paypal.com/donate?hosted_button_id=N374LBS72AAMA")
+    outbox.send(update.effective_chat.id, context.bot.send_message,
+                chat_id=update.effective_chat.id, text="Is ilovepdfbot useful you?")
+    outbox.send(update.effective_chat.id, context.bot.send_message,
+                chat_id=update.effective_chat.id, text="Would you like to donate my mother a coffe? ♥")
+    outbox.send(update.effective_chat.id, context.bot.send_message,
+                chat_id=update.effective_chat.id, text="Please go to: https://www.paypal.com/donate?hosted_button_id=N374LBS72AAMA")
 
 
 start_handler = CommandHandler('start', start)
 help_handler = CommandHandler('help', help)
 donate_handler = CommandHandler('donate', donate)
 
-updater = Updater(token=token, use_context=True)
-dispatcher = updater.dispatcher
-
-# basic handlers
-dispatcher.add_handler(start_handler)
-dispatcher.add_handler(help_handler)
-dispatcher.add_handler(donate_handler)
-
-# command handlers
-dispatcher.add_handler(compress_handler())
-dispatcher.add_handler(imgtopdf_handler())
-dispatcher.add_handler(officetopdf_handler())
-dispatcher.add_handler(addpagenumbers_handler())
-dispatcher.add_handler(pdfa_handler())
-dispatcher.add_handler(pdftojpg_handler())
-dispatcher.add_handler(protectpdf_handler())
-dispatcher.add_handler(rotatepdf_handler())
-dispatcher.add_handler(splitpdf_handler())
-dispatcher.add_handler(unlockpdf_handler())
-dispatcher.add_handler(watermark_handler())
-
-updater.start_polling()
+
+def add_handlers(dispatcher) -> None:
+    """
+    Add every handler of the bot to a dispatcher
+    :param dispatcher: (telegram.ext.Dispatcher) the dispatcher object
+    :return: None
+    """
+    # basic handlers
+    dispatcher.add_handler(start_handler)
+    dispatcher.add_handler(help_handler)
+    dispatcher.add_handler(donate_handler)
+
+    # one-shot commands, before the conversations waiting for a document
+    dispatcher.add_handler(caption_handler())
+
+    # command handlers
+    dispatcher.add_handler(compress_handler())
+    dispatcher.add_handler(imgtopdf_handler())
+    dispatcher.add_handler(officetopdf_handler())
+    dispatcher.add_handler(addpagenumbers_handler())
+    dispatcher.add_handler(pdfa_handler())
+    dispatcher.add_handler(pdftojpg_handler())
+    dispatcher.add_handler(protectpdf_handler())
+    dispatcher.add_handler(rotatepdf_handler())
+    dispatcher.add_handler(splitpdf_handler())
+    dispatcher.add_handler(unlockpdf_handler())
+    dispatcher.add_handler(watermark_handler())
+
+
+def main() -> None:
+    # conversations states are kept with their data when the store persists
+    persistence = StatePersistence(store) if store.persistent else None
+    updater = Updater(token=token, use_context=True, persistence=persistence)
+    add_handlers(updater.dispatcher)
+
+    # remove the workspaces of jobs interrupted by a previous run
+    workspaces.sweep()
+    # local pdftojpg processes, forked before the threads start
+    rasterizer.start()
+    # warm LibreOffice instances of the local officetopdf
+    office_pool.start()
+    # ilovepdf jobs run in the job engine workers, not in the dispatcher ones
+    engine.start()
+    # messages and files to the users are sent within the Telegram limits
+    outbox.start()
+    # files of the tools asking a parameter are uploaded while it is typed
+    prefetcher.start()
+    # scraped by Prometheus from the host
+    metrics_server = MetricsServer() if METRICS_PORT else None
+    if metrics_server:
+        metrics_server.start()
+
+    if BOT_MODE == 'webhook':
+        # same dispatcher and handlers, updates are posted by Telegram
+        webhook = WebhookServer(updater.dispatcher)
+        webhook.set_webhook()
+        webhook.start()
+        webhook.idle()
+    else:
+        updater.start_polling(timeout=POLL_TIMEOUT,
+                              read_latency=POLL_READ_LATENCY,
+                              bootstrap_retries=POLL_BOOTSTRAP_RETRIES)
+        updater.idle()
+    engine.stop()
+    # after the jobs, which wait for their files to be sent
+    outbox.stop()
+    prefetcher.stop()
+    rasterizer.stop()
+    office_pool.stop()
+    if metrics_server:
+        metrics_server.stop()
+
+
+if __name__ == '__main__':
+    main()
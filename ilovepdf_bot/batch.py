@@ -0,0 +1,86 @@
+import logging
+import threading
+from typing import Callable, Hashable, List
+
+from .constants import BATCH_MAX_FILES, BATCH_WINDOW
+from .jobs import checkpoint
+
+logger = logging.getLogger(__name__)
+
+
+class Batch:
+    """
+    Items of the jobs grouped under the same key
+    """
+
+    def __init__(self):
+        self.items = []
+        self.done = []
+        self.full = threading.Event()
+        self.finished = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Group the same work asked by different jobs at about the same time:
+    the first job of a key waits up to window seconds (or max_items
+    items) for others, then runs func once with every item for all of
+    them. A job whose item was not done by the batch (func failed, or it
+    left it out) runs it alone.
+    :param window: (float) seconds the first job waits for others
+    :param max_items: (int) items of a batch
+    """
+
+    def __init__(self, window: float = BATCH_WINDOW,
+                 max_items: int = BATCH_MAX_FILES):
+        self.window = window
+        self.max_items = max(1, max_items)
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: Hashable, item,
+            func: Callable[[list], List[bool]]) -> bool:
+        """
+        Add item to the open batch of key, or open one, and wait for the
+        batch to run
+        :param key: e.g. the tool and its options
+        :param item: passed to func with the items of the other jobs
+        :param func: (callable) running a batch, it returns a bool per item,
+        True if the item was done
+        :return: (bool) True if the item was done by the batch
+        """
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_items:
+                del self._open[key]
+                batch.full.set()
+        if leader:
+            self._lead(key, batch, func)
+        else:
+            while not batch.finished.wait(1):
+                checkpoint()
+        return batch.done[index]
+
+    def _lead(self, key: Hashable, batch: Batch, func: Callable) -> None:
+        batch.full.wait(self.window)
+        with self._lock:
+            if self._open.get(key) is batch:
+                del self._open[key]
+        try:
+            if len(batch.items) > 1:
+                batch.done = list(func(batch.items))
+        except Exception as exc:
+            # each job runs its item alone
+            logger.warning("batch of %s items failed: %s",
+                           len(batch.items), exc)
+        finally:
+            batch.done += [False] * (len(batch.items) - len(batch.done))
+            batch.finished.set()
+
+
+batcher = MicroBatcher()
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import List
+
+from .constants import CACHE_DIR, CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def dir_size(path: str) -> int:
+    """
+    Return the size in bytes of the files in a folder (not recursive)
+    :param path: (str) of the folder
+    :return: (int) bytes
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(path)
+               if entry.is_file())
+
+
+def file_digest(path: str) -> str:
+    """
+    Return the SHA-256 of a file content
+    :param path: (str) of the file
+    :return: (str) hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class OutputCache:
+    """
+    Content-addressed cache of ilovepdf outputs on disk, keyed by
+    the SHA-256 of the input bytes plus the tool and its options.
+    Each entry is a folder with the output file(s), written in a temporary
+    folder and renamed, so readers never see a half-written entry.
+    The root folder is created (and its entries loaded) on first use.
+    :param root: (str) folder of the cache entries
+    :param max_bytes: (int) budget, least recently used entries are evicted
+    (0 disables the cache)
+    """
+
+    def __init__(self, root: str = CACHE_DIR,
+                 max_bytes: int = CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _load(self) -> None:
+        # called with the lock held
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.root, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            if entry.name.startswith('.'):
+                # temporary folder of an interrupted write
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            entries.append((entry.stat().st_mtime, entry.name,
+                            dir_size(entry.path)))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(digests: List[str], tool: str, options: dict = None) -> str:
+        """
+        Return the cache key of a request
+        :param digests: (list) of the input files sha256, see file_digest()
+        :param tool: (str) e.g. 'compress'
+        :param options: (dict) of the tool options
+        :return: (str) sha256 hex digest
+        """
+        params = json.dumps([digests, tool, options or {}], sort_keys=True,
+                            default=str)
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def get(self, key: str, output_dir: str) -> bool:
+        """
+        Copy the cached output(s) of key into output_dir folder
+        :param key: (str) returned by key()
+        :param output_dir: (str) folder to copy the output file(s)
+        :return: (bool) True on a cache hit
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            self._load()
+            found = key in self._entries
+            if found:
+                self._entries.move_to_end(key)
+        entry_dir = os.path.join(self.root, key)
+        if found:
+            # copied beside output_dir first, so an entry evicted while it
+            # is copied leaves nothing in output_dir
+            tmp_dir = f"{output_dir.rstrip(os.sep)}.{uuid.uuid4().hex}"
+            try:
+                os.mkdir(tmp_dir)
+                for file_name in os.listdir(entry_dir):
+                    shutil.copyfile(os.path.join(entry_dir, file_name),
+                                    os.path.join(tmp_dir, file_name))
+                os.utime(entry_dir)
+                os.makedirs(output_dir, exist_ok=True)
+                for file_name in os.listdir(tmp_dir):
+                    os.replace(os.path.join(tmp_dir, file_name),
+                               os.path.join(output_dir, file_name))
+            except OSError:
+                # evicted while it was being copied
+                logger.warning("cache entry %s vanished", key)
+                found = False
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def put(self, key: str, output_dir: str) -> None:
+        """
+        Store the output file(s) of output_dir folder under key
+        :param key: (str) returned by key()
+        :param output_dir: (str) folder with the output file(s)
+        :return: None
+        """
+        if not self.enabled or not os.path.isdir(output_dir):
+            return
+        size = dir_size(output_dir)
+        if not size or size > self.max_bytes:
+            return
+        with self._lock:
+            self._load()
+        tmp_dir = os.path.join(self.root, f".{uuid.uuid4().hex}")
+        os.mkdir(tmp_dir)
+        for entry in os.scandir(output_dir):
+            if entry.is_file():
+                shutil.copyfile(entry.path, os.path.join(tmp_dir, entry.name))
+        try:
+            os.rename(tmp_dir, os.path.join(self.root, key))
+        except OSError:
+            # another worker stored the same key first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with self._lock:
+            self._entries[key] = size
+            self.bytes += size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def stats(self) -> dict:
+        """
+        Return the cache counters
+        :return: (dict) with entries, bytes, hits, misses and evictions
+        """
+        with self._lock:
+            if self.enabled:
+                self._load()
+            return {'entries': len(self._entries), 'bytes': self.bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+cache = OutputCache()
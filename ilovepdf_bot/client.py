@@ -0,0 +1,313 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from pylovepdf.response import Response
+from requests.adapters import HTTPAdapter
+
+from .constants import (ILOVEPDF_CONNECT_TIMEOUT, ILOVEPDF_POOL_SIZE,
+                        ILOVEPDF_PROCESS_TIMEOUT, ILOVEPDF_READ_TIMEOUT,
+                        ILOVEPDF_TOKEN_TTL, ILOVEPDF_URL)
+from .jobs import remaining
+from .limiter import limiter
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# seconds before the token expiration to ask a new one
+TOKEN_MARGIN = 60
+# requests whose latency tells how loaded ilovepdf is (the uploads and
+# downloads depend on the bandwidth, and the others are too short)
+LATENCY_ENDPOINTS = ('process',)
+# requests waiting for ilovepdf up to PROCESS_TIMEOUT
+LONG_ENDPOINTS = ('upload', 'process', 'download')
+# bytes of the smallest size class of the uploaded files of a task, each
+# next class is SIZE_CLASS_FACTOR times bigger
+SIZE_CLASS_BYTES = 256 * 1024
+SIZE_CLASS_FACTOR = 4
+
+
+def body_size(payload, files: dict = None) -> int:
+    """
+    Return the bytes of the files (or of the streamed body) of a request
+    :param payload: (dict or streaming.MultipartStream) form data
+    :param files: (dict) files to upload
+    :return: (int) bytes, 0 if unknown
+    """
+    size = getattr(payload, 'len', 0)
+    for f in (files or {}).values():
+        try:
+            size += os.fstat(f.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            pass
+    return size
+
+
+def size_class(size: int) -> int:
+    """
+    Return the size class of the files of a task: the latency of a tool
+    is only compared with the one of tasks of about the same size
+    :param size: (int) bytes uploaded for the task
+    :return: (int) 0 up to SIZE_CLASS_BYTES, then one more per
+    SIZE_CLASS_FACTOR times more bytes
+    """
+    cls = 0
+    while size > SIZE_CLASS_BYTES:
+        size //= SIZE_CLASS_FACTOR
+        cls += 1
+    return cls
+
+
+def request_timeout(endpoint: str) -> tuple:
+    """
+    Return the timeouts of an ilovepdf request, the long ones waiting no
+    longer than the time left to the job
+    :param endpoint: (str) of the request, e.g. 'process'
+    :return: (tuple) (connect, read) seconds
+    """
+    if endpoint.split('/')[0] not in LONG_ENDPOINTS:
+        return ILOVEPDF_CONNECT_TIMEOUT, ILOVEPDF_READ_TIMEOUT
+    read = ILOVEPDF_PROCESS_TIMEOUT
+    left = remaining()
+    if left is not None:
+        read = max(1.0, min(read, left))
+    return ILOVEPDF_CONNECT_TIMEOUT, read
+
+
+def token_expiration(token: str, default_ttl: float) -> float:
+    """
+    Return the expiration (unix time) of a JWT, read from its 'exp' claim
+    :param token: (str) the JWT
+    :param default_ttl: (float) seconds used if the token has no 'exp'
+    :return: (float) unix time
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_ttl
+
+
+class SharedTask:
+    """
+    Mixin of the pylovepdf tools sending every request through a LoveClient,
+    so tasks reuse its token and its keep-alive connections
+    """
+
+    client = None
+
+    def auth(self):
+        self._set_token(self.client.token())
+        self._set_headers()
+
+    def _auth_headers(self) -> dict:
+        """
+        Return the headers of the task with the client token, a new one
+        once the token of the task expired or was rejected
+        """
+        token = self.client.token()
+        if token != self.token:
+            self._set_token(token)
+            self._set_headers()
+        return self.headers
+
+    def _send_request(self, method, endpoint, payload, headers=None,
+                      start=False, files=None, stream=None, proxies=None):
+        server = self.client.start_server
+        if not start and self.working_server:
+            server = self.working_server
+        if headers is None:
+            return self.client.send(method, server, endpoint, payload,
+                                    files=files, stream=stream)
+        response = self.client.send(method, server, endpoint, payload,
+                                    headers=dict(headers,
+                                                 **self._auth_headers()),
+                                    files=files, stream=stream)
+        # the token asked again if this one was rejected
+        self._auth_headers()
+        return response
+
+    def delete_current_task(self):
+        server = self.working_server or self.client.start_server
+        self.client.send('delete', server, f"task/{self.task}", None,
+                         headers=self._auth_headers())
+
+
+class LoveClient:
+    """
+    Long-lived ilovepdf client shared by the worker threads: it caches the
+    auth token (JWT) until it expires and keeps a pooled keep-alive
+    requests.Session per ilovepdf server host
+    :param public_key: (str) ilovepdf project public key
+    :param verify_ssl: (bool) verify the servers certificates
+    :param pool_size: (int) keep-alive connections kept per host
+    :param token_ttl: (float) seconds a token is used if it has no 'exp'
+    :param base_url: (str) send every request to this server instead of
+    the ilovepdf ones, e.g. 'http://127.0.0.1:8099' (a fake ilovepdf)
+    """
+
+    start_server = 'api.ilovepdf.com'
+    api_version = 'v1'
+
+    def __init__(self, public_key: str, verify_ssl: bool = True,
+                 pool_size: int = ILOVEPDF_POOL_SIZE,
+                 token_ttl: float = ILOVEPDF_TOKEN_TTL,
+                 base_url: str = ILOVEPDF_URL):
+        self.public_key = public_key
+        self.base_url = base_url.rstrip('/')
+        self.verify_ssl = verify_ssl
+        self.pool_size = pool_size
+        self.token_ttl = token_ttl
+        self._token = ''
+        self._expires = 0.0
+        self._token_lock = threading.Lock()
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._tools = {}
+        self._tools_lock = threading.Lock()
+        # task id -> bytes uploaded, to tell the size of its process
+        self._uploaded = {}
+        self._uploaded_lock = threading.Lock()
+
+    def token(self) -> str:
+        """
+        Return a valid auth token, asking a new one only when the cached one
+        is about to expire
+        :return: (str) the JWT
+        """
+        with self._token_lock:
+            if not self._token or time.time() > self._expires - TOKEN_MARGIN:
+                response = self._request('post', self.start_server, 'auth',
+                                         {'public_key': self.public_key})
+                self._token = Response(response).token
+                self._expires = token_expiration(self._token, self.token_ttl)
+            return self._token
+
+    def _invalidate(self, token: str) -> None:
+        with self._token_lock:
+            if self._token == token:
+                self._token = ''
+
+    def session(self, host: str) -> requests.Session:
+        """
+        Return the keep-alive session of an ilovepdf server host
+        :param host: (str) e.g. 'api11.ilovepdf.com'
+        :return: (requests.Session)
+        """
+        with self._sessions_lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size)
+                session.mount(f"https://{host}", adapter)
+                session.mount(f"http://{host}", adapter)
+                self._sessions[host] = session
+            return session
+
+    def url(self, host: str, endpoint: str) -> str:
+        base_url = self.base_url or f"https://{host}"
+        return f"{base_url}/{self.api_version}/{endpoint}"
+
+    def _request(self, method, host, endpoint, payload, headers=None,
+                 files=None, stream=None) -> requests.Response:
+        start = time.monotonic()
+        try:
+            response = self.session(host).request(
+                method, self.url(host, endpoint), data=payload,
+                headers=headers, files=files, stream=stream,
+                timeout=request_timeout(endpoint), verify=self.verify_ssl)
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            metrics.inc('errors_total', source='ilovepdf',
+                        type=type(exc).__name__)
+            limiter.overloaded()
+            raise
+        metrics.inc('bytes_out_total', body_size(payload, files),
+                    peer='ilovepdf')
+        metrics.inc('bytes_in_total',
+                    int(response.headers.get('Content-Length') or 0),
+                    peer='ilovepdf')
+        if response.status_code >= 400:
+            metrics.inc('errors_total', source='ilovepdf',
+                        type=f"http_{response.status_code}")
+        uploaded = self._track_upload(endpoint, payload, files)
+        # the limit of tasks at once follows how loaded ilovepdf is
+        if response.status_code == 429 or response.status_code >= 500:
+            limiter.overloaded()
+        elif endpoint.split('/')[0] in LATENCY_ENDPOINTS:
+            tool = payload.get('tool') if isinstance(payload, dict) else None
+            limiter.observe(time.monotonic() - start,
+                            (tool, size_class(uploaded)))
+        return response
+
+    def _track_upload(self, endpoint: str, payload, files: dict) -> int:
+        """
+        Count the bytes uploaded for a task until it is processed
+        :param endpoint: (str) of the request, e.g. 'upload'
+        :param payload: (dict or streaming.MultipartStream) form data
+        :param files: (dict) files uploaded
+        :return: (int) bytes uploaded for the task, when it is processed
+        """
+        fields = getattr(payload, 'fields', payload)
+        task_id = fields.get('task') if isinstance(fields, dict) else None
+        if endpoint.startswith('task/'):
+            task_id = endpoint[5:]
+        if not task_id:
+            return 0
+        with self._uploaded_lock:
+            if endpoint == 'upload':
+                self._uploaded[task_id] = \
+                    self._uploaded.get(task_id, 0) + body_size(payload, files)
+                return 0
+            if endpoint in LATENCY_ENDPOINTS or endpoint.startswith('task/'):
+                return self._uploaded.pop(task_id, 0)
+            return 0
+
+    def send(self, method: str, host: str, endpoint: str, payload,
+             headers: dict = None, files: dict = None,
+             stream: bool = None) -> Response:
+        """
+        Send a request to an ilovepdf server, asking a new token and
+        retrying once if the token was rejected
+        :param method: (str) 'get', 'post' or 'delete'
+        :param host: (str) ilovepdf server host
+        :param endpoint: (str) e.g. 'upload'
+        :param payload: (dict) form data
+        :param headers: (dict) with the Authorization header
+        :param files: (dict) files to upload
+        :param stream: (bool) stream the response content
+        :return: (pylovepdf.response.Response)
+        """
+        response = self._request(method, host, endpoint, payload,
+                                 headers, files, stream)
+        # a streamed body can not be sent again
+        if response.status_code == 401 and headers and \
+                not hasattr(payload, 'read'):
+            logger.info("ilovepdf token rejected, asking a new one")
+            self._invalidate(headers.get('Authorization', '')[7:])
+            headers = dict(headers, Authorization=f"Bearer {self.token()}")
+            for f in (files or {}).values():
+                f.seek(0)
+            response = self._request(method, host, endpoint, payload,
+                                     headers, files, stream)
+        return Response(response)
+
+    def task(self, tool):
+        """
+        Return a new task of a pylovepdf tool using this client
+        :param tool: (pylovepdf.task.Task) subclass, e.g. Compress
+        :return: the tool object, authenticated and started
+        """
+        with self._tools_lock:
+            shared_tool = self._tools.get(tool)
+            if shared_tool is None:
+                shared_tool = type(tool.__name__, (SharedTask, tool),
+                                   {'client': self})
+                self._tools[tool] = shared_tool
+        return shared_tool(self.public_key, verify_ssl=self.verify_ssl,
+                           proxies=None)
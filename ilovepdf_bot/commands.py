@@ -1,30 +1,313 @@
 import os
+from collections import namedtuple
 
 from dotenv import load_dotenv
 from telegram import ChatAction, ReplyKeyboardRemove, ParseMode
 from telegram.ext import CommandHandler, ConversationHandler, MessageHandler
-from telegram.ext.dispatcher import run_async
+from telegram.ext.dispatcher import run_async as dispatcher_run_async
 
+from . import streaming
 from .constants import *
+from .delivery import resend, send_pages, send_zip
+from .jobs import JobTimeout, engine
+from .metrics import metrics
+from .prefetch import prefetcher
+from .raster import rasterizer
+from .results import Results, flights, index
+from .state import store
+from .streaming import TelegramSource
 from .ilovepdf import (love_addpagenumbers, love_compress, love_imgtopdf,
-                       love_merge, love_officetopdf, love_pdfa, love_pdftojpg,
+                       love_officetopdf, love_pdfa, love_pdftojpg,
                        love_protect, love_rotate, love_split, love_unlock,
                        love_watermark)
-from .utils import (ask_file, bye, del_tmp, file_ok, img_ok, result_file,
-                    unzip_file, usr_msg)
+from .utils import (ask_file, bye, file_ok, img_ok, is_too_large, reply_text,
+                    result_file, send_file, status_usr_msg, usr_msg)
+from .workspace import QuotaExceeded, workspaces
 
 load_dotenv()
 token = os.getenv('BOT_TOKEN')
 
 
+def run_async(func):
+    """
+    ptb run_async, unless the conversations states are persistent: the
+    state returned by a run_async handler is a Promise, which can not be
+    stored (the entry points only queue their message in the outbox, they
+    do not hold the dispatcher)
+    """
+    return func if store.persistent else dispatcher_run_async(func)
+
+
+# files the conversations keep in the store until their parameter comes
+STORED_FILES = ('imgtopdf', 'protect', 'split', 'rotate', 'watermark')
+
+
 # cancel action
-def cancel_without_async(update):
-    update.effective_message.reply_text(
+def cancel_without_async(update, context=None):
+    chat_id = update.effective_chat.id
+    prefetcher.discard(chat_id)
+    for name in STORED_FILES:
+        store.pop(chat_id, name)
+    reply_text(
+        update,
         "🚫 Action cancelled"
     )
     return ConversationHandler.END
 
 
+# background jobs
+def submit_job(update, func, *args) -> None:
+    """
+    Queue func(update, *args) in the job engine so the handler can return
+    right away, or tell the user to come back later if the queue is full
+    :param update: (telegram.update.Update) the update object
+    :param func: (callable) job running the ilovepdf stages
+    :return: None
+    """
+    queued = engine.submit(func, update, *args,
+                           on_error=lambda exc: job_failed(update, exc),
+                           chat_id=update.effective_chat.id,
+                           size=job_size(args))
+    if not queued:
+        msg = "I'm very busy right now 😔, please try again in a few minutes"
+        usr_msg(update=update, msg=msg, error=False)
+
+
+def job_size(args) -> int:
+    """
+    Return the bytes of the user files among the arguments of a job
+    (a Document, a FileRef or a list of them)
+    :param args: (tuple) of the job
+    :return: (int) bytes
+    """
+    size = 0
+    for arg in args:
+        for usr_file in arg if isinstance(arg, list) else [arg]:
+            size += getattr(usr_file, 'file_size', 0) or 0
+    return size
+
+
+def job_failed(update, exc: Exception) -> None:
+    """
+    Send an error message to the user when a job fails or times out
+    :param update: (telegram.update.Update) the update object
+    :param exc: (Exception) raised by the job
+    :return: None
+    """
+    msg = ''
+    if isinstance(exc, JobTimeout):
+        msg = "It is taking me too long ⏳, please try again later"
+    elif isinstance(exc, QuotaExceeded):
+        msg = "Your file is too large for me to process 😔"
+    usr_msg(update=update, msg=msg)
+
+
+def reuse_results(update, unique_id: str, tool: str, params=()) -> bool:
+    """
+    Answer with the outputs already sent for the same input, tool and
+    parameters (no download, no ilovepdf task and no upload)
+    :param update: (telegram.update.Update) the update object
+    :param unique_id: (str) telegram file_unique_id of the input
+    :param tool: (str) e.g. 'compress'
+    :param params: (tuple) of the tool parameters
+    :return: (bool) True if the user was answered
+    """
+    results = index.get(unique_id, tool, params)
+    if not results:
+        return False
+    resend(update, results)
+    bye(update)
+    return True
+
+
+# run: ilovepdf function called with (file_path, *params),
+# file_path is the input path without extension and the output folder
+# ext: extension of the input file, None to use the first param
+# caption: of a single result file, formatted with the params
+# zip_caption: of each file of a zip result, formatted with its number
+# zip_msg: sent after the files of a zip result
+# zip_file_caption: of a zip result sent as one document,
+# formatted with its number of files
+# pages: local alternative to run, called with the same arguments, it
+# returns an iterator of the result files (sent as they are yielded)
+# or None to use run
+Tool = namedtuple('Tool', ['run', 'ext', 'caption', 'zip_caption',
+                           'zip_msg', 'action', 'zip_file_caption', 'pages'],
+                  defaults=['', None])
+
+tools = {
+    'compress': Tool(
+        run=love_compress, ext='pdf',
+        caption="✨ Here is your compressed file",
+        zip_caption='', zip_msg='', action=ChatAction.UPLOAD_DOCUMENT),
+    'officetopdf': Tool(
+        run=lambda path, ext: love_officetopdf(f"{path}.{ext}", path),
+        ext=None,
+        caption="✨ Here is your PDF file",
+        zip_caption='', zip_msg='', action=ChatAction.UPLOAD_DOCUMENT),
+    'addpagenumbers': Tool(
+        run=love_addpagenumbers, ext='pdf',
+        caption="✨ Here is your PDF file with page numbers",
+        zip_caption='', zip_msg='', action=ChatAction.UPLOAD_DOCUMENT),
+    'pdfa': Tool(
+        run=love_pdfa, ext='pdf',
+        caption="✨ Here is your PDF/A file",
+        zip_caption='', zip_msg='', action=ChatAction.UPLOAD_DOCUMENT),
+    'pdftojpg': Tool(
+        run=love_pdftojpg, ext='pdf',
+        caption="🖼 page 1 of your PDF file",
+        zip_caption="🖼 page {0} of your PDF file",
+        zip_msg="✨ Here are your jpg images",
+        action=ChatAction.UPLOAD_PHOTO,
+        zip_file_caption="🗜 Here are the {0} pages of your PDF file",
+        pages=rasterizer.pages),
+    'protect': Tool(
+        run=lambda path, password: love_protect(f"{path}.pdf", password,
+                                                path),
+        ext='pdf',
+        caption="✨ Here is your protected PDF file",
+        zip_caption='', zip_msg='', action=ChatAction.UPLOAD_DOCUMENT),
+    'split': Tool(
+        run=lambda path, range: love_split(f"{path}.pdf", path, int(range)),
+        ext='pdf',
+        caption="The range you sent me generated just one PDF file.",
+        zip_caption="📄 {0} range of your PDF file",
+        zip_msg="✨ Here are your PDF files",
+        action=ChatAction.UPLOAD_PHOTO,
+        zip_file_caption="🗜 Here are your {0} PDF files"),
+    'rotate': Tool(
+        run=lambda path, angle: love_rotate(f"{path}.pdf", path, int(angle)),
+        ext='pdf',
+        caption="✨ Here is your {0} rotated PDF file",
+        zip_caption='', zip_msg='', action=ChatAction.UPLOAD_DOCUMENT),
+    'unlock': Tool(
+        run=lambda path: love_unlock(f"{path}.pdf", path), ext='pdf',
+        caption="✨ Here is your unlocked file",
+        zip_caption='', zip_msg='', action=ChatAction.UPLOAD_DOCUMENT),
+    'watermark': Tool(
+        run=lambda path, text: love_watermark(f"{path}.pdf", path, text),
+        ext='pdf',
+        caption="✨ Here is your marked file",
+        zip_caption="📄 {0} range of your PDF file",
+        zip_msg="✨ Here are your PDF files",
+        action=ChatAction.UPLOAD_PHOTO,
+        zip_file_caption="🗜 Here are your {0} PDF files"),
+}
+
+
+def run_tool(update, spec: Tool, ws, file_path: str, params) -> Results:
+    """
+    Run the ilovepdf function of a tool and send its result file(s)
+    :param update: (telegram.update.Update) the update object
+    :param spec: (Tool) of the tool
+    :param ws: (workspace.Workspace) of the job
+    :param file_path: (str) input path without extension and output folder
+    :param params: of the tool, e.g. the password for 'protect'
+    :return: (list) of (file_id, caption) of the sent documents
+    """
+    spec.run(file_path, *params)
+    ws.check()
+    # get the path of the result file
+    output_file = result_file(file_path)
+    results = []
+    if not output_file:
+        usr_msg(update)
+    elif spec.zip_caption and output_file.endswith('.zip'):
+        results = send_zip(update, f"{file_path}/{output_file}",
+                           spec.zip_file_caption, spec.zip_caption,
+                           action=spec.action)
+        usr_msg(update=update, msg=spec.zip_msg, error=False)
+    else:
+        caption = spec.caption.format(*params)
+        msg = send_file(update, f"{file_path}/{output_file}", caption,
+                        action=spec.action)
+        results.append((msg.document.file_id, caption))
+    return results
+
+
+def tool_job(update, bot, doc, tool: str, *params) -> None:
+    """
+    Download the user file, run an ilovepdf tool on it and answer with the
+    result file(s) or an error message (runs in a job worker), the
+    identical requests (same file, tool and parameters) which arrive
+    while it runs are answered with its result file(s) too
+    :param update: (telegram.update.Update) the update object
+    :param bot: (telegram.Bot) the bot object
+    :param doc: (telegram.Document or state.FileRef) the user file
+    :param tool: (str) key of tools, e.g. 'compress'
+    :param params: of the tool, e.g. the password for 'protect'
+    :return: None
+    """
+    with metrics.command(tool):
+        chat_id = update.effective_chat.id
+        if reuse_results(update, doc.file_unique_id, tool, params) or \
+                flights.join(doc.file_unique_id, tool, params, update):
+            # answered now, or with the outputs of the identical job running
+            prefetcher.discard(chat_id, tool, doc.file_unique_id)
+            return
+        try:
+            results = run_tool_job(update, bot, doc, tool, *params)
+        except Exception as exc:
+            for waiting in flights.finish(doc.file_unique_id, tool, params):
+                job_failed(waiting, exc)
+            raise
+        for waiting in flights.finish(doc.file_unique_id, tool, params):
+            if results:
+                resend(waiting, results)
+                bye(waiting)
+            else:
+                usr_msg(waiting)
+
+
+def run_tool_job(update, bot, doc, tool: str, *params) -> Results:
+    """
+    Download the user file, run an ilovepdf tool on it and answer with the
+    result file(s) or an error message
+    :param update: (telegram.update.Update) the update object
+    :param bot: (telegram.Bot) the bot object
+    :param doc: (telegram.Document or state.FileRef) the user file
+    :param tool: (str) key of tools, e.g. 'compress'
+    :param params: of the tool, e.g. the password for 'protect'
+    :return: (list) of (file_id, caption) of the sent documents
+    """
+    chat_id = update.effective_chat.id
+    spec = tools[tool]
+    ext = spec.ext or params[0]
+    # downloaded (and uploaded) while the user typed the parameter
+    staged = prefetcher.take(chat_id, tool, doc)
+    with staged or workspaces.create() as ws:
+        file_path = ws.file(doc.file_id)
+        if not staged:
+            ws.reserve(doc.file_size)
+            with metrics.stage('telegram_download'):
+                usr_file = bot.getFile(doc.file_id)
+                if STREAM_UPLOADS:
+                    # piped from telegram to ilovepdf when the task uploads
+                    # it (the bytes are counted as they are read)
+                    streaming.defer(f"{file_path}.{ext}",
+                                    TelegramSource(usr_file))
+                else:
+                    usr_file.download(f"{file_path}.{ext}")
+                    metrics.inc('bytes_in_total', doc.file_size or 0,
+                                peer='telegram')
+        # a file_id folder is created to know where the file is
+        os.mkdir(file_path)
+        pages = spec.pages(file_path, *params) if spec.pages else None
+        if pages is not None:
+            # rendered locally, each file is sent as soon as it is ready
+            # (or zipped when they are many, as the ilovepdf results)
+            results = send_pages(update, pages,
+                                 os.path.join(file_path, 'pages.zip'),
+                                 spec.zip_file_caption, spec.zip_caption,
+                                 action=spec.action)
+            usr_msg(update=update, msg=spec.zip_msg, error=False)
+        else:
+            results = run_tool(update, spec, ws, file_path, params)
+    index.put(doc.file_unique_id, tool, results, params)
+    bye(update)
+    return results
+
+
 # compress functions
 def compress_pdf(update, context):
     """
@@ -41,29 +324,9 @@ def compress_pdf(update, context):
         usr_msg(update=update,
                 msg="please wait a moment while I compress it for you...",
                 error=False)
-        file_id = doc.file_id
-        usr_file = context.bot.getFile(file_id)
-        file_path = f"./tmp/{file_id}"
-        usr_file.download(f"{file_path}.pdf")
-        # a file_id folder is created to know where the file is
-        os.mkdir(file_path)
-        # compress the file
-        love_compress(file_path)
-        # get the path of the compressed file
-        compressed_file = result_file(file_path)
-        if compressed_file:
-            update.effective_message.chat.send_action(
-                ChatAction.UPLOAD_DOCUMENT)
-            update.effective_message.reply_document(
-                document=open(f"{file_path}/{compressed_file}", "rb"),
-                caption="✨ Here is your compressed file",
-            )
-        else:
-            usr_msg(update)
-        bye(update)
+        submit_job(update, tool_job, context.bot, doc, 'compress')
     else:
         compress(update, context)
-    del_tmp()
     return ConversationHandler.END
 
 
@@ -91,6 +354,9 @@ def compress_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='compress',
+        persistent=store.persistent,
     )
 
     return conv_handler
@@ -99,8 +365,7 @@ def compress_handler():
 # imgtopdf functions
 @run_async
 def imgtopdf(update, context):
-    global images
-    images = []
+    store.pop(update.effective_chat.id, 'imgtopdf')
     msg = "🖼 Send me an image file you want to convert, please. " \
           "*(I strongly recommend you DO NOT compress it.)*"
     return ask_file(update, msg, WAIT_FILE_IMGTOPDF)
@@ -115,17 +380,17 @@ def check_img(update, context):
     the context object
     :return: (int) WAIT_MERGE constant according to handler state
     """
+    chat_id = update.effective_chat.id
     img = img_ok(update=update)
-    if img:
-        file_id = img.file_id
-        file_path = f"./tmp/{file_id}"
-        usr_file = context.bot.getFile(file_id)
-        usr_file.download(f"{file_path}.png")
-        images.append(file_path)
+    # images are downloaded by the job, once the user sends 'done'
+    if img and not store.add_file(chat_id, 'imgtopdf', img):
+        msg = "I can't take more images 😔, send me the word *'done'* " \
+              "to get the PDF file with the ones I received"
+        return ask_file(update, msg, WAIT_IMGTOPDF)
 
     msg = "Send me the word *'done'* if you want the PDF file, " \
           "or send me more images 🖼"
-    if images:
+    if store.files(chat_id, 'imgtopdf'):
         return ask_file(update, msg, WAIT_IMGTOPDF)
     else:
         return imgtopdf(update, context)
@@ -144,6 +409,7 @@ def check_text(update, context):
     text = update.effective_message.text
     if text:
         if text.lower() == 'done':
+            images = store.pop_files(update.effective_chat.id, 'imgtopdf')
             if images:
                 usr_msg(update=update,
                         msg=f"I received {len(images)} images, "
@@ -151,7 +417,8 @@ def check_text(update, context):
                             f"I convert them for you...",
                         error=False)
                 # convert images to PDF
-                img_to_pdf(update, images)
+                submit_job(update, img_to_pdf, context.bot, images)
+                return ConversationHandler.END
             else:
                 return ConversationHandler.END
         elif text.lower() == 'cancel':
@@ -164,51 +431,51 @@ def check_text(update, context):
             return ask_file(update, msg, WAIT_IMGTOPDF)
 
 
-def img_to_pdf(update, images):
+def img_to_pdf(update, bot, imgs):
     """
     Answer to the user with the PDF file
-    or an error message.
+    or an error message (runs in a job worker).
     :param update: (telegram.update.Update) the update object
-    :param images: (list) of each image paths
-    :return: (ConversationHandler.END) after send the file or message
+    :param bot: (telegram.Bot) the bot object
+    :param imgs: (list) of FileRef of each user image
+    :return: None
     """
-    pdfs = []
-    merged_file = ''
-    pdf_file = ''
-    final_file = None
-
-    # convert each image to PDF
-    for file_path in images:
-        love_imgtopdf(file_path)
-        converted_file = result_file(file_path)
-        if converted_file:
-            pdfs.append(f"{file_path}/{converted_file}")
-    if images:
-        last_file_id = images[-1]  # .split('.')[0]
-        output_dir = f"{last_file_id}-merge"
-        if len(images) == 1:
-            pdf_file = pdfs[0]
-            if pdf_file:
-                final_file = pdf_file
-        else:
-            # merge all PDF files
-            love_merge(files=pdfs, output_dir=output_dir)
-            merged_file = result_file(output_dir)
-
-            if merged_file:
-                final_file = f"{output_dir}/{merged_file}"
-
-        if final_file:
-            update.effective_message.chat.send_action(
-                ChatAction.UPLOAD_DOCUMENT)
-            update.effective_message.reply_document(
-                document=open(final_file, "rb"),
-                caption="✨ Here is your PDF file", )
-        else:
-            usr_msg(update, error=True)
-    bye(update)
-    del_tmp()
-    return ConversationHandler.END
+    with metrics.command('imgtopdf'):
+        unique_id = ','.join(img.file_unique_id for img in imgs)
+        if reuse_results(update, unique_id, 'imgtopdf'):
+            return
+        with workspaces.create() as ws:
+            images = []
+            for img in imgs:
+                file_path = ws.file(img.file_id)
+                ws.reserve(img.file_size)
+                with metrics.stage('telegram_download'):
+                    bot.getFile(img.file_id).download(f"{file_path}.png")
+                metrics.inc('bytes_in_total', img.file_size or 0,
+                            peer='telegram')
+                images.append(file_path)
+            merge_images(update, unique_id, images)
+        bye(update)
+
+
+def merge_images(update, unique_id: str, images) -> None:
+    """
+    Convert the downloaded images to one PDF file and send it to the user
+    :param update: (telegram.update.Update) the update object
+    :param unique_id: (str) of the images, to index the result
+    :param images: (list) of each image path without extension
+    :return: None
+    """
+    # one task for every image, merged by ilovepdf
+    output_dir = f"{images[-1]}-merge"
+    love_imgtopdf([f"{file_path}.png" for file_path in images], output_dir)
+    merged_file = result_file(output_dir)
+    if merged_file:
+        caption = "✨ Here is your PDF file"
+        msg = send_file(update, f"{output_dir}/{merged_file}", caption)
+        index.put(unique_id, 'imgtopdf', [(msg.document.file_id, caption)])
+    else:
+        usr_msg(update, error=True)
 
 
 def error_imgtopdf(update, context):
@@ -234,19 +501,28 @@ def imgtopdf_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='imgtopdf',
+        persistent=store.persistent,
     )
 
     return conv_handler
 
 
 # office to pdf functions
+# mime type ending: extension of the office file
+office_ext = {'opendocument.text': 'docx',
+              'wordprocessingml.document': 'docx',
+              'sheet': 'xls', 'presentation': 'ppt'}
+
+
 @run_async
 def officetopdf(update, context):
-    office_ext = ('odt', 'doc', 'docx',
-                  'ods', 'xls', 'xlsx',
-                  'odp', 'ppt', 'pptx')
+    allowed_ext = ('odt', 'doc', 'docx',
+                   'ods', 'xls', 'xlsx',
+                   'odp', 'ppt', 'pptx')
     msg = f"📄 Send me an office file you want to convert, please. " \
-          f"Extensions allowed are: {', '.join(office_ext)}",
+          f"Extensions allowed are: {', '.join(allowed_ext)}"
     return ask_file(update, msg, WAIT_OFFICETOPDF)
 
 
@@ -259,38 +535,15 @@ def office_to_pdf(update, context):
     :return: (int) WAIT_CONVERT constant according to handler state
     """
     doc = update.message.document
-    valid_ext = {'opendocument.text': 'docx',
-                 'wordprocessingml.document': 'docx',
-                 'sheet': 'xls', 'presentation': 'ppt'}
-
     file_ext = file_ok(update=update, usr_file=doc,
-                       ext=tuple(valid_ext.keys()),
+                       ext=tuple(office_ext.keys()),
                        obj='Office file', send_msg=True)
     if file_ext:
         usr_msg(update=update,
                 msg="please wait a moment while I convert it for you...",
                 error=False)
-        ext = valid_ext[file_ext]
-        file_id = doc.file_id
-        file_path = f"./tmp/{file_id}"
-        usr_file = context.bot.getFile(file_id)
-        usr_file.download(f"{file_path}.{ext}")
-        # a file_id folder is created to know where the file is
-        output_dir = file_path
-        os.mkdir(output_dir)
-        love_officetopdf(f"{file_path}.{ext}", output_dir)
-        converted_file = result_file(output_dir)
-        if converted_file:
-            update.effective_message.chat.send_action(
-                ChatAction.UPLOAD_DOCUMENT)
-            update.effective_message.reply_document(
-                document=open(f"{file_path}/{converted_file}", "rb"),
-                caption="✨ Here is your PDF file",
-            )
-        else:
-            usr_msg(update)
-        bye(update)
-        del_tmp()
+        submit_job(update, tool_job, context.bot, doc, 'officetopdf',
+                   office_ext[file_ext])
     return ConversationHandler.END
 
 
@@ -313,6 +566,9 @@ def officetopdf_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='officetopdf',
+        persistent=store.persistent,
     )
 
     return conv_handler
@@ -331,31 +587,11 @@ def add_page_numbers(update, context):
     doc = update.message.document
     if file_ok(update=update, usr_file=doc):
         msg = "please wait a moment while " \
-              "I add page numbers to it for you...",
+              "I add page numbers to it for you..."
         usr_msg(update=update, msg=msg, error=False)
-        file_id = doc.file_id
-        usr_file = context.bot.getFile(file_id)
-        file_path = f"./tmp/{file_id}"
-        usr_file.download(f"{file_path}.pdf")
-        # a file_id folder is created to know where the file is
-        os.mkdir(file_path)
-        # add page numbers to the file
-        love_addpagenumbers(file_path)
-        # get the path of the result file
-        pagenumbers_file = result_file(file_path)
-        if pagenumbers_file:
-            update.effective_message.chat.send_action(
-                ChatAction.UPLOAD_DOCUMENT)
-            update.effective_message.reply_document(
-                document=open(f"{file_path}/{pagenumbers_file}", "rb"),
-                caption="✨ Here is your compressed file",
-            )
-        else:
-            usr_msg(update)
-        bye(update)
+        submit_job(update, tool_job, context.bot, doc, 'addpagenumbers')
     else:
         return addpagenumbers(update, context)
-    del_tmp()
     return ConversationHandler.END
 
 
@@ -384,6 +620,9 @@ def addpagenumbers_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='addpagenumbers',
+        persistent=store.persistent,
     )
 
     return conv_handler
@@ -403,29 +642,9 @@ def pdf_to_pdfa(update, context):
     doc = update.message.document
     if file_ok(update=update, usr_file=doc):
         msg = "please wait a moment while " \
-              "I convert it to PDF/A ISO standard for you...",
+              "I convert it to PDF/A ISO standard for you..."
         usr_msg(update=update, msg=msg, error=False)
-        file_id = doc.file_id
-        usr_file = context.bot.getFile(file_id)
-        file_path = f"./tmp/{file_id}"
-        usr_file.download(f"{file_path}.pdf")
-        # a file_id folder is created to know where the file is
-        os.mkdir(file_path)
-        # add page numbers to the file
-        love_pdfa(file_path)
-        # get the path of the compressed file
-        pdfa_file = result_file(file_path)
-        if pdfa_file:
-            update.effective_message.chat.send_action(
-                ChatAction.UPLOAD_DOCUMENT)
-            update.effective_message.reply_document(
-                document=open(f"{file_path}/{pdfa_file}", "rb"),
-                caption="✨ Here is your PDF/A file",
-            )
-        else:
-            usr_msg(update)
-        bye(update)
-    del_tmp()
+        submit_job(update, tool_job, context.bot, doc, 'pdfa')
     return ConversationHandler.END
 
 
@@ -453,6 +672,9 @@ def pdfa_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='pdfa',
+        persistent=store.persistent,
     )
 
     return conv_handler
@@ -473,33 +695,7 @@ def pdf_to_jpg(update, context):
         msg = "please wait a moment while " \
               "I convert it to jpg for you..."
         usr_msg(update=update, msg=msg, error=False)
-        file_id = doc.file_id
-        usr_file = context.bot.getFile(file_id)
-        file_path = f"./tmp/{file_id}"
-        usr_file.download(f"{file_path}.pdf")
-        # a file_id folder is created to know where the file is
-        os.mkdir(file_path)
-        # add page numbers to the file
-        love_pdftojpg(file_path)
-        # get the path of the compressed file
-        jpg_zip_file = result_file(file_path)
-        if jpg_zip_file:
-            jpg_files = unzip_file(zip_path=f"{file_path}/{jpg_zip_file}",
-                                   output_dir=f"{file_path}-unzip")
-
-            for num, file_path in enumerate(jpg_files[::-1]):
-                update.effective_message.chat.send_action(
-                    ChatAction.UPLOAD_PHOTO)
-                update.effective_message.reply_document(
-                    document=open(file_path, "rb"),
-                    caption=f"🖼 page {num + 1} of your PDF file",
-                )
-            msg = "✨ Here are your jpg images"
-            usr_msg(update=update, msg=msg, error=False)
-        else:
-            usr_msg(update)
-        bye(update)
-    del_tmp()
+        submit_job(update, tool_job, context.bot, doc, 'pdftojpg')
     return ConversationHandler.END
 
 
@@ -527,16 +723,15 @@ def pdftojpg_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='pdftojpg',
+        persistent=store.persistent,
     )
 
     return conv_handler
 
 
 # protectpdf functions
-global pdf_to_protect
-pdf_to_protect = None
-
-
 @run_async
 def protectpdf(update, context):
     msg = "📄 Send me the PDF file you want to protect, please. "
@@ -554,13 +749,11 @@ def check_pdf_protect(update, context):
     """
     doc = update.message.document
     if file_ok(update=update, usr_file=doc):
-        file_id = doc.file_id
-        file_path = f"./tmp/{file_id}"
-        os.mkdir(file_path)
-        usr_file = context.bot.getFile(file_id)
-        usr_file.download(f"{file_path}.pdf")
-        global pdf_to_protect
-        pdf_to_protect = f"{file_path}.pdf"
+        # the ilovepdf task is started (and the file uploaded) while
+        # the user types the password
+        store.set_file(update.effective_chat.id, 'protect', doc)
+        prefetcher.stage(update.effective_chat.id, 'protect', context.bot,
+                         doc)
         msg = "Send me the password to protect the PDF file, please 🔑"
         return ask_file(update, msg, WAIT_PROTECT)
 
@@ -575,47 +768,27 @@ def check_pass(update, context):
     text = update.effective_message.text
     if text:
         if text.lower() == 'cancel':
+            store.pop(update.effective_chat.id, 'protect')
+            prefetcher.discard(update.effective_chat.id, 'protect')
             return ConversationHandler.END
         else:
             msg = "I received the password"
+            pdf_to_protect = store.pop_file(update.effective_chat.id,
+                                            'protect')
             if pdf_to_protect:
                 msg += ", please wait a moment while " \
                        "I protect the file for you..."
                 usr_msg(update=update, msg=msg, error=False)
                 # protect PDF
-                protect_pdf(update, text)
+                submit_job(update, tool_job, context.bot,
+                           pdf_to_protect, 'protect', text)
+                return ConversationHandler.END
             else:
                 msg += ", but I still need the PDF file to protect"
                 usr_msg(update=update, msg=msg, error=False)
                 protectpdf(update, context)
 
 
-def protect_pdf(update, password):
-    """
-    Answer to the user with the protected PDF file
-    or an error message.
-    :param password: (str) to protect the PDF file
-    :param update: (telegram.update.Update) the update object
-    :return: (ConversationHandler.END) after send the file or message
-    """
-    if pdf_to_protect:
-        output_dir = pdf_to_protect.split('.pdf')[0]
-        love_protect(pdf_to_protect, password, output_dir)
-        protected_file = result_file(output_dir)
-        if protected_file:
-            update.effective_message.chat.send_action(
-                ChatAction.UPLOAD_DOCUMENT)
-            update.effective_message.reply_document(
-                document=open(f"{output_dir}/{protected_file}", "rb"),
-                caption="✨ Here is your protected PDF file",
-            )
-        else:
-            usr_msg(update)
-        bye(update)
-        del_tmp()
-        return ConversationHandler.END
-
-
 def error_protect(update, context):
     msg = "That is not a PDF 😔, try again."
     usr_msg(update=update, msg=msg, error=False)
@@ -637,16 +810,15 @@ def protectpdf_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='protectpdf',
+        persistent=store.persistent,
     )
 
     return conv_handler
 
 
 # splitpdf functions
-global pdf_to_split
-pdf_to_split = None
-
-
 @run_async
 def splitpdf(update, context):
     msg = "📄 Send me the PDF file you want to split, please. "
@@ -664,13 +836,11 @@ def check_pdf_split(update, context):
     """
     doc = update.message.document
     if file_ok(update=update, usr_file=doc):
-        file_id = doc.file_id
-        file_path = f"./tmp/{file_id}"
-        os.mkdir(file_path)
-        usr_file = context.bot.getFile(file_id)
-        usr_file.download(f"{file_path}.pdf")
-        global pdf_to_split
-        pdf_to_split = f"{file_path}.pdf"
+        # the ilovepdf task is started (and the file uploaded) while
+        # the user types the range
+        store.set_file(update.effective_chat.id, 'split', doc)
+        prefetcher.stage(update.effective_chat.id, 'split', context.bot,
+                         doc)
         msg = "Send me the range you want to split the file, please ✂️. " \
               "(e.g. 2 for split 2 pages per file)"
         return ask_file(update, msg, WAIT_RANGE)
@@ -688,11 +858,17 @@ def check_range(update, context):
     if text:
         try:
             int(text)
+            pdf_to_split = store.pop_file(update.effective_chat.id, 'split')
+            if not pdf_to_split:
+                usr_msg(update)
+                return ConversationHandler.END
             msg = f"I received the range, please wait a moment while I split " \
                   f"the file {text} pages per file for you..."
             usr_msg(update=update, msg=msg, error=False)
             # split PDF
-            split_pdf(update, text)
+            submit_job(update, tool_job, context.bot, pdf_to_split,
+                       'split', text)
+            return ConversationHandler.END
         except ValueError:
             msg = "This range is not valid 😔, it must be an interger number, " \
                   "try again."
@@ -700,45 +876,6 @@ def check_range(update, context):
             return WAIT_RANGE
 
 
-def split_pdf(update, range):
-    """
-    Answer to the user with the rotated PDF file
-    or an error message.
-    :param angle: (str) to rotate the PDF file
-    :param update: (telegram.update.Update) the update object
-    :return: (ConversationHandler.END) after send the file or message
-    """
-    if pdf_to_split:
-        output_dir = pdf_to_split.split('.pdf')[0]
-        love_split(pdf_to_split, output_dir, int(range))
-        splitted_file = result_file(output_dir)
-        if splitted_file:
-            if splitted_file.endswith('.zip'):
-                pdf_files = unzip_file(zip_path=f"{output_dir}/{splitted_file}",
-                                       output_dir=f"{output_dir}-unzip")
-                for num, file_path in enumerate(pdf_files[::-1]):
-                    update.effective_message.chat.send_action(
-                        ChatAction.UPLOAD_PHOTO)
-                    update.effective_message.reply_document(
-                        document=open(file_path, "rb"),
-                        caption=f"📄 {num + 1} range of your PDF file",
-                    )
-                msg = "✨ Here are your PDF files"
-                usr_msg(update=update, msg=msg, error=False)
-            else:
-                update.effective_message.chat.send_action(
-                    ChatAction.UPLOAD_PHOTO)
-                update.effective_message.reply_document(
-                    document=open(f"{output_dir}/{splitted_file}", "rb"),
-                    caption=f"The range you sent me generated just one PDF file.",
-                )
-    else:
-        usr_msg(update)
-    bye(update)
-    del_tmp()
-    return ConversationHandler.END
-
-
 def error_split(update, context):
     msg = "That is not a PDF 😔, try again."
     usr_msg(update=update, msg=msg, error=False)
@@ -766,6 +903,9 @@ def splitpdf_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='splitpdf',
+        persistent=store.persistent,
     )
 
     return conv_handler
@@ -773,8 +913,6 @@ def splitpdf_handler():
 
 # rotatepdf functions
 
-global pdf_to_rotate, allowed_rot
-pdf_to_rotate = ''
 allowed_rot = ('90', '180')
 
 
@@ -795,13 +933,11 @@ def check_pdf_rotate(update, context):
     """
     doc = update.message.document
     if file_ok(update=update, usr_file=doc):
-        file_id = doc.file_id
-        file_path = f"./tmp/{file_id}"
-        os.mkdir(file_path)
-        usr_file = context.bot.getFile(file_id)
-        usr_file.download(f"{file_path}.pdf")
-        global pdf_to_rotate
-        pdf_to_rotate = f"{file_path}.pdf"
+        # the ilovepdf task is started (and the file uploaded) while
+        # the user types the angle
+        store.set_file(update.effective_chat.id, 'rotate', doc)
+        prefetcher.stage(update.effective_chat.id, 'rotate', context.bot,
+                         doc)
         msg = "Send me the rotation angle you want, please ↩️. " \
               f"*Allowed angles are: {' ,'.join(allowed_rot)}.*"
         return ask_file(update, msg, WAIT_ANGLE)
@@ -825,32 +961,10 @@ def check_angle(update, context):
             usr_msg(update=update, msg=msg, error=False)
             return WAIT_ANGLE
         # rotate PDF
-        rotate_pdf(update, text)
-
-
-def rotate_pdf(update, angle):
-    """
-    Answer to the user with the rotated PDF file
-    or an error message.
-    :param angle: (str) to rotate the PDF file
-    :param update: (telegram.update.Update) the update object
-    :return: (ConversationHandler.END) after send the file or message
-    """
-    if pdf_to_rotate:
-        output_dir = pdf_to_rotate.split('.pdf')[0]
-        love_rotate(pdf_to_rotate, output_dir, int(angle))
-        rotated_file = result_file(output_dir)
-        if rotated_file:
-            update.effective_message.chat.send_action(
-                ChatAction.UPLOAD_DOCUMENT)
-            update.effective_message.reply_document(
-                document=open(f"{output_dir}/{rotated_file}", "rb"),
-                caption=f"✨ Here is your {angle} rotated PDF file",
-            )
-        else:
-            usr_msg(update)
-        bye(update)
-        del_tmp()
+        pdf_to_rotate = store.pop_file(update.effective_chat.id, 'rotate')
+        if pdf_to_rotate:
+            submit_job(update, tool_job, context.bot, pdf_to_rotate,
+                       'rotate', text)
         return ConversationHandler.END
 
 
@@ -881,6 +995,9 @@ def rotatepdf_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='rotatepdf',
+        persistent=store.persistent,
     )
 
     return conv_handler
@@ -901,27 +1018,7 @@ def unlock_pdf(update, context):
     if file_ok(update=update, usr_file=doc):
         msg = "please wait a moment while I unlock it for you..."
         usr_msg(update=update, msg=msg, error=False)
-        file_id = doc.file_id
-        usr_file = context.bot.getFile(file_id)
-        file_path = f"./tmp/{file_id}"
-        usr_file.download(f"{file_path}.pdf")
-        # a file_id folder is created to know where the file is
-        os.mkdir(file_path)
-        # unlock the file
-        love_unlock(f"{file_path}.pdf", file_path)
-        # get the path of the compressed file
-        unlocked_file = result_file(file_path)
-        if unlocked_file:
-            update.effective_message.chat.send_action(
-                ChatAction.UPLOAD_DOCUMENT)
-            update.effective_message.reply_document(
-                document=open(f"{file_path}/{unlocked_file}", "rb"),
-                caption="✨ Here is your unlocked file",
-            )
-        else:
-            usr_msg(update)
-        bye(update)
-    del_tmp()
+        submit_job(update, tool_job, context.bot, doc, 'unlock')
     return ConversationHandler.END
 
 
@@ -949,16 +1046,15 @@ def unlockpdf_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='unlockpdf',
+        persistent=store.persistent,
     )
 
     return conv_handler
 
 
 # watermark functions
-global pdf_to_mark
-pdf_to_mark = None
-
-
 @run_async
 def watermarkpdf(update, context):
     msg = "📄 Send me the PDF file you want to apply a watermark, please. "
@@ -976,13 +1072,11 @@ def check_pdf_mark(update, context):
     """
     doc = update.message.document
     if file_ok(update=update, usr_file=doc):
-        file_id = doc.file_id
-        file_path = f"./tmp/{file_id}"
-        os.mkdir(file_path)
-        usr_file = context.bot.getFile(file_id)
-        usr_file.download(f"{file_path}.pdf")
-        global pdf_to_mark
-        pdf_to_mark = f"{file_path}.pdf"
+        # the ilovepdf task is started (and the file uploaded) while
+        # the user types the text
+        store.set_file(update.effective_chat.id, 'watermark', doc)
+        prefetcher.stage(update.effective_chat.id, 'watermark', context.bot,
+                         doc)
         msg = "Send me the text you want to apply in the file, please 💧. "
         return ask_file(update, msg, WAIT_TEXT_MARK)
     else:
@@ -1001,52 +1095,19 @@ def check_text_mark(update, context):
               f"'{text}' as a watermark for you..."
         usr_msg(update=update, msg=msg, error=False)
         # apply watermark PDF
-        watermark_pdf(update, text)
+        pdf_to_mark = store.pop_file(update.effective_chat.id, 'watermark')
+        if pdf_to_mark:
+            submit_job(update, tool_job, context.bot, pdf_to_mark,
+                       'watermark', text)
+        else:
+            usr_msg(update)
+        return ConversationHandler.END
     else:
         msg = f"You didn't send me a text 😔, try again."
         usr_msg(update=update, msg=msg, error=False)
         return WAIT_WATERMARK
 
 
-def watermark_pdf(update, text):
-    """
-    Answer to the user with the PDF file with a watermark
-    or an error message.
-    :param angle: (str) to rotate the PDF file
-    :param update: (telegram.update.Update) the update object
-    :return: (ConversationHandler.END) after send the file or message
-    """
-    if pdf_to_mark:
-        output_dir = pdf_to_mark.split('.pdf')[0]
-        love_watermark(pdf_to_mark, output_dir, text)
-        marked_file = result_file(output_dir)
-        if marked_file:
-            if marked_file.endswith('.zip'):
-                pdf_files = unzip_file(zip_path=f"{output_dir}/{marked_file}",
-                                       output_dir=f"{output_dir}-unzip")
-                for num, file_path in enumerate(pdf_files[::-1]):
-                    update.effective_message.chat.send_action(
-                        ChatAction.UPLOAD_PHOTO)
-                    update.effective_message.reply_document(
-                        document=open(file_path, "rb"),
-                        caption=f"📄 {num + 1} range of your PDF file",
-                    )
-                msg = "✨ Here are your PDF files"
-                usr_msg(update=update, msg=msg, error=False)
-            else:
-                update.effective_message.chat.send_action(
-                    ChatAction.UPLOAD_PHOTO)
-                update.effective_message.reply_document(
-                    document=open(f"{output_dir}/{marked_file}", "rb"),
-                    caption="✨ Here is your marked file",
-                )
-    else:
-        usr_msg(update)
-    bye(update)
-    del_tmp()
-    return ConversationHandler.END
-
-
 def error_file_watermark(update, context):
     msg = "That is not a PDF file 😔, try again."
     usr_msg(update=update, msg=msg, error=False)
@@ -1078,7 +1139,89 @@ def watermark_handler():
             CommandHandler("cancel", cancel_without_async)
         ],
         allow_reentry=True,
+        conversation_timeout=STATE_TTL,
+        name='watermark',
+        persistent=store.persistent,
     )
 
     return conv_handler
 
+
+# one-shot commands: a file sent with the command (and its parameter) in
+# its caption, e.g. '/rotatepdf 180', is answered from that single update,
+# without a conversation nor any state kept for the chat
+# tool: key of tools
+# check: of the parameter, None if the command takes none
+# usage: sent when the parameter is missing or not valid
+OneShot = namedtuple('OneShot', ['tool', 'check', 'usage'],
+                     defaults=[None, ''])
+
+one_shot = {
+    'compress': OneShot('compress'),
+    'officetopdf': OneShot('officetopdf'),
+    'addpagenumbers': OneShot('addpagenumbers'),
+    'pdfa': OneShot('pdfa'),
+    'pdftojpg': OneShot('pdftojpg'),
+    'unlockpdf': OneShot('unlock'),
+    'protectpdf': OneShot(
+        'protect', check=bool,
+        usage="Write the password after the command, "
+              "e.g. */protectpdf mypassword* 🔑"),
+    'splitpdf': OneShot(
+        'split', check=lambda arg: arg.isdigit() and int(arg) > 0,
+        usage="Write the pages per file after the command, "
+              "e.g. */splitpdf 2* ✂️"),
+    'rotatepdf': OneShot(
+        'rotate', check=lambda arg: arg in allowed_rot,
+        usage="Write the angle after the command, e.g. */rotatepdf 90* ↩️. "
+              f"*Allowed angles are: {' ,'.join(allowed_rot)}.*"),
+    'watermark': OneShot(
+        'watermark', check=bool,
+        usage="Write the text after the command, "
+              "e.g. */watermark CONFIDENTIAL* 💧"),
+}
+
+# a document whose caption starts with one of the commands
+# (optionally addressed to the bot, e.g. /splitpdf@ilovepdfbot 2)
+caption_filter = Filters.document & Filters.caption_regex(
+    rf"(?i)^/({'|'.join(one_shot)})(@\w+)?(\s|$)")
+
+
+def caption_command(update, context):
+    """
+    Run the tool of the command in the caption of a document, with the
+    parameter which follows it (e.g. '/splitpdf 2'), answering with the
+    result file(s) or an error message
+    :param update: (telegram.update.Update) the update object
+    :param context: (telegram.ext.callbackcontext.CallbackContext),
+    the context object
+    :return: None
+    """
+    message = update.effective_message
+    command, *arg = message.caption.strip().split(maxsplit=1)
+    arg = arg[0].strip() if arg else ''
+    spec = one_shot[command[1:].split('@')[0].lower()]
+    if spec.check and not spec.check(arg):
+        usr_msg(update=update, msg=spec.usage, error=False)
+        return
+    doc = message.document
+    if spec.tool == 'officetopdf':
+        obj = 'Office file'
+        file_ext = file_ok(update=update, usr_file=doc,
+                           ext=tuple(office_ext.keys()), obj=obj,
+                           send_msg=False)
+        params = (office_ext.get(file_ext),)
+    else:
+        obj = 'PDF file'
+        file_ext = file_ok(update=update, usr_file=doc, send_msg=False)
+        params = (arg,) if spec.check else ()
+    if not file_ext or is_too_large(doc):
+        status = 'too large' if is_too_large(doc) else 'invalid'
+        status_usr_msg(update=update, status=status, obj=obj)
+        return
+    # no 'please wait' message, the first answer is the result
+    submit_job(update, tool_job, context.bot, doc, spec.tool, *params)
+
+
+def caption_handler():
+    return MessageHandler(caption_filter, caption_command)
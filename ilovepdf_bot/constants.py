@@ -1,5 +1,10 @@
+import os
+
+from dotenv import load_dotenv
 from telegram.ext import Filters
 
+load_dotenv()
+
 WAIT_FILE_COMPRESS = 0
 WAIT_COMPRESS = 1
 WAIT_FILE_IMGTOPDF = 0
@@ -31,4 +36,150 @@ img_filter = Filters.photo | Filters.document
 text_filter = Filters.text & ~Filters.command
 cancel_filter = Filters.regex(r'cancel') | Filters.regex(r'Cancel')
 not_doc_filter = ~Filters.document & ~Filters.command & ~cancel_filter
-not_text_filter = ~Filters.text & ~Filters.command
\ No newline at end of file
+not_text_filter = ~Filters.text & ~Filters.command
+# job engine settings
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 100))
+# seconds, 0 for no limit
+JOB_TIMEOUT = float(os.getenv('JOB_TIMEOUT', 300))
+# jobs of a chat running at once and their bytes (0 for no limit)
+JOB_CHAT_WORKERS = int(os.getenv('JOB_CHAT_WORKERS', 2))
+JOB_CHAT_BYTES = int(os.getenv('JOB_CHAT_BYTES', 100 * 1024 * 1024))
+# jobs a chat gets per turn, 'chat_id:weight' comma separated
+# (e.g. '12345:3'), 1 for the other chats
+JOB_CHAT_WEIGHTS = {int(chat_id): int(weight) for chat_id, weight in (
+    item.split(':') for item in
+    filter(None, os.getenv('JOB_CHAT_WEIGHTS', '').split(',')))}
+
+# telegram outputs already sent, reused for repeated requests
+RESULT_INDEX_PATH = os.getenv('RESULT_INDEX_PATH', './results.db')
+RESULT_INDEX_SIZE = int(os.getenv('RESULT_INDEX_SIZE', 10000))
+
+# ilovepdf outputs cached on disk, keyed by the input bytes
+CACHE_DIR = os.getenv('CACHE_DIR', './cache')
+# bytes, 0 disables the cache
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# per-job workspaces (e.g. on tmpfs: /dev/shm/ilovepdfbot)
+WORKSPACE_DIR = os.getenv('WORKSPACE_DIR', './tmp')
+# bytes per job, 0 for no limit
+WORKSPACE_QUOTA = int(os.getenv('WORKSPACE_QUOTA', 256 * 1024 * 1024))
+
+# concurrent uploads of a multi-file ilovepdf task (e.g. imgtopdf)
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 4))
+
+# ilovepdf client shared by the workers
+ILOVEPDF_POOL_SIZE = int(os.getenv('ILOVEPDF_POOL_SIZE', 16))
+# seconds, used when the auth token does not tell its expiration
+ILOVEPDF_TOKEN_TTL = float(os.getenv('ILOVEPDF_TOKEN_TTL', 3600))
+# every ilovepdf request is sent to this server when set
+# (e.g. benchmarks/fake_ilovepdf.py)
+ILOVEPDF_URL = os.getenv('ILOVEPDF_URL', '')
+# seconds to connect to ilovepdf, and to wait for its answer (the uploads,
+# processes and downloads wait up to PROCESS_TIMEOUT, or the time left to
+# the job)
+ILOVEPDF_CONNECT_TIMEOUT = float(os.getenv('ILOVEPDF_CONNECT_TIMEOUT', 10))
+ILOVEPDF_READ_TIMEOUT = float(os.getenv('ILOVEPDF_READ_TIMEOUT', 30))
+ILOVEPDF_PROCESS_TIMEOUT = float(os.getenv('ILOVEPDF_PROCESS_TIMEOUT', 240))
+# ilovepdf tasks at once: adapted between the min and the max, cut when
+# the latency goes over LATENCY_TOLERANCE times the usual one
+ILOVEPDF_CONCURRENCY = int(os.getenv('ILOVEPDF_CONCURRENCY', 4))
+ILOVEPDF_CONCURRENCY_MIN = int(os.getenv('ILOVEPDF_CONCURRENCY_MIN', 1))
+ILOVEPDF_CONCURRENCY_MAX = int(os.getenv('ILOVEPDF_CONCURRENCY_MAX', 32))
+ILOVEPDF_LATENCY_TOLERANCE = float(
+    os.getenv('ILOVEPDF_LATENCY_TOLERANCE', 2.0))
+
+# pipe telegram downloads straight into the ilovepdf uploads
+STREAM_UPLOADS = os.getenv('STREAM_UPLOADS', 'true').lower() == 'true'
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 64 * 1024))
+# also keep a copy of the streamed files in the job workspace
+STREAM_SPILL = os.getenv('STREAM_SPILL', 'false').lower() == 'true'
+
+# tools whose jobs of different chats may share one ilovepdf task
+# (comma separated: compress, pdfa, addpagenumbers), the first job waits
+# BATCH_WINDOW seconds (or BATCH_MAX_FILES files) for the others
+BATCH_TOOLS = set(filter(None, os.getenv('BATCH_TOOLS', '').split(',')))
+BATCH_WINDOW = float(os.getenv('BATCH_WINDOW', 0.3))
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 10))
+
+# threads downloading the file of /protectpdf, /splitpdf, /rotatepdf and
+# /watermark, and uploading it to ilovepdf, while the user types the
+# parameter (0 waits for the parameter)
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', 4))
+
+# bytes of each zip member kept in memory before spooling it to disk
+ZIP_SPOOL_SIZE = int(os.getenv('ZIP_SPOOL_SIZE', 8 * 1024 * 1024))
+
+# delivery of multi-file results (pdftojpg, splitpdf, watermark):
+# 'document' one message per file, 'group' media groups,
+# 'auto' media groups or the zip itself above ZIP_THRESHOLD files
+DELIVERY_MODE = os.getenv('DELIVERY_MODE', 'auto')
+MEDIA_GROUP_SIZE = int(os.getenv('MEDIA_GROUP_SIZE', 10))
+ZIP_THRESHOLD = int(os.getenv('ZIP_THRESHOLD', 50))
+
+# outbound telegram calls: sender threads, calls per second (and burst)
+# of the bot, of a private chat and of a group
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 8))
+SEND_RATE = float(os.getenv('SEND_RATE', 30))
+SEND_BURST = float(os.getenv('SEND_BURST', 30))
+CHAT_RATE = float(os.getenv('CHAT_RATE', 1))
+CHAT_BURST = float(os.getenv('CHAT_BURST', 3))
+GROUP_RATE = float(os.getenv('GROUP_RATE', 20 / 60))
+
+# how updates are received: 'polling' or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# polling: seconds of each long poll, seconds added to its read timeout
+# and retries of the first requests (-1 for no limit)
+POLL_TIMEOUT = float(os.getenv('POLL_TIMEOUT', 10))
+POLL_READ_LATENCY = float(os.getenv('POLL_READ_LATENCY', 2.0))
+POLL_BOOTSTRAP_RETRIES = int(os.getenv('POLL_BOOTSTRAP_RETRIES', -1))
+# webhook: the public url is WEBHOOK_URL + WEBHOOK_PATH, the endpoint
+# is served over https when a certificate and its key are given
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT', '')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY', '')
+
+# local endpoint serving the metrics to Prometheus at /metrics
+# (METRICS_PORT 0 disables it)
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))
+
+# per-chat conversation state: 'memory' (one process) or 'sqlite'
+# (shared by the processes of a host, kept across restarts)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_PATH = os.getenv('STATE_PATH', './state.db')
+# seconds an abandoned conversation is kept
+STATE_TTL = int(os.getenv('STATE_TTL', 3600))
+# files (and their bytes) a chat may send to /imgtopdf
+STATE_MAX_FILES = int(os.getenv('STATE_MAX_FILES', 50))
+STATE_MAX_BYTES = int(os.getenv('STATE_MAX_BYTES', 200 * 1024 * 1024))
+
+# tools run by the local engine instead of ilovepdf (comma separated,
+# e.g. 'rotate,split,merge,unlock,protect,imgtopdf'), ilovepdf is used
+# if it fails
+LOCAL_TOOLS = set(filter(None, os.getenv('LOCAL_TOOLS', '').split(',')))
+
+# local pdftojpg ('pdftojpg' in LOCAL_TOOLS): processes rendering pages,
+# resolution and jpg quality (1 to 95) of the images
+RASTER_WORKERS = int(os.getenv('RASTER_WORKERS', os.cpu_count() or 1))
+RASTER_DPI = int(os.getenv('RASTER_DPI', 150))
+RASTER_QUALITY = int(os.getenv('RASTER_QUALITY', 85))
+
+# local officetopdf ('officetopdf' in LOCAL_TOOLS): warm LibreOffice
+# instances, conversions before an instance is restarted and seconds
+# a conversion (or an instance start) may take
+OFFICE_WORKERS = int(os.getenv('OFFICE_WORKERS', 2))
+OFFICE_MAX_JOBS = int(os.getenv('OFFICE_MAX_JOBS', 100))
+OFFICE_TIMEOUT = int(os.getenv('OFFICE_TIMEOUT', 120))
+OFFICE_START_TIMEOUT = int(os.getenv('OFFICE_START_TIMEOUT', 60))
+# each instance uses OFFICE_PORT + 2 * its number, and the next port
+OFFICE_PORT = int(os.getenv('OFFICE_PORT', 2003))
+OFFICE_COMMAND = os.getenv(
+    'OFFICE_COMMAND',
+    'unoserver --interface 127.0.0.1 --port {port} --uno-port {uno_port} '
+    '--user-installation file://{profile}')
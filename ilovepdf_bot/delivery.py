@@ -0,0 +1,193 @@
+import zipfile
+from typing import IO, Iterator, List, Sized, Tuple, Union
+
+from telegram import ChatAction, InputMediaDocument
+
+from .constants import DELIVERY_MODE, MEDIA_GROUP_SIZE, ZIP_THRESHOLD
+from .jobs import checkpoint
+from .metrics import metrics
+from .outbox import FILE, outbox
+from .results import Results
+from .utils import iter_zip, send_file, sent_size
+
+
+def zip_size(zip_path: str) -> int:
+    """
+    Return the number of files in a zip
+    :param zip_path: (str) path of zip file
+    :return: (int) files
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        return len([info for info in zip_ref.infolist() if not info.is_dir()])
+
+
+def send_group(update, media: list, action: str) -> List[str]:
+    """
+    Send up to 10 documents in one sendMediaGroup call
+    :param update: (telegram.update.Update) the update object
+    :param media: (list) of telegram.InputMediaDocument
+    :param action: (str) chat action shown while uploading
+    :return: (list) of the sent documents file_id
+    """
+    chat_id = update.effective_chat.id
+    outbox.send(chat_id, update.effective_message.chat.send_action, action,
+                priority=FILE)
+    metrics.inc('bytes_out_total', sum(sent_size(item.media)
+                                       for item in media), peer='telegram')
+    # each document counts in the Telegram limits
+    with metrics.stage('reply_upload'):
+        messages = outbox.call(chat_id,
+                               update.effective_message.reply_media_group,
+                               media=media, cost=len(media))
+    return [msg.document.file_id for msg in messages]
+
+
+def send_zip(update, zip_path: str, caption: str, zip_caption: str,
+             action: str = ChatAction.UPLOAD_DOCUMENT,
+             mode: str = DELIVERY_MODE,
+             group_size: int = MEDIA_GROUP_SIZE,
+             threshold: int = ZIP_THRESHOLD) -> Results:
+    """
+    Send the files of a zip result according to the delivery mode:
+    'document' sends one document per file, 'group' sends media groups of
+    group_size documents, 'auto' sends media groups, or the zip itself as
+    one document when it has more than threshold files
+    :param update: (telegram.update.Update) the update object
+    :param zip_path: (str) path of zip file
+    :param caption: (str) of the zip when it is sent as one document,
+    formatted with the number of files
+    :param zip_caption: (str) of each file, formatted with its number
+    :param action: (str) chat action shown while uploading
+    :param mode: (str) 'document', 'group' or 'auto'
+    :param group_size: (int) documents per media group (2 to 10)
+    :param threshold: (int) files above which 'auto' sends the zip
+    :return: (list) of (file_id, caption) of the sent documents
+    """
+    if mode == 'auto' and threshold:
+        count = zip_size(zip_path)
+        if count > threshold:
+            caption = caption.format(count)
+            msg = send_file(update, zip_path, caption)
+            return [(msg.document.file_id, caption)]
+
+    return send_files(update, iter_zip(zip_path), zip_caption, action,
+                      mode, group_size)
+
+
+def send_pages(update, pages: Sized, zip_path: str, caption: str,
+               zip_caption: str, action: str = ChatAction.UPLOAD_DOCUMENT,
+               mode: str = DELIVERY_MODE,
+               group_size: int = MEDIA_GROUP_SIZE,
+               threshold: int = ZIP_THRESHOLD) -> Results:
+    """
+    Send files made locally according to the delivery mode, as send_zip()
+    does: in 'auto' mode they are zipped into zip_path and sent as one
+    document when there are more than threshold files
+    :param update: (telegram.update.Update) the update object
+    :param pages: (iterable) of (file name, path) with a length
+    :param zip_path: (str) where the zip is written
+    :param caption: (str) of the zip when it is sent as one document,
+    formatted with the number of files
+    :param zip_caption: (str) of each file, formatted with its number
+    :param action: (str) chat action shown while uploading
+    :param mode: (str) 'document', 'group' or 'auto'
+    :param group_size: (int) documents per media group (2 to 10)
+    :param threshold: (int) files above which 'auto' sends the zip
+    :return: (list) of (file_id, caption) of the sent documents
+    """
+    if mode == 'auto' and threshold and len(pages) > threshold:
+        # the images are compressed already, they are only stored
+        with zipfile.ZipFile(zip_path, 'w') as zip_ref:
+            for name, path in pages:
+                zip_ref.write(path, name)
+        caption = caption.format(len(pages))
+        msg = send_file(update, zip_path, caption)
+        return [(msg.document.file_id, caption)]
+
+    return send_files(update, iter(pages), zip_caption, action, mode,
+                      group_size)
+
+
+def send_files(update, files: Iterator[Tuple[str, Union[str, IO]]],
+               zip_caption: str, action: str = ChatAction.UPLOAD_DOCUMENT,
+               mode: str = DELIVERY_MODE,
+               group_size: int = MEDIA_GROUP_SIZE) -> Results:
+    """
+    Send files one by one ('document' mode) or in media groups of
+    group_size documents, each one as soon as it is yielded by files
+    (or its group is full)
+    :param update: (telegram.update.Update) the update object
+    :param files: (iterator) of (file name, path or file object)
+    :param zip_caption: (str) of each file, formatted with its number
+    :param action: (str) chat action shown while uploading
+    :param mode: (str) 'document', 'group' or 'auto'
+    :param group_size: (int) documents per media group (2 to 10)
+    :return: (list) of (file_id, caption) of the sent documents
+    """
+    results = []
+    group_size = min(max(group_size, 2), 10)
+    media = []
+    captions = []
+    for num, (name, member) in enumerate(files):
+        checkpoint()
+        file_caption = zip_caption.format(num + 1)
+        if mode == 'document':
+            msg = send_file(update, member, file_caption, action=action,
+                            filename=name)
+            results.append((msg.document.file_id, file_caption))
+            continue
+        # the file is read here, so it can be closed before it is sent
+        if isinstance(member, str):
+            with open(member, 'rb') as f:
+                media.append(InputMediaDocument(f, caption=file_caption,
+                                                filename=name))
+        else:
+            media.append(InputMediaDocument(member, caption=file_caption,
+                                            filename=name))
+        captions.append(file_caption)
+        if len(media) == group_size:
+            results.extend(zip(send_group(update, media, action), captions))
+            media, captions = [], []
+    if len(media) == 1:
+        # a media group needs two documents at least
+        metrics.inc('bytes_out_total', sent_size(media[0].media),
+                    peer='telegram')
+        with metrics.stage('reply_upload'):
+            msg = outbox.call(update.effective_chat.id,
+                              update.effective_message.reply_document,
+                              document=media[0].media, caption=captions[0])
+        results.append((msg.document.file_id, captions[0]))
+    elif media:
+        results.extend(zip(send_group(update, media, action), captions))
+    return results
+
+
+def resend(update, results: Results, mode: str = DELIVERY_MODE,
+           group_size: int = MEDIA_GROUP_SIZE) -> None:
+    """
+    Send again documents already uploaded to Telegram, by their file_id
+    :param update: (telegram.update.Update) the update object
+    :param results: (list) of (file_id, caption)
+    :param mode: (str) 'document', 'group' or 'auto'
+    :param group_size: (int) documents per media group (2 to 10)
+    :return: None
+    """
+    group_size = min(max(group_size, 2), 10)
+    chat_id = update.effective_chat.id
+    message = update.effective_message
+    if mode == 'document' or len(results) == 1:
+        for file_id, caption in results:
+            outbox.send(chat_id, message.reply_document, document=file_id,
+                        caption=caption, priority=FILE)
+        return
+    for start in range(0, len(results), group_size):
+        batch = results[start:start + group_size]
+        if len(batch) == 1:
+            file_id, caption = batch[0]
+            outbox.send(chat_id, message.reply_document, document=file_id,
+                        caption=caption, priority=FILE)
+        else:
+            outbox.send(chat_id, message.reply_media_group, media=[
+                InputMediaDocument(file_id, caption=caption)
+                for file_id, caption in batch],
+                priority=FILE, cost=len(batch))
@@ -1,8 +1,14 @@
+import functools
+import logging
 import os
-from typing import List
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 from dotenv import load_dotenv
-from pylovepdf.ilovepdf import ILovePdf
+from pylovepdf.tools.compress import Compress
 from pylovepdf.tools.imagetopdf import ImageToPdf
 from pylovepdf.tools.merge import Merge
 from pylovepdf.tools.officepdf import OfficeToPdf
@@ -15,19 +21,333 @@ from pylovepdf.tools.split import Split
 from pylovepdf.tools.unlock import Unlock
 from pylovepdf.tools.watermark import Watermark
 
+from . import streaming
+from .batch import batcher
+from .cache import cache, file_digest
+from .client import LoveClient
+from .constants import BATCH_TOOLS, LOCAL_TOOLS, UPLOAD_WORKERS
+from .jobs import JobTimeout, checkpoint
+from .limiter import limiter
+from .local import (local_imgtopdf, local_merge, local_protect, local_rotate,
+                    local_split, local_unlock)
+from .metrics import metrics
+from .office import office_pool
+from .workspace import workspaces
+
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 public_key = os.getenv('PUBLIC_KEY')
-ilovepdf = ILovePdf(public_key, verify_ssl=True)
+# shared by every task: one auth token and keep-alive connections
+client = LoveClient(public_key, verify_ssl=True)
 
 
-def love_execute_task(task, file_path: str) -> None:
+def love_execute_task(task, file_path: str, uploaded: bool = False) -> None:
     """
-    Execute common lines of ilovepdf tasks
+    Execute common lines of ilovepdf tasks,
+    the running job timeout is checked between stages
+    :param uploaded: (bool) the files were already uploaded
     """
     task.set_output_folder(file_path)
-    task.execute()
-    task.download()
-    task.delete_current_task()
+    try:
+        if not uploaded:
+            checkpoint()
+            # execute() would upload them, timed apart
+            with metrics.stage('ilovepdf_upload'):
+                task.upload()
+        task.upload = lambda: None
+        checkpoint()
+        with metrics.stage('ilovepdf_process'):
+            task.execute()
+        checkpoint()
+        with metrics.stage('ilovepdf_download'):
+            task.download()
+    finally:
+        with metrics.stage('ilovepdf_delete'):
+            task.delete_current_task()
+
+
+Files = List[str]
+
+
+def love_upload(task, workers: int = UPLOAD_WORKERS) -> None:
+    """
+    Upload the files of a task concurrently, it replaces task.upload()
+    (the files order, and so the pages order, is kept by task.process())
+    :param task: (pylovepdf.task.Task) with the files added
+    :param workers: (int) max concurrent uploads
+    :return: None
+    """
+    def upload(file):
+        with open(file.filename, 'rb') as f:
+            response = task._send_request('post', 'upload',
+                                          payload={'task': task.task},
+                                          headers=task.headers,
+                                          files={'file': f},
+                                          proxies=task.proxies)
+        file.server_filename = response.server_filename
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # list() to raise the upload errors
+        list(pool.map(upload, task.files))
+
+
+def love_stream_upload(task, sources) -> List[str]:
+    """
+    Upload the files of a task, streaming the ones with a Telegram source
+    :param task: (pylovepdf.task.Task) with the files added
+    :param sources: (list) of TelegramSource or None, one per task file
+    :return: (list) of the files sha256 hex digest
+    """
+    digests = []
+    for file, source in zip(task.files, sources):
+        checkpoint()
+        if source:
+            digests.append(streaming.stream_upload(task, file, source))
+        else:
+            with open(file.filename, 'rb') as f:
+                response = task._send_request('post', 'upload',
+                                              payload={'task': task.task},
+                                              headers=task.headers,
+                                              files={'file': f})
+            file.server_filename = response.server_filename
+            digests.append(file_digest(file.filename))
+    return digests
+
+
+# started tasks with their file uploaded, by file path
+_staged = {}
+_staged_lock = threading.Lock()
+
+
+def love_stage(tool, file_name: str) -> None:
+    """
+    Start a task of tool and upload file_name to it ahead of its options
+    (e.g. while the user types a password), love_task() on the same file
+    path only processes and downloads it then
+    :param tool: (pylovepdf.task.Task) subclass, e.g. Protect
+    :param file_name: (str) path of the input file
+    :return: None
+    """
+    digest = file_digest(file_name) if cache.enabled else ''
+    # the upload is limited as the other tasks, not the wait for the options
+    with limiter.slot():
+        with metrics.stage('ilovepdf_start'):
+            task = client.task(tool)
+        task.debug = False
+        task.add_file(file_name)
+        try:
+            with metrics.stage('ilovepdf_upload'):
+                love_upload(task)
+        except Exception:
+            task.delete_current_task()
+            raise
+    with _staged_lock:
+        old = _staged.pop(file_name, None)
+        _staged[file_name] = (task, digest)
+    if old:
+        old[0].delete_current_task()
+
+
+def take_staged(tool, file_name: str) -> Optional[Tuple[object, str]]:
+    """
+    Return the task staged for file_name by love_stage(), and forget it
+    :param tool: (pylovepdf.task.Task) subclass the task must be of
+    :param file_name: (str) path of the input file
+    :return: (tuple) of the task and the file sha256 hex digest ('' if
+    the cache is disabled), or None
+    """
+    with _staged_lock:
+        staged = _staged.pop(file_name, None)
+    if staged and not isinstance(staged[0], tool):
+        staged[0].delete_current_task()
+        return None
+    return staged
+
+
+def forget_staged(file_name: str) -> None:
+    """
+    Delete the task staged for file_name if love_task() did not take it
+    (e.g. the job was cancelled or the tool ran locally)
+    :param file_name: (str) path of the input file
+    :return: None
+    """
+    with _staged_lock:
+        staged = _staged.pop(file_name, None)
+    if staged:
+        try:
+            staged[0].delete_current_task()
+        except Exception as exc:
+            logger.warning("could not delete a staged task: %s", exc)
+
+
+def love_batch(tool, members: list, **options) -> List[bool]:
+    """
+    Run one task of tool with the files of several jobs and save the
+    output of each file in the output dir of its job
+    (called by batch.MicroBatcher)
+    :param tool: (pylovepdf.task.Task) subclass, e.g. Compress
+    :param members: (list) of (file path, output dir) of each job
+    :param options: attributes of the task
+    :return: (list) of bool, True for the files whose output was saved
+    """
+    with limiter.slot():
+        with metrics.stage('ilovepdf_start'):
+            task = client.task(tool)
+        task.debug = False
+        for file_name, _ in members:
+            task.add_file(file_name)
+        for attr, value in options.items():
+            setattr(task, attr, value)
+        # the outputs are named after the file number, to give them back
+        task.output_filename = '{filename}'
+
+        def upload():
+            love_upload(task)
+            for num, file in enumerate(task.files):
+                file.filename = f"{num}.pdf"
+
+        task.upload = upload
+        with workspaces.create() as ws:
+            love_execute_task(task, ws.path)
+            return split_batch(ws.path, members)
+
+
+def split_batch(folder: str, members: list) -> List[bool]:
+    """
+    Copy the outputs of a batch task, a zip in folder with one file per
+    job, to the output dir of each job
+    :param folder: (str) where the task output was downloaded
+    :param members: (list) of (file path, output dir) of each job
+    :return: (list) of bool, True for the files whose output was saved
+    """
+    outputs = os.listdir(folder)
+    if len(outputs) != 1 or not outputs[0].endswith('.zip'):
+        return [False] * len(members)
+    with zipfile.ZipFile(os.path.join(folder, outputs[0])) as zip_ref:
+        names = [info.filename for info in zip_ref.infolist()
+                 if not info.is_dir()]
+        by_num = {os.path.splitext(os.path.basename(name))[0]: name
+                  for name in names}
+        if any(str(num) not in by_num for num in range(len(members))) \
+                and len(names) == len(members):
+            # named otherwise, they are in the order of the files
+            by_num = {str(num): name for num, name in enumerate(names)}
+        done = []
+        for num, (file_name, output_dir) in enumerate(members):
+            name = by_num.get(str(num))
+            if name is None:
+                done.append(False)
+                continue
+            output = os.path.join(output_dir, os.path.basename(file_name))
+            try:
+                with zip_ref.open(name) as src, open(output, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                done.append(True)
+            except OSError:
+                # e.g. the job gave up and its workspace was removed
+                done.append(False)
+    return done
+
+
+def love_task(tool, files: Files, output_dir: str,
+              file_options: Optional[dict] = None, batch: bool = False,
+              **options) -> None:
+    """
+    Run an ilovepdf tool and save the result in output_dir folder,
+    the output is taken from the cache if the same input bytes were
+    already processed with the same tool and options.
+    Files deferred with streaming.defer() are streamed from Telegram
+    to ilovepdf, then the cache is checked before processing them.
+    A file staged with love_stage() is only processed and downloaded.
+    With batch, the file may be processed in one task with the files of
+    other jobs running the same tool (see batch.MicroBatcher).
+    :param tool: (pylovepdf.task.Task) subclass, e.g. Compress
+    :param files: (list) of the input file paths
+    :param output_dir: (str) path of output dir
+    :param file_options: (dict) attributes of the last added file,
+    e.g. {'rotate': 90}
+    :param batch: (bool) allow batching a single file without file options
+    :param options: attributes of the task, e.g. pagesize='fit'
+    """
+    file_options = file_options or {}
+    params = dict(options, **file_options)
+    staged = take_staged(tool, files[0]) if len(files) == 1 else None
+    batch = batch and len(files) == 1 and not staged and not file_options
+    if batch:
+        # the batch task uploads it from disk
+        streaming.local(files[0])
+    sources = [None] if staged else \
+        [streaming.take(file_name) for file_name in files]
+    key = ''
+    if cache.enabled and not any(sources):
+        digests = [staged[1]] if staged else \
+            [file_digest(file_name) for file_name in files]
+        key = cache.key(digests, tool.__name__, params)
+        if cache.get(key, output_dir):
+            if staged:
+                staged[0].delete_current_task()
+            return
+    if batch and batcher.run((tool.__name__, tuple(sorted(options.items()))),
+                             (files[0], output_dir),
+                             functools.partial(love_batch, tool, **options)):
+        if key:
+            cache.put(key, output_dir)
+        return
+    # the ilovepdf tasks at once are limited, from start to delete
+    with limiter.slot():
+        if staged:
+            # file already uploaded
+            task = staged[0]
+        else:
+            with metrics.stage('ilovepdf_start'):
+                task = client.task(tool)
+            task.debug = False
+            for file_name in files:
+                task.add_file(file_name)
+        for attr, value in options.items():
+            setattr(task, attr, value)
+        for attr, value in file_options.items():
+            setattr(task.file, attr, value)
+        if any(sources):
+            with metrics.stage('ilovepdf_upload'):
+                digests = love_stream_upload(task, sources)
+            if cache.enabled:
+                key = cache.key(digests, tool.__name__, params)
+                if cache.get(key, output_dir):
+                    task.delete_current_task()
+                    return
+        elif len(files) > 1:
+            task.upload = lambda: love_upload(task)
+        love_execute_task(task, output_dir,
+                          uploaded=bool(staged) or any(sources))
+    if key:
+        cache.put(key, output_dir)
+
+
+def local_first(tool: str, local_func):
+    """
+    Decorator running local_func, with the same arguments, instead of the
+    ilovepdf function when tool is in LOCAL_TOOLS, the ilovepdf function
+    is still used if the local one fails
+    :param tool: (str) e.g. 'rotate'
+    :param local_func: (callable) local engine function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if tool in LOCAL_TOOLS:
+                try:
+                    with metrics.stage('local'):
+                        return local_func(*args, **kwargs)
+                except JobTimeout:
+                    raise
+                except Exception as exc:
+                    logger.warning("local %s failed (%s), using ilovepdf",
+                                   tool, exc)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 def love_compress(file_path: str) -> None:
@@ -36,46 +356,36 @@ def love_compress(file_path: str) -> None:
     :param file_path: (str) without extension
     (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
     """
-    task = ilovepdf.new_task('compress')
-    task.add_file(f"{file_path}.pdf")
     # file_path folder should exist
-    love_execute_task(task, file_path)
+    love_task(Compress, [f"{file_path}.pdf"], file_path,
+              batch='compress' in BATCH_TOOLS)
 
 
-def love_imgtopdf(file_path: str) -> None:
+@local_first('imgtopdf', local_imgtopdf)
+def love_imgtopdf(files: Files, output_dir: str) -> None:
     """
-    Convert an image to a PDF file and save the result in file_id folder
-    :param file_path: (str) without extension
-    (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
+    Convert one or more images to a single PDF file (one page per image,
+    in the files order) and save the result in output_dir folder,
+    every image is added to the same task and uploaded concurrently
+    :param files: (list) of each image file paths
+    :param output_dir: (str) path of output dir
     """
-    task = ImageToPdf(public_key, verify_ssl=True, proxies='')
-    task.add_file(f"{file_path}.png")
-    task.debug = False
-    task.orientation = 'portrait'
-    task.margin = 0
-    task.pagesize = 'fit'
-    # file_id folder should exist
-    love_execute_task(task, file_path)
-
-
-Files = List[str]
+    love_task(ImageToPdf, files, output_dir, orientation='portrait',
+              margin=0, pagesize='fit', merge_after=True)
 
 
+@local_first('merge', local_merge)
 def love_merge(files: Files, output_dir: str) -> None:
     """
     Merge two or more PDF files and save the result in output_dir folder
     :param files: (list) of each PDF file paths.
     :param output_dir: (str) path of output dir (it should exist)
     """
-    task = Merge(public_key, verify_ssl=True, proxies='')
     # two or more files needed
-    for file_name in files:
-        task.add_file(file_name)
-    task.debug = False
-    # output_dir folder should exist
-    love_execute_task(task, output_dir)
+    love_task(Merge, files, output_dir)
 
 
+@local_first('officetopdf', office_pool.convert)
 def love_officetopdf(file_path: str, output_dir: str) -> None:
     """
     Convert one or more Office files and save the result in output_dir folder
@@ -83,10 +393,7 @@ def love_officetopdf(file_path: str, output_dir: str) -> None:
     :param file_path: (str)
     :param output_dir: (str) to save the converted file
     """
-    task = OfficeToPdf(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(file_path)
-    love_execute_task(task, output_dir)
+    love_task(OfficeToPdf, [file_path], output_dir)
 
 
 def love_addpagenumbers(file_path: str) -> None:
@@ -95,10 +402,8 @@ def love_addpagenumbers(file_path: str) -> None:
     :param file_path: (str) without extension
     (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
     """
-    task = Pagenumber(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(f"{file_path}.pdf")
-    love_execute_task(task, file_path)
+    love_task(Pagenumber, [f"{file_path}.pdf"], file_path,
+              batch='addpagenumbers' in BATCH_TOOLS)
 
 
 def love_pdfa(file_path: str) -> None:
@@ -108,26 +413,22 @@ def love_pdfa(file_path: str) -> None:
     :param file_path: (str) without extension
     (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
     """
-    task = ToPdfA(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(f"{file_path}.pdf")
-    love_execute_task(task, file_path)
+    love_task(ToPdfA, [f"{file_path}.pdf"], file_path,
+              batch='pdfa' in BATCH_TOOLS)
 
 
 def love_pdftojpg(file_path: str) -> None:
     """
-    Convert a PDF file to PDF/A (the ISO-standardized version)
+    Convert each page of a PDF file to a jpg image
     and save the result in file_path folder
     :param file_path: (str) without extension
     (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
     """
-    task = PdfToJpg(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(f"{file_path}.pdf")
-    task.pdfjpg_mode = 'pages'
-    love_execute_task(task, file_path)
+    love_task(PdfToJpg, [f"{file_path}.pdf"], file_path,
+              pdfjpg_mode='pages')
 
 
+@local_first('protect', local_protect)
 def love_protect(file_path: str, password: str, output_dir: str) -> None:
     """
     Protect a PDF file with a password
@@ -136,14 +437,12 @@ def love_protect(file_path: str, password: str, output_dir: str) -> None:
     :param password: (str) to protect the PDF file
     :param file_path: (str) of the PDF to protect
     """
-    task = Protect(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(file_path)
-    task.file_encryption_key = 'ilovepdfbot'
-    task.file.password = password
-    love_execute_task(task, output_dir)
+    love_task(Protect, [file_path], output_dir,
+              file_options={'password': password},
+              file_encryption_key='ilovepdfbot')
 
 
+@local_first('rotate', local_rotate)
 def love_rotate(file_path: str, output_dir: str, rot: int = 90) -> None:
     """
     Rotate a PDF file and save the result in output_dir folder
@@ -152,40 +451,31 @@ def love_rotate(file_path: str, output_dir: str, rot: int = 90) -> None:
     :param output_dir: (str) to save the protected PDF file
     (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
     """
-    task = Rotate(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(file_path)
-    task.file.rotate = rot
-    love_execute_task(task, output_dir)
+    love_task(Rotate, [file_path], output_dir, file_options={'rotate': rot})
 
 
+@local_first('split', local_split)
 def love_split(file_path: str, output_dir: str, range=1):
     """
-    Rotate a PDF file and save the result in output_dir folder
+    Split a PDF file and save the result in output_dir folder
     :param range: (int) of split the PDF file
     :param file_path: (str) without extension
     :param output_dir: (str) to save the protected PDF file
     (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
     """
-    task = Split(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(file_path)
-    task.split_mode = 'fixed_range'
-    task.fixed_range = range
-    love_execute_task(task, output_dir)
+    love_task(Split, [file_path], output_dir,
+              split_mode='fixed_range', fixed_range=range)
 
 
+@local_first('unlock', local_unlock)
 def love_unlock(file_path: str, output_dir: str) -> None:
     """
-    Rotate a PDF file and save the result in output_dir folder
+    Unlock a PDF file and save the result in output_dir folder
     :param file_path: (str) without extension
     :param output_dir: (str) to save the protected PDF file
     (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
     """
-    task = Unlock(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(file_path)
-    love_execute_task(task, output_dir)
+    love_task(Unlock, [file_path], output_dir)
 
 
 def love_watermark(file_path: str, output_dir: str, text: str) -> None:
@@ -196,12 +486,5 @@ def love_watermark(file_path: str, output_dir: str, text: str) -> None:
     :param output_dir: (str) to save the protected PDF file
     (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
     """
-    task = Watermark(public_key, verify_ssl=True, proxies='')
-    task.debug = False
-    task.add_file(file_path)
-    task.mode = 'text'
-    task.text = text
-    task.rotation = 30
-    task.fontsize = 150
-    task.transparency = 40
-    love_execute_task(task, output_dir)
+    love_task(Watermark, [file_path], output_dir, mode='text', text=text,
+              rotation=30, fontsize=150, transparency=40)
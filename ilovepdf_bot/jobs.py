@@ -0,0 +1,263 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import Callable, Optional
+
+from .constants import (JOB_CHAT_BYTES, JOB_CHAT_WEIGHTS, JOB_CHAT_WORKERS,
+                        JOB_QUEUE_SIZE, JOB_TIMEOUT, JOB_WORKERS)
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class JobTimeout(Exception):
+    """
+    Raised by checkpoint() when the running job went over its timeout
+    """
+
+
+class Job:
+    """
+    A unit of work queued in the JobEngine
+    :param func: (callable) to run in a worker thread
+    :param args: (tuple) positional arguments of func
+    :param kwargs: (dict) keyword arguments of func
+    :param timeout: (float) seconds the job may run, None or 0 for no limit
+    :param on_error: (callable) called with the exception if func fails
+    :param chat_id: (int) of the chat the job works for
+    :param size: (int) bytes of the files of the job
+    """
+
+    def __init__(self, func: Callable, args: tuple, kwargs: dict,
+                 timeout: Optional[float] = None,
+                 on_error: Optional[Callable] = None,
+                 chat_id: Optional[int] = None, size: int = 0):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.on_error = on_error
+        self.chat_id = chat_id
+        self.size = size
+        self.deadline = None
+        self.queued = time.monotonic()
+
+    def expired(self) -> bool:
+        """
+        Return True if the job is running past its deadline
+        """
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def run(self) -> None:
+        metrics.observe('queue_wait_seconds', time.monotonic() - self.queued)
+        if self.timeout:
+            self.deadline = time.monotonic() + self.timeout
+        _local.job = self
+        try:
+            self.func(*self.args, **self.kwargs)
+        except Exception as exc:
+            logger.exception("job %s failed", getattr(self.func, '__name__', self.func))
+            metrics.inc('errors_total', source='job', type=type(exc).__name__)
+            if self.on_error:
+                try:
+                    self.on_error(exc)
+                except Exception:
+                    logger.exception("error callback failed")
+        finally:
+            _local.job = None
+
+
+def remaining() -> Optional[float]:
+    """
+    Return the seconds left to the job running in this thread
+    :return: (float) seconds, None if it has no deadline
+    """
+    job = getattr(_local, 'job', None)
+    if job is None or job.deadline is None:
+        return None
+    return job.deadline - time.monotonic()
+
+
+def checkpoint() -> None:
+    """
+    Raise JobTimeout if the job running in this thread is past its deadline,
+    stages call it between the slow steps (download, ilovepdf, upload)
+    :return: None
+    """
+    job = getattr(_local, 'job', None)
+    if job and job.expired():
+        raise JobTimeout(f"job took more than {job.timeout} seconds")
+
+
+class JobEngine:
+    """
+    Bounded pool of worker threads running jobs from a bounded queue,
+    so conversation handlers only validate input and submit the job.
+    Jobs are queued per chat and the chats are served in turn (weighted
+    round robin: a chat of weight w gets up to w jobs per turn), and
+    a chat may not run more than chat_workers jobs, nor jobs of more
+    than chat_bytes bytes, at once, so one heavy user can not take every
+    worker
+    :param workers: (int) number of worker threads
+    :param queue_size: (int) max jobs waiting for a worker
+    :param timeout: (float) default seconds a job may run
+    :param chat_workers: (int) jobs of a chat running at once, 0 no limit
+    :param chat_bytes: (int) bytes of the jobs of a chat running at once,
+    0 for no limit (a larger job runs when the chat has none running)
+    :param weights: (dict) chat_id: weight, 1 for the other chats
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS,
+                 queue_size: int = JOB_QUEUE_SIZE,
+                 timeout: float = JOB_TIMEOUT,
+                 chat_workers: int = JOB_CHAT_WORKERS,
+                 chat_bytes: int = JOB_CHAT_BYTES,
+                 weights: Optional[dict] = None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.chat_workers = chat_workers
+        self.chat_bytes = chat_bytes
+        self.weights = JOB_CHAT_WEIGHTS if weights is None else weights
+        self.threads = []
+        self.active = 0
+        # chat_id: deque of its waiting jobs, in the order they are served
+        self._queues = OrderedDict()
+        self._turns = {}
+        self._running = defaultdict(int)
+        self._bytes = defaultdict(int)
+        self._queued = 0
+        self._stopped = False
+        self._changed = threading.Condition()
+
+    def start(self) -> None:
+        """
+        Start the worker threads (it does nothing if already started)
+        :return: None
+        """
+        if self.threads:
+            return
+        self._stopped = False
+        for num in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name=f"job-worker-{num}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, wait: bool = True) -> None:
+        """
+        Let the workers finish the queued jobs and stop them
+        :param wait: (bool) if True, wait until every worker stopped
+        :return: None
+        """
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.threads = []
+
+    def submit(self, func: Callable, *args, timeout: Optional[float] = None,
+               on_error: Optional[Callable] = None, chat_id: int = None,
+               size: int = 0, **kwargs) -> bool:
+        """
+        Queue func(*args, **kwargs) to run in a worker thread
+        :param func: (callable) the job
+        :param timeout: (float) seconds the job may run, engine default if None
+        :param on_error: (callable) called with the exception if the job fails
+        :param chat_id: (int) of the chat the job works for
+        :param size: (int) bytes of the files of the job
+        :return: (bool) True if the job was queued, False if the queue is full
+        """
+        if timeout is None:
+            timeout = self.timeout
+        job = Job(func, args, kwargs, timeout=timeout, on_error=on_error,
+                  chat_id=chat_id, size=size)
+        with self._changed:
+            if self._queued >= self.queue_size:
+                logger.warning("job queue is full, %s rejected", func.__name__)
+                return False
+            self._queues.setdefault(chat_id, deque()).append(job)
+            self._queued += 1
+            self._changed.notify()
+        return True
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of jobs waiting for a worker
+        """
+        return self._queued
+
+    def _allowed(self, chat_id, job: Job) -> bool:
+        """
+        Return True if the chat may run job now
+        """
+        running = self._running[chat_id]
+        if self.chat_workers and running >= self.chat_workers:
+            return False
+        return not (self.chat_bytes and running and
+                    self._bytes[chat_id] + job.size > self.chat_bytes)
+
+    def _take(self) -> Optional[Job]:
+        """
+        Wait for the next job to run: the one of the first chat in turn
+        allowed to run it, None once stopped and every job was taken
+        """
+        with self._changed:
+            while True:
+                for chat_id, jobs in self._queues.items():
+                    if self._allowed(chat_id, jobs[0]):
+                        break
+                else:
+                    if self._stopped and not self._queued:
+                        return None
+                    self._changed.wait()
+                    continue
+                job = jobs.popleft()
+                self._queued -= 1
+                turns = self._turns.get(chat_id,
+                                        self.weights.get(chat_id, 1)) - 1
+                if not jobs:
+                    del self._queues[chat_id]
+                    self._turns.pop(chat_id, None)
+                elif turns <= 0:
+                    # its turn is over, the next chats go first
+                    self._queues.move_to_end(chat_id)
+                    self._turns.pop(chat_id, None)
+                else:
+                    self._turns[chat_id] = turns
+                self._running[chat_id] += 1
+                self._bytes[chat_id] += job.size
+                self.active += 1
+                return job
+
+    def _done(self, job: Job) -> None:
+        with self._changed:
+            self.active -= 1
+            chat_id = job.chat_id
+            self._running[chat_id] -= 1
+            self._bytes[chat_id] -= job.size
+            if not self._running[chat_id]:
+                del self._running[chat_id]
+                del self._bytes[chat_id]
+            self._changed.notify_all()
+
+    def _work(self) -> None:
+        while True:
+            job = self._take()
+            if job is None:
+                break
+            try:
+                job.run()
+            finally:
+                self._done(job)
+
+
+engine = JobEngine()
+metrics.gauge('jobs_queued', lambda: engine.depth)
+metrics.gauge('jobs_active', lambda: engine.active)
@@ -0,0 +1,155 @@
+import contextlib
+import logging
+import threading
+import time
+from typing import Hashable
+
+from .constants import (ILOVEPDF_CONCURRENCY, ILOVEPDF_CONCURRENCY_MAX,
+                        ILOVEPDF_CONCURRENCY_MIN, ILOVEPDF_LATENCY_TOLERANCE)
+from .jobs import checkpoint
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# limit factor when the latency rises and when ilovepdf is overloaded
+LATENCY_BACKOFF = 0.9
+OVERLOAD_BACKOFF = 0.5
+# weight of a new latency sample in the recent latency, and in the
+# baseline one when it is higher (a lower sample is the new baseline)
+RECENT_SMOOTHING = 0.2
+BASELINE_SMOOTHING = 0.002
+# seconds over the baseline always tolerated (jitter of fast requests)
+LATENCY_SLACK = 0.05
+
+
+class AdaptiveLimiter:
+    """
+    Limit of the ilovepdf tasks running at once, adapted as TCP does
+    (AIMD): it grows by one task per limit of requests answered while the
+    limit is in use and the latency is stable, and it is cut when the
+    recent latency goes over tolerance times the baseline (the lowest
+    latency, which follows a lasting slowdown slowly), or when
+    ilovepdf answers 429 or 5xx (once per latency, as the requests on the
+    way were sent with the old load)
+    :param initial: (int) tasks at once to start with
+    :param minimum: (int) tasks at once, whatever the latency
+    :param maximum: (int) tasks at once
+    :param tolerance: (float) recent / baseline latency cutting the limit
+    """
+
+    def __init__(self, initial: int = ILOVEPDF_CONCURRENCY,
+                 minimum: int = ILOVEPDF_CONCURRENCY_MIN,
+                 maximum: int = ILOVEPDF_CONCURRENCY_MAX,
+                 tolerance: float = ILOVEPDF_LATENCY_TOLERANCE):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.tolerance = tolerance
+        self.inflight = 0
+        self.waiting = 0
+        # of the last observed kind of request
+        self.latency = 0.0
+        self.baseline = 0.0
+        # kind of request -> (recent, baseline) latency
+        self._latencies = {}
+        self._decreased = 0.0
+        self._changed = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Context manager holding a task slot while it runs
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self) -> None:
+        """
+        Wait for a free task slot, giving up if the job running in this
+        thread times out
+        :return: None
+        """
+        with self._changed:
+            self.waiting += 1
+            try:
+                while self.inflight >= int(self.limit):
+                    checkpoint()
+                    self._changed.wait(1)
+            finally:
+                self.waiting -= 1
+            self.inflight += 1
+
+    def release(self) -> None:
+        with self._changed:
+            self.inflight -= 1
+            self._changed.notify()
+
+    def observe(self, latency: float, kind: Hashable = None) -> None:
+        """
+        Adapt the limit to the latency of an ilovepdf request, compared
+        with the earlier requests of the same kind only (the tools and
+        file sizes take very different times)
+        :param latency: (float) seconds the request took
+        :param kind: of the request, e.g. its tool and file size class
+        :return: None
+        """
+        with self._changed:
+            recent, baseline = self._latencies.get(kind, (0.0, 0.0))
+            if not baseline:
+                recent = baseline = latency
+            else:
+                recent += RECENT_SMOOTHING * (latency - recent)
+                # it follows a lasting slowdown, slowly
+                baseline = min(latency, baseline +
+                               BASELINE_SMOOTHING * (latency - baseline))
+            self._latencies[kind] = (recent, baseline)
+            self.latency, self.baseline = recent, baseline
+            if recent > max(self.tolerance * baseline,
+                            baseline + LATENCY_SLACK):
+                self._decrease(LATENCY_BACKOFF, 'latency rising')
+            elif self.inflight >= int(self.limit) and \
+                    self.limit < self.maximum:
+                # only grown when it is what holds the tasks back
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._changed.notify_all()
+
+    def overloaded(self) -> None:
+        """
+        Cut the limit, ilovepdf answered 429 or 5xx (or did not answer)
+        :return: None
+        """
+        with self._changed:
+            self._decrease(OVERLOAD_BACKOFF, 'ilovepdf overloaded')
+
+    def _decrease(self, factor: float, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._decreased < self.latency:
+            return
+        self._decreased = now
+        limit = max(self.minimum, self.limit * factor)
+        if int(limit) < int(self.limit):
+            logger.info("ilovepdf concurrency limit %s -> %s (%s)",
+                        int(self.limit), int(limit), reason)
+        self.limit = limit
+
+    def stats(self) -> dict:
+        """
+        Return the limiter metrics
+        :return: (dict) with the limit, the running and waiting tasks and
+        the recent and baseline latency (seconds) of the last observed
+        kind of request
+        """
+        with self._changed:
+            return {'limit': int(self.limit), 'inflight': self.inflight,
+                    'waiting': self.waiting,
+                    'latency': round(self.latency, 3),
+                    'baseline': round(self.baseline, 3)}
+
+
+limiter = AdaptiveLimiter()
+metrics.gauge('ilovepdf_tasks_limit', lambda: int(limiter.limit))
+metrics.gauge('ilovepdf_tasks_running', lambda: limiter.inflight)
+metrics.gauge('ilovepdf_tasks_waiting', lambda: limiter.waiting)
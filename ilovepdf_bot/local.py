@@ -0,0 +1,362 @@
+import builtins
+import io
+import os
+import struct
+import zipfile
+import zlib
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from . import streaming
+from .jobs import checkpoint
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    # the local engine is optional, every tool falls back to ilovepdf
+    PdfReader = PdfWriter = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # only jpg images are converted without it
+    Image = ImageOps = None
+
+CHUNK_SIZE = 1024 * 1024
+# jpg markers starting a frame, with its size and components
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+               0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+COLOR_SPACES = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}
+
+
+class LocalError(Exception):
+    """
+    Raised when the local engine can not run a tool,
+    so the ilovepdf one is used instead
+    """
+
+
+def _reader(file_path: str):
+    if PdfReader is None:
+        raise LocalError("pypdf is not installed")
+    reader = PdfReader(streaming.local(file_path))
+    if reader.is_encrypted and not reader.decrypt(''):
+        # it needs a password to be opened
+        raise LocalError(f"{file_path} is encrypted")
+    return reader
+
+
+def _output(file_path: str, output_dir: str, ext: str = 'pdf') -> str:
+    """
+    Return the output path of file_path in output_dir
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(output_dir, f"{name}.{ext}")
+
+
+def _save(writer, path: str) -> None:
+    """
+    Write a PDF file, renaming it once it is complete so a failed write
+    never leaves a second file in the output folder
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path),
+                            f".{os.path.basename(path)}")
+    try:
+        with open(tmp_path, 'wb') as f:
+            writer.write(f)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def local_merge(files: list, output_dir: str) -> None:
+    """
+    Merge two or more PDF files and save the result in output_dir folder
+    :param files: (list) of each PDF file paths.
+    :param output_dir: (str) path of output dir (it should exist)
+    """
+    readers = [_reader(file_name) for file_name in files]
+    writer = PdfWriter()
+    for reader in readers:
+        checkpoint()
+        writer.append(reader)
+    _save(writer, _output(files[0], output_dir))
+
+
+def local_protect(file_path: str, password: str, output_dir: str) -> None:
+    """
+    Protect a PDF file with a password (AES-256)
+    and save the result in output_dir folder
+    :param output_dir: (str) to save the protected PDF file
+    :param password: (str) to protect the PDF file
+    :param file_path: (str) of the PDF to protect
+    """
+    writer = PdfWriter(clone_from=_reader(file_path))
+    # it needs the cryptography package
+    writer.encrypt(user_password=password, algorithm='AES-256')
+    _save(writer, _output(file_path, output_dir))
+
+
+def local_rotate(file_path: str, output_dir: str, rot: int = 90) -> None:
+    """
+    Rotate (clockwise) every page of a PDF file
+    and save the result in output_dir folder
+    :param rot: (int) angle to rotate the PDF file
+    :param file_path: (str) of the PDF to rotate
+    :param output_dir: (str) to save the rotated PDF file
+    """
+    writer = PdfWriter(clone_from=_reader(file_path))
+    for page in writer.pages:
+        page.rotate(rot)
+    _save(writer, _output(file_path, output_dir))
+
+
+def local_split(file_path: str, output_dir: str, range=1):
+    """
+    Split a PDF file every range pages and save the result in output_dir
+    folder: a PDF file if there is one part, else a zip of the parts
+    :param range: (int) pages of each part
+    :param file_path: (str) of the PDF to split
+    :param output_dir: (str) to save the PDF or zip file
+    """
+    if range < 1:
+        raise LocalError(f"invalid range {range}")
+    reader = _reader(file_path)
+    pages = len(reader.pages)
+    if pages <= range:
+        _save(PdfWriter(clone_from=reader), _output(file_path, output_dir))
+        return
+    zip_path = _output(file_path, output_dir, 'zip')
+    tmp_path = os.path.join(output_dir, f".{os.path.basename(zip_path)}")
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    try:
+        with zipfile.ZipFile(tmp_path, 'w') as zip_ref:
+            # range is the parameter, as in love_split()
+            starts = builtins.range(0, pages, range)
+            for num, start in enumerate(starts):
+                checkpoint()
+                writer = PdfWriter()
+                for page in reader.pages[start:start + range]:
+                    writer.add_page(page)
+                part = io.BytesIO()
+                writer.write(part)
+                zip_ref.writestr(f"{name}-{num + 1}.pdf", part.getvalue())
+        os.rename(tmp_path, zip_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def local_unlock(file_path: str, output_dir: str) -> None:
+    """
+    Remove the restrictions (owner password) of a PDF file
+    and save the result in output_dir folder
+    :param file_path: (str) of the PDF to unlock
+    :param output_dir: (str) to save the unlocked PDF file
+    """
+    writer = PdfWriter(clone_from=_reader(file_path))
+    _save(writer, _output(file_path, output_dir))
+
+
+def jpeg_info(f: BinaryIO) -> Tuple[int, int, int, bool]:
+    """
+    Read the size and the components of a jpg image from its headers
+    :param f: (file) the image opened in binary mode, at its start
+    :return: (tuple) width, height, components and whether it has an Adobe
+    marker (its CMYK values are inverted)
+    """
+    if f.read(2) != b'\xff\xd8':
+        raise LocalError("not a jpg image")
+    adobe = False
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise LocalError("invalid jpg image")
+        if marker[1] == 0xFF:
+            # fill byte
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker[1] in SOF_MARKERS:
+            _, height, width, components = struct.unpack('>BHHB', f.read(6))
+            if components not in COLOR_SPACES or not width or not height:
+                raise LocalError("unsupported jpg image")
+            return width, height, components, adobe
+        segment = f.read(length - 2)
+        if marker[1] == 0xEE and segment.startswith(b'Adobe'):
+            adobe = True
+
+
+class PdfStream:
+    """
+    Minimal PDF file writer: objects are written to f as they come,
+    so an image is never in memory
+    :param f: (file) opened in binary mode
+    """
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.offsets = {}
+        self.count = 0
+        self.f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def reserve(self) -> int:
+        """
+        Return the number of a new object, written later
+        """
+        self.count += 1
+        return self.count
+
+    def begin(self, number: int = 0) -> int:
+        number = number or self.reserve()
+        self.offsets[number] = self.f.tell()
+        self.f.write(f"{number} 0 obj\n".encode())
+        return number
+
+    def write(self, body: str, number: int = 0) -> int:
+        """
+        Write an object (its dictionary or value)
+        :return: (int) its number
+        """
+        number = self.begin(number)
+        self.f.write(f"{body}\nendobj\n".encode())
+        return number
+
+    def write_stream(self, entries: str, chunks,
+                     length: Optional[int] = None) -> int:
+        """
+        Write a stream object of length bytes from chunks, if the length
+        is not known it is written after the stream, in its own object
+        :return: (int) its number
+        """
+        number = self.begin()
+        length_number = self.reserve() if length is None else 0
+        length_ref = f"{length_number} 0 R" if length_number else length
+        self.f.write(f"<< {entries} /Length {length_ref} >>\nstream\n"
+                     .encode())
+        start = self.f.tell()
+        for chunk in chunks:
+            self.f.write(chunk)
+        length = self.f.tell() - start
+        self.f.write(b'\nendstream\nendobj\n')
+        if length_number:
+            self.write(str(length), length_number)
+        return number
+
+    def close(self, root: int) -> None:
+        """
+        Write the cross-reference table and the trailer
+        :param root: (int) number of the catalog
+        """
+        xref = self.f.tell()
+        self.f.write(f"xref\n0 {self.count + 1}\n".encode())
+        self.f.write(b'0000000000 65535 f \n')
+        for number in range(1, self.count + 1):
+            self.f.write(f"{self.offsets[number]:010d} 00000 n \n".encode())
+        self.f.write(f"trailer\n<< /Size {self.count + 1} /Root {root} 0 R "
+                     f">>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+
+def _embed_jpeg(pdf: PdfStream, f: BinaryIO) -> Tuple[int, int, int]:
+    """
+    Write a jpg image as it is (DCTDecode), without decoding it
+    :return: (tuple) image object number, width and height
+    """
+    width, height, components, adobe = jpeg_info(f)
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    entries = f"/Type /XObject /Subtype /Image /Width {width} " \
+              f"/Height {height} /ColorSpace {COLOR_SPACES[components]} " \
+              f"/BitsPerComponent 8 /Filter /DCTDecode"
+    if components == 4 and adobe:
+        entries += " /Decode [1 0 1 0 1 0 1 0]"
+    chunks = iter(lambda: f.read(CHUNK_SIZE), b'')
+    return pdf.write_stream(entries, chunks, size), width, height
+
+
+def _deflate(image) -> Iterator[bytes]:
+    """
+    Yield the pixels of a Pillow image compressed (zlib), a band of rows
+    of about CHUNK_SIZE bytes at a time
+    """
+    compressor = zlib.compressobj()
+    width, height = image.size
+    rows = max(1, CHUNK_SIZE // (width * len(image.getbands())))
+    for top in range(0, height, rows):
+        band = image.crop((0, top, width, min(height, top + rows)))
+        yield compressor.compress(band.tobytes())
+    yield compressor.flush()
+
+
+def _embed_image(pdf: PdfStream, file_name: str) -> Tuple[int, int, int]:
+    """
+    Write an image other than jpg losslessly (FlateDecode), it needs Pillow.
+    It is turned as its EXIF orientation tells, and a transparent image is
+    laid on a white background.
+    :return: (tuple) image object number, width and height
+    """
+    if Image is None:
+        raise LocalError("Pillow is not installed")
+    with Image.open(file_name) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'PA') or \
+                'transparency' in image.info:
+            image = image.convert('RGBA')
+            background = Image.new('RGBA', image.size, 'white')
+            image = Image.alpha_composite(background, image)
+        if image.mode not in ('L', 'RGB', 'CMYK'):
+            image = image.convert('RGB')
+        width, height = image.size
+        color_space = {'L': '/DeviceGray', 'RGB': '/DeviceRGB',
+                       'CMYK': '/DeviceCMYK'}[image.mode]
+        entries = f"/Type /XObject /Subtype /Image /Width {width} " \
+                  f"/Height {height} /ColorSpace {color_space} " \
+                  f"/BitsPerComponent 8 /Filter /FlateDecode"
+        return pdf.write_stream(entries, _deflate(image)), width, height
+
+
+def local_imgtopdf(files: List[str], output_dir: str) -> None:
+    """
+    Convert one or more images to a single PDF file (one page per image,
+    in the files order) and save the result in output_dir folder, as
+    love_imgtopdf() does (portrait, fit page size and no margin).
+    The PDF file is written in one pass, one image at a time, and jpg
+    images are embedded without being decoded and encoded again.
+    :param files: (list) of each image file paths
+    :param output_dir: (str) path of output dir
+    """
+    path = _output(files[-1], output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_path = os.path.join(output_dir, f".{os.path.basename(path)}")
+    try:
+        with open(tmp_path, 'wb') as f:
+            pdf = PdfStream(f)
+            catalog = pdf.reserve()
+            pages = pdf.reserve()
+            kids = []
+            for file_name in files:
+                checkpoint()
+                with open(streaming.local(file_name), 'rb') as image:
+                    is_jpeg = image.read(2) == b'\xff\xd8'
+                    image.seek(0)
+                    if is_jpeg:
+                        xobject, width, height = _embed_jpeg(pdf, image)
+                if not is_jpeg:
+                    xobject, width, height = _embed_image(pdf, file_name)
+                # the page has the size of the image, 1 pixel per point
+                content = f"q {width} 0 0 {height} 0 0 cm /Im0 Do Q".encode()
+                contents = pdf.write_stream('', [content], len(content))
+                kids.append(pdf.write(
+                    f"<< /Type /Page /Parent {pages} 0 R "
+                    f"/MediaBox [0 0 {width} {height}] "
+                    f"/Resources << /XObject << /Im0 {xobject} 0 R >> >> "
+                    f"/Contents {contents} 0 R >>"))
+            pdf.write(f"<< /Type /Pages /Count {len(kids)} /Kids "
+                      f"[{' '.join(f'{kid} 0 R' for kid in kids)}] >>", pages)
+            pdf.write(f"<< /Type /Catalog /Pages {pages} 0 R >>", catalog)
+            pdf.close(catalog)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
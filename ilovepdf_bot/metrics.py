@@ -0,0 +1,270 @@
+import contextlib
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+from .constants import METRICS_LISTEN, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'ilovepdfbot_'
+# seconds, upper bounds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300)
+# name: (type, help) of every metric
+CATALOG = {
+    'command_seconds': (
+        'histogram', "Seconds a job of each command ran"),
+    'stage_seconds': (
+        'histogram', "Seconds of each stage of the jobs of each command: "
+                     "telegram_download, ilovepdf_start, ilovepdf_upload, "
+                     "ilovepdf_process, ilovepdf_download, ilovepdf_delete, "
+                     "local, unzip and reply_upload"),
+    'queue_wait_seconds': (
+        'histogram', "Seconds a job waited for a worker"),
+    'bytes_in_total': (
+        'counter', "Bytes received from each peer (telegram, ilovepdf)"),
+    'bytes_out_total': (
+        'counter', "Bytes sent to each peer (telegram, ilovepdf)"),
+    'errors_total': (
+        'counter', "Errors by source (job, ilovepdf, telegram) and type"),
+    'jobs_queued': (
+        'gauge', "Jobs waiting for a worker"),
+    'jobs_active': (
+        'gauge', "Jobs running"),
+    'jobs_coalesced_total': (
+        'counter', "Jobs answered with the outputs of an identical one"),
+    'results_reused_total': (
+        'counter', "Requests answered with outputs already sent"),
+    'outbox_queued': (
+        'gauge', "Telegram calls waiting to be sent"),
+    'ilovepdf_tasks_limit': (
+        'gauge', "ilovepdf tasks allowed at once"),
+    'ilovepdf_tasks_running': (
+        'gauge', "ilovepdf tasks running"),
+    'ilovepdf_tasks_waiting': (
+        'gauge', "ilovepdf tasks waiting for the limit"),
+    'files_staged': (
+        'gauge', "Files downloaded (and uploaded) waiting for a parameter"),
+}
+
+_local = threading.local()
+
+
+class Histogram:
+    """
+    Observations counted in buckets, with their sum
+    :param buckets: (tuple) sorted upper bounds
+    """
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        num = bisect_left(self.buckets, value)
+        if num < len(self.counts):
+            self.counts[num] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: tuple, **extra) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of the bot (see CATALOG), rendered in
+    the Prometheus text format. The stages timed in a thread are labelled
+    with the command set by command() in that thread.
+    :param buckets: (tuple) seconds, upper bounds of the histograms
+    """
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        # name -> {labels: value or Histogram}
+        self._values = {name: {} for name in CATALOG}
+        # name -> callable returning the value of a gauge
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Add value to a counter
+        :param name: (str) of the counter, e.g. 'errors_total'
+        :param value: (float) to add
+        :param labels: of the counter, e.g. source='job'
+        :return: None
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Count value in a histogram
+        :param name: (str) of the histogram, e.g. 'stage_seconds'
+        :param value: (float) observed, e.g. seconds
+        :param labels: of the histogram, e.g. stage='unzip'
+        :return: None
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._values[name].get(key)
+            if histogram is None:
+                histogram = self._values[name][key] = \
+                    Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Context manager observing the seconds it took in a histogram,
+        also when it raised
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextlib.contextmanager
+    def command(self, command: str, timed: bool = True):
+        """
+        Context manager labelling the stages timed in this thread with
+        command, and timing the command if timed
+        :param command: (str) e.g. 'compress'
+        :param timed: (bool) observe its seconds in command_seconds
+        """
+        previous = getattr(_local, 'command', '')
+        _local.command = command
+        try:
+            if timed:
+                with self.timer('command_seconds', command=command):
+                    yield
+            else:
+                yield
+        finally:
+            _local.command = previous
+
+    def stage(self, stage: str):
+        """
+        Return a context manager timing a stage of the running command
+        :param stage: (str) e.g. 'ilovepdf_process'
+        """
+        return self.timer('stage_seconds', stage=stage,
+                          command=getattr(_local, 'command', ''))
+
+    def gauge(self, name: str, func: Callable[[], float]) -> None:
+        """
+        Register the function returning the value of a gauge (or of a
+        counter kept elsewhere), called when the metrics are rendered
+        :param name: (str) of the gauge, e.g. 'jobs_queued'
+        :param func: (callable) returning its value
+        :return: None
+        """
+        self._gauges[name] = func
+
+    def render(self) -> str:
+        """
+        Return every metric in the Prometheus text format
+        :return: (str)
+        """
+        lines = []
+        for name, (kind, text) in CATALOG.items():
+            full_name = PREFIX + name
+            lines.append(f"# HELP {full_name} {text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if name in self._gauges:
+                try:
+                    lines.append(f"{full_name} {self._gauges[name]()}")
+                except Exception as exc:
+                    logger.warning("metric %s failed: %s", name, exc)
+                continue
+            with self._lock:
+                values = [(key, value) if kind != 'histogram' else
+                          (key, (list(value.counts), value.sum, value.count))
+                          for key, value in self._values[name].items()]
+            for key, value in sorted(values, key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f"{full_name}{_labels(key)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append(f"{full_name}_bucket"
+                                 f"{_labels(key, le=bound)} {cumulative}")
+                lines.append(f"{full_name}_bucket{_labels(key, le='+Inf')} "
+                             f"{count}")
+                lines.append(f"{full_name}_sum{_labels(key)} {total}")
+                lines.append(f"{full_name}_count{_labels(key)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Answer GET /metrics with the bot metrics
+    """
+
+    server_version = 'ilovepdfbot'
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Local HTTP endpoint serving the metrics to Prometheus at /metrics
+    :param listen: (str) address to bind
+    :param port: (int) port to bind
+    """
+
+    daemon_threads = True
+
+    def __init__(self, listen: str = METRICS_LISTEN,
+                 port: int = METRICS_PORT):
+        super().__init__((listen, port), MetricsHandler)
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Serve the endpoint in a background thread
+        :return: None
+        """
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='metrics', daemon=True)
+        self._thread.start()
+        logger.info("metrics served on %s:%s/metrics",
+                    *self.server_address[:2])
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
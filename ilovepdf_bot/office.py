@@ -0,0 +1,268 @@
+import logging
+import os
+import queue
+import shlex
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import xmlrpc.client
+
+from . import streaming
+from .constants import (LOCAL_TOOLS, OFFICE_COMMAND, OFFICE_MAX_JOBS,
+                        OFFICE_PORT, OFFICE_START_TIMEOUT, OFFICE_TIMEOUT,
+                        OFFICE_WORKERS)
+from .jobs import checkpoint
+
+logger = logging.getLogger(__name__)
+
+
+class OfficeError(Exception):
+    """
+    Raised when a conversion fails, times out or no worker is available
+    """
+
+
+class TimeoutTransport(xmlrpc.client.Transport):
+    """
+    XML-RPC transport giving up after timeout seconds
+    """
+
+    def __init__(self, timeout: float):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class OfficeWorker:
+    """
+    A warm headless LibreOffice instance, started by command (a unoserver)
+    with its own profile, which converts files through XML-RPC
+    :param number: (int) of the worker, its ports are taken from it
+    :param command: (str) template, formatted with port, uno_port and
+    profile
+    :param base_port: (int) first port used by the workers
+    """
+
+    def __init__(self, number: int, command: str = OFFICE_COMMAND,
+                 base_port: int = OFFICE_PORT):
+        self.number = number
+        self.command = command
+        self.port = base_port + 2 * number
+        self.uno_port = self.port + 1
+        self.profile = None
+        self.process = None
+        self.jobs = 0
+
+    def start(self, timeout: float = OFFICE_START_TIMEOUT) -> None:
+        """
+        Start the instance and wait until it accepts conversions
+        :param timeout: (float) seconds to wait
+        :return: None
+        """
+        self.profile = tempfile.mkdtemp(prefix='office-')
+        args = shlex.split(self.command.format(port=self.port,
+                                               uno_port=self.uno_port,
+                                               profile=self.profile))
+        self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL,
+                                        start_new_session=True)
+        self.jobs = 0
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.alive():
+                break
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                logger.info("office worker %s ready on port %s",
+                            self.number, self.port)
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise OfficeError(f"office worker {self.number} did not start")
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self) -> None:
+        """
+        Stop the instance (and the soffice it started) and remove its profile
+        :return: None
+        """
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, 15)
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, 9)
+                self.process.wait()
+            except ProcessLookupError:
+                pass
+            self.process = None
+        if self.profile:
+            shutil.rmtree(self.profile, ignore_errors=True)
+            self.profile = None
+
+    def restart(self) -> None:
+        self.stop()
+        self.start()
+
+    def convert(self, file_path: str, pdf_path: str,
+                timeout: float = OFFICE_TIMEOUT) -> None:
+        """
+        Convert an office file to a PDF file
+        :param file_path: (str) of the office file
+        :param pdf_path: (str) where the PDF file is saved
+        :param timeout: (float) seconds the conversion may take
+        :return: None
+        """
+        proxy = xmlrpc.client.ServerProxy(
+            f"http://127.0.0.1:{self.port}", allow_none=True,
+            transport=TimeoutTransport(timeout))
+        # convert(inpath, indata, outpath, convert_to)
+        proxy.convert(os.path.abspath(file_path), None,
+                      os.path.abspath(pdf_path), 'pdf')
+        self.jobs += 1
+
+
+class OfficePool:
+    """
+    Pool of warm OfficeWorkers, a local alternative to the ilovepdf
+    officepdf tool without the soffice cold start of each file.
+    A conversion is dispatched to an idle worker; workers are recycled
+    after max_jobs conversions, or when a conversion fails or times out.
+    :param workers: (int) LibreOffice instances
+    :param max_jobs: (int) conversions before a worker is restarted
+    :param timeout: (float) seconds a conversion may take
+    """
+
+    def __init__(self, workers: int = OFFICE_WORKERS,
+                 max_jobs: int = OFFICE_MAX_JOBS,
+                 timeout: float = OFFICE_TIMEOUT):
+        self.size = workers
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self._workers = []
+        self._idle = queue.Queue()
+        self._started = False
+
+    @property
+    def enabled(self) -> bool:
+        return 'officetopdf' in LOCAL_TOOLS
+
+    def start(self) -> None:
+        """
+        Start the workers in background threads
+        :return: None
+        """
+        if not self.enabled or self._started:
+            return
+        self._started = True
+        for number in range(self.size):
+            worker = OfficeWorker(number)
+            self._workers.append(worker)
+            self._recycle(worker, restart=False)
+
+    def stop(self) -> None:
+        """
+        Stop the workers
+        :return: None
+        """
+        self._started = False
+        for worker in self._workers:
+            worker.stop()
+
+    def _recycle(self, worker: OfficeWorker, restart: bool = True) -> None:
+        """
+        (Re)start a worker in a background thread, it is idle once ready
+        """
+        def run():
+            if not self._started:
+                return
+            try:
+                if restart:
+                    worker.restart()
+                else:
+                    worker.start()
+            except (OSError, OfficeError):
+                logger.exception("office worker %s failed to start",
+                                 worker.number)
+                # kept out of the pool, it is started again later
+                retry = threading.Timer(OFFICE_START_TIMEOUT, self._recycle,
+                                        (worker,))
+                retry.daemon = True
+                retry.start()
+                return
+            if self._started:
+                self._idle.put(worker)
+
+        threading.Thread(target=run, name=f"office-{worker.number}",
+                         daemon=True).start()
+
+    def _acquire(self) -> OfficeWorker:
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            # checkpoint() gives up if the job timed out
+            checkpoint()
+            try:
+                worker = self._idle.get(timeout=1)
+            except queue.Empty:
+                continue
+            if worker.alive():
+                return worker
+            logger.warning("office worker %s crashed", worker.number)
+            self._recycle(worker)
+        raise OfficeError("no office worker available")
+
+    def convert(self, file_path: str, output_dir: str) -> None:
+        """
+        Convert an office file and save the result in output_dir folder,
+        as love_officetopdf() does
+        :param file_path: (str)
+        :param output_dir: (str) to save the converted file
+        """
+        if not self._started:
+            raise OfficeError("the office pool is not started")
+        file_path = streaming.local(file_path)
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        pdf_path = os.path.join(output_dir, f"{name}.pdf")
+        # renamed once complete, a failed conversion leaves no file
+        tmp_path = os.path.join(output_dir, f".{name}.pdf")
+        os.makedirs(output_dir, exist_ok=True)
+        worker = self._acquire()
+        recycle = False
+        try:
+            worker.convert(file_path, tmp_path, self.timeout)
+            if not os.path.isfile(tmp_path):
+                raise OfficeError(f"{file_path} was not converted")
+            os.rename(tmp_path, pdf_path)
+        except (OSError, xmlrpc.client.Error) as exc:
+            # timed out, crashed or the instance is in a bad state
+            recycle = True
+            raise OfficeError(f"office conversion failed: {exc}") from exc
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if recycle or worker.jobs >= self.max_jobs:
+                self._recycle(worker)
+            else:
+                self._idle.put(worker)
+
+    def stats(self) -> dict:
+        """
+        Return the pool counters
+        :return: (dict) with workers, idle and alive workers
+        """
+        return {'workers': self.size, 'idle': self._idle.qsize(),
+                'alive': sum(worker.alive() for worker in self._workers)}
+
+
+office_pool = OfficePool()
@@ -0,0 +1,324 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from typing import Callable, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+from .constants import (CHAT_BURST, CHAT_RATE, GROUP_RATE, SEND_BURST,
+                        SEND_RATE, SEND_WORKERS)
+from .jobs import checkpoint
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# priorities: result files (and their chat actions) go before the chatter
+FILE = 0
+CHATTER = 1
+
+
+class TokenBucket:
+    """
+    Allow rate calls per second, and bursts of up to burst calls
+    :param rate: (float) tokens added per second
+    :param burst: (float) tokens the bucket holds
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, cost: float, now: float) -> float:
+        """
+        Return the seconds until cost tokens can be taken (0 if now),
+        a cost above burst is allowed once the bucket is full
+        """
+        self._refill(now)
+        needed = min(cost, self.burst)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, cost: float) -> None:
+        self.tokens -= cost
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Send:
+    """
+    A Bot API call queued in the Outbox
+    """
+
+    def __init__(self, seq: int, func: Callable, args: tuple, kwargs: dict,
+                 priority: int, cost: int):
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.cost = cost
+        self.future = Future()
+        self.started = False
+        # file objects of the call (read by ptb when it is sent), with
+        # where they were read from
+        self.files = [(value, value.tell())
+                      for value in (*args, *kwargs.values())
+                      if hasattr(value, 'seek') and hasattr(value, 'tell')]
+
+    def rewind(self) -> None:
+        """
+        Put the file objects of the call back where they were when it was
+        queued, so it is sent again with the whole files
+        """
+        for f, position in self.files:
+            f.seek(position)
+
+
+class Outbox:
+    """
+    Central queue of the calls sending something to the users, run by
+    sender threads within the Telegram limits: a global token bucket and
+    one per chat (slower for groups). Every chat gets its calls in order,
+    the chats whose next call is a result file are served first, and a
+    chat answered with a flood wait (429 retry_after) is put aside until
+    it ends while the other chats go on.
+    :param workers: (int) sender threads
+    :param rate: (float) calls per second of the bot
+    :param burst: (float) calls the bot may send at once
+    :param chat_rate: (float) calls per second to a private chat
+    :param chat_burst: (float) calls a private chat may get at once
+    :param group_rate: (float) calls per second to a group
+    """
+
+    def __init__(self, workers: int = SEND_WORKERS, rate: float = SEND_RATE,
+                 burst: float = SEND_BURST, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST,
+                 group_rate: float = GROUP_RATE):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._bucket = TokenBucket(rate, burst)
+        self._chats = {}
+        self._buckets = {}
+        self._blocked = {}
+        self._busy = set()
+        self._seq = 0
+        self._threads = []
+        self._stopped = False
+        self._changed = threading.Condition()
+
+    @property
+    def started(self) -> bool:
+        return bool(self._threads)
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of calls waiting to be sent
+        """
+        with self._changed:
+            return sum(len(sends) for sends in self._chats.values())
+
+    def start(self) -> None:
+        """
+        Start the sender threads (it does nothing if already started)
+        :return: None
+        """
+        if self._threads:
+            return
+        self._stopped = False
+        for num in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name=f"sender-{num}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10) -> None:
+        """
+        Send the queued calls and stop the sender threads
+        :param timeout: (float) seconds to wait for each thread
+        :return: None
+        """
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def send(self, chat_id: int, func: Callable, *args,
+             priority: int = CHATTER, cost: int = 1, **kwargs) -> Future:
+        """
+        Queue func(*args, **kwargs), a Bot API call to chat_id, without
+        waiting for it (it runs right away if the outbox is not started),
+        a failed call is logged
+        :param chat_id: (int) of the chat the call sends to
+        :param func: (callable) e.g. update.effective_message.reply_text
+        :param priority: (int) FILE or CHATTER
+        :param cost: (int) messages sent by the call (e.g. a media group)
+        :return: (concurrent.futures.Future) of the call result
+        """
+        future = self._queue(chat_id, func, args, kwargs, priority, cost)
+        future.add_done_callback(self._log_error)
+        return future
+
+    def call(self, chat_id: int, func: Callable, *args,
+             priority: int = FILE, cost: int = 1, **kwargs):
+        """
+        Queue a Bot API call as send() does and wait for its result
+        (e.g. the message of a sent document), giving up if the job
+        running in this thread times out
+        :return: the result of func, or raise its exception
+        """
+        future = self._queue(chat_id, func, args, kwargs, priority, cost)
+        try:
+            while True:
+                checkpoint()
+                try:
+                    return future.result(timeout=1)
+                except TimeoutError:
+                    continue
+        except BaseException:
+            future.cancel()
+            raise
+
+    def _queue(self, chat_id: int, func: Callable, args: tuple,
+               kwargs: dict, priority: int, cost: int) -> Future:
+        if not self._threads:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as exc:
+                future.set_exception(exc)
+            return future
+        with self._changed:
+            self._seq += 1
+            send = Send(self._seq, func, args, kwargs, priority, cost)
+            self._chats.setdefault(chat_id, deque()).append(send)
+            self._changed.notify()
+        return send.future
+
+    @staticmethod
+    def _log_error(future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("telegram call failed: %s", future.exception())
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # negative ids are groups and channels
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate,
+                                                          self.chat_burst)
+        return bucket
+
+    def _next(self, now: float) -> Tuple[Optional[int], Optional[float]]:
+        """
+        Return the chat whose next call can be sent now, or None and the
+        seconds to wait (None if there is nothing to send)
+        """
+        chosen, first, wait = None, None, None
+        for chat_id, sends in self._chats.items():
+            if chat_id in self._busy:
+                # one call at a time, to keep the chat calls in order
+                continue
+            send = sends[0]
+            delay = max(self._blocked.get(chat_id, 0) - now,
+                        self._chat_bucket(chat_id).delay(send.cost, now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif first is None or \
+                    (send.priority, send.seq) < (first.priority, first.seq):
+                chosen, first = chat_id, send
+        if chosen is None:
+            return None, wait
+        delay = self._bucket.delay(first.cost, now)
+        if delay > 0:
+            return None, delay
+        return chosen, None
+
+    def _take(self) -> Optional[Tuple[int, Send]]:
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                chat_id, wait = self._next(now)
+                if chat_id is not None:
+                    send = self._chats[chat_id].popleft()
+                    self._bucket.take(send.cost)
+                    self._chat_bucket(chat_id).take(send.cost)
+                    self._busy.add(chat_id)
+                    return chat_id, send
+                if self._stopped and wait is None:
+                    return None
+                self._changed.wait(wait)
+
+    def _done(self, chat_id: int, send: Send = None) -> None:
+        """
+        Free the chat, putting send back at the head of its calls
+        """
+        with self._changed:
+            self._busy.discard(chat_id)
+            sends = self._chats[chat_id]
+            if send is not None:
+                sends.appendleft(send)
+            elif not sends:
+                del self._chats[chat_id]
+                self._blocked.pop(chat_id, None)
+            # forget the idle chats once their bucket is full again
+            now = time.monotonic()
+            for idle in [idle for idle, bucket in self._buckets.items()
+                         if idle not in self._chats
+                         and bucket.full(now)]:
+                del self._buckets[idle]
+            self._changed.notify_all()
+
+    def _work(self) -> None:
+        while True:
+            taken = self._take()
+            if taken is None:
+                break
+            chat_id, send = taken
+            if not send.started:
+                send.started = True
+                if not send.future.set_running_or_notify_cancel():
+                    # the waiting job gave up
+                    self._done(chat_id)
+                    continue
+            try:
+                result = send.func(*send.args, **send.kwargs)
+            except RetryAfter as exc:
+                logger.warning("flood wait of %ss in chat %s",
+                               exc.retry_after, chat_id)
+                metrics.inc('errors_total', source='telegram',
+                            type='RetryAfter')
+                with self._changed:
+                    self._blocked[chat_id] = time.monotonic() + \
+                        exc.retry_after
+                send.rewind()
+                self._done(chat_id, send)
+                continue
+            except Exception as exc:
+                metrics.inc('errors_total', source='telegram',
+                            type=type(exc).__name__)
+                send.future.set_exception(exc)
+            else:
+                send.future.set_result(result)
+            self._done(chat_id)
+
+
+outbox = Outbox()
+metrics.gauge('outbox_queued', lambda: outbox.depth)
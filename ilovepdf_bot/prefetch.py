@@ -0,0 +1,229 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from pylovepdf.tools.protect import Protect
+from pylovepdf.tools.rotate import Rotate
+from pylovepdf.tools.split import Split
+from pylovepdf.tools.watermark import Watermark
+
+from .constants import LOCAL_TOOLS, PREFETCH_WORKERS, STATE_TTL
+from .ilovepdf import forget_staged, love_stage
+from .jobs import checkpoint
+from .metrics import metrics
+from .workspace import Workspace, workspaces
+
+logger = logging.getLogger(__name__)
+
+# tools asking a parameter after the file, and their ilovepdf task
+staged_tools = {
+    'protect': Protect,
+    'split': Split,
+    'rotate': Rotate,
+    'watermark': Watermark,
+}
+
+
+class Staged:
+    """
+    A user file downloaded (and uploaded to an ilovepdf task) while the
+    user types the parameter of the tool. It is a context manager
+    returning its workspace, the workspace and the task left are removed
+    when it exits.
+    :param doc: (telegram.Document or state.FileRef) the user file
+    :param expires: (float) time.monotonic() when it is discarded
+    """
+
+    def __init__(self, doc, expires: float):
+        self.file_id = doc.file_id
+        self.unique_id = doc.file_unique_id
+        self.size = doc.file_size
+        self.expires = expires
+        self.ws: Optional[Workspace] = None
+        self.failed = False
+        self.cancelled = False
+        self.ready = threading.Event()
+
+    @property
+    def file_path(self) -> str:
+        """
+        Input path without extension (and output folder) of the job
+        """
+        return self.ws.file(self.file_id)
+
+    def close(self) -> None:
+        if self.ws:
+            forget_staged(f"{self.file_path}.pdf")
+            self.ws.close()
+
+    def __enter__(self) -> Workspace:
+        return self.ws
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class Prefetcher:
+    """
+    Stage the input of /protectpdf, /splitpdf, /rotatepdf and /watermark
+    once the PDF file is accepted: it is downloaded into a workspace and,
+    unless the tool runs locally, an ilovepdf task is started and the file
+    uploaded, so the job only processes and downloads it when the
+    parameter arrives. A staged file is discarded when the conversation
+    is cancelled, when another file replaces it or ttl seconds later.
+    :param workers: (int) threads staging files (0 disables it)
+    :param ttl: (float) seconds a staged file waits for its parameter
+    """
+
+    def __init__(self, workers: int = PREFETCH_WORKERS,
+                 ttl: float = STATE_TTL):
+        self.workers = workers
+        self.ttl = ttl
+        self._pool = None
+        # (chat_id, tool) -> Staged
+        self._staged = {}
+        self._lock = threading.Lock()
+        self._last_expire = time.monotonic()
+
+    def start(self) -> None:
+        """
+        Start the staging threads (it does nothing if disabled or already
+        started)
+        :return: None
+        """
+        if self.workers > 0 and self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='prefetch')
+
+    def stop(self) -> None:
+        """
+        Stop the staging threads and discard every staged file
+        :return: None
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        with self._lock:
+            staged, self._staged = list(self._staged.values()), {}
+        for entry in staged:
+            entry.close()
+
+    def stage(self, chat_id: int, tool: str, bot, doc) -> None:
+        """
+        Start staging the file of a tool in background (it does nothing if
+        the prefetcher is not started or the tool has no parameter)
+        :param chat_id: (int) of the chat
+        :param tool: (str) e.g. 'protect'
+        :param bot: (telegram.Bot) the bot object
+        :param doc: (telegram.Document or state.FileRef) the user file
+        :return: None
+        """
+        if self._pool is None or tool not in staged_tools:
+            return
+        self.discard(chat_id, tool)
+        staged = Staged(doc, time.monotonic() + self.ttl)
+        with self._lock:
+            self._staged[(chat_id, tool)] = staged
+        self._pool.submit(self._run, staged, tool, bot)
+        self._maybe_expire()
+
+    def _run(self, staged: Staged, tool: str, bot) -> None:
+        try:
+            if staged.cancelled:
+                return
+            staged.ws = workspaces.create()
+            staged.ws.reserve(staged.size)
+            file_name = f"{staged.file_path}.pdf"
+            # its stages are timed as those of the tool
+            with metrics.command(tool, timed=False):
+                with metrics.stage('telegram_download'):
+                    bot.getFile(staged.file_id).download(file_name)
+                metrics.inc('bytes_in_total', staged.size or 0,
+                            peer='telegram')
+                if tool not in LOCAL_TOOLS and not staged.cancelled:
+                    love_stage(staged_tools[tool], file_name)
+        except Exception as exc:
+            logger.warning("prefetch of a %s file failed: %s", tool, exc)
+            staged.failed = True
+        finally:
+            with self._lock:
+                staged.ready.set()
+                done = staged.cancelled or staged.failed
+            if done:
+                # the job downloads the file itself
+                staged.close()
+
+    def take(self, chat_id: int, tool: str, doc) -> Optional[Staged]:
+        """
+        Return the file staged for a tool once it is ready, the caller
+        owns it then (use it as a context manager), giving up if the job
+        running in this thread times out. The file staged for another
+        user file is left to its conversation (e.g. a file sent with the
+        command in its caption meanwhile).
+        :param chat_id: (int) of the chat
+        :param tool: (str) e.g. 'protect'
+        :param doc: (telegram.Document or state.FileRef) the user file
+        :return: (Staged) or None if the file was not staged or it failed
+        """
+        self._maybe_expire()
+        with self._lock:
+            staged = self._staged.get((chat_id, tool))
+            if staged is None or staged.unique_id != doc.file_unique_id:
+                return None
+            del self._staged[(chat_id, tool)]
+        if staged.expires < time.monotonic():
+            self._cancel(staged)
+            return None
+        try:
+            while not staged.ready.wait(1):
+                checkpoint()
+        except BaseException:
+            self._cancel(staged)
+            raise
+        if staged.failed:
+            return None
+        return staged
+
+    def discard(self, chat_id: int, tool: Optional[str] = None,
+                unique_id: Optional[str] = None) -> None:
+        """
+        Discard the files staged for a chat (its ilovepdf tasks are
+        deleted and its workspaces removed)
+        :param chat_id: (int) of the chat
+        :param tool: (str) e.g. 'protect', None for every tool
+        :param unique_id: (str) of the user file, None for any file
+        :return: None
+        """
+        with self._lock:
+            keys = [key for key, staged in self._staged.items()
+                    if key[0] == chat_id and tool in (None, key[1]) and
+                    unique_id in (None, staged.unique_id)]
+            staged = [self._staged.pop(key) for key in keys]
+        for entry in staged:
+            self._cancel(entry)
+
+    def _cancel(self, staged: Staged) -> None:
+        with self._lock:
+            staged.cancelled = True
+            ready = staged.ready.is_set()
+        # else the staging thread closes it when it ends
+        if ready:
+            staged.close()
+
+    def _maybe_expire(self) -> None:
+        now = time.monotonic()
+        if now - self._last_expire < min(self.ttl, 60):
+            return
+        self._last_expire = now
+        with self._lock:
+            keys = [key for key, staged in self._staged.items()
+                    if staged.expires < now]
+            expired = [self._staged.pop(key) for key in keys]
+        for staged in expired:
+            self._cancel(staged)
+
+
+prefetcher = Prefetcher()
+metrics.gauge('files_staged', lambda: len(prefetcher._staged))
@@ -0,0 +1,164 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from . import streaming
+from .constants import (LOCAL_TOOLS, RASTER_DPI, RASTER_QUALITY,
+                        RASTER_WORKERS)
+from .jobs import checkpoint
+
+try:
+    import pypdfium2
+except ImportError:
+    # the rasterizer is optional, pdftojpg falls back to ilovepdf
+    pypdfium2 = None
+
+logger = logging.getLogger(__name__)
+
+# pages rendered by a worker with the document opened once (it is closed
+# after them, so no document of a finished job is left open)
+PAGES_PER_TASK = 4
+
+
+def render_pages(pdf_path: str, first: int, jpg_paths: List[str], dpi: int,
+                 quality: int) -> List[str]:
+    """
+    Render pages of a PDF file to jpg images (runs in a worker process)
+    :param pdf_path: (str) of the PDF file
+    :param first: (int) number of the first page, from 0
+    :param jpg_paths: (list) where the images of the pages from first on
+    are saved
+    :param dpi: (int) resolution of the images
+    :param quality: (int) jpg quality, 1 to 95
+    :return: (list) jpg_paths
+    """
+    document = pypdfium2.PdfDocument(pdf_path)
+    try:
+        for number, jpg_path in enumerate(jpg_paths, first):
+            page = document[number]
+            try:
+                image = page.render(scale=dpi / 72).to_pil()
+                image.convert('RGB').save(jpg_path, 'JPEG', quality=quality)
+            finally:
+                page.close()
+    finally:
+        document.close()
+    return jpg_paths
+
+
+def page_count(pdf_path: str) -> int:
+    """
+    Return the number of pages of a PDF file
+    :param pdf_path: (str) of the PDF file
+    :return: (int) pages
+    """
+    document = pypdfium2.PdfDocument(pdf_path)
+    try:
+        return len(document)
+    finally:
+        document.close()
+
+
+def _warm(_) -> None:
+    pass
+
+
+class Pages:
+    """
+    Images of the pages being rendered: iterating yields (file name,
+    image path) of each one as soon as it and the ones before it are
+    rendered
+    :param futures: (list) of the render_pages() futures, in pages order
+    :param count: (int) pages
+    """
+
+    def __init__(self, futures: List, count: int):
+        self.futures = futures
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        try:
+            for future in self.futures:
+                checkpoint()
+                for jpg_path in future.result():
+                    yield os.path.basename(jpg_path), jpg_path
+        finally:
+            # e.g. the job timed out or a page could not be sent
+            for future in self.futures:
+                future.cancel()
+
+
+class Rasterizer:
+    """
+    Render the pages of PDF files to jpg images in a pool of processes,
+    a local alternative to the ilovepdf pdftojpg tool
+    :param workers: (int) processes rendering pages
+    :param dpi: (int) resolution of the images
+    :param quality: (int) jpg quality, 1 to 95
+    """
+
+    def __init__(self, workers: int = RASTER_WORKERS, dpi: int = RASTER_DPI,
+                 quality: int = RASTER_QUALITY):
+        self.workers = workers
+        self.dpi = dpi
+        self.quality = quality
+        self._pool = None
+
+    @property
+    def enabled(self) -> bool:
+        return pypdfium2 is not None and 'pdftojpg' in LOCAL_TOOLS
+
+    def start(self) -> None:
+        """
+        Start the worker processes, call it before starting threads
+        (workers are forked from the bot process)
+        :return: None
+        """
+        if self.enabled and self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            # ProcessPoolExecutor starts its processes on demand
+            list(self._pool.map(_warm, range(self.workers)))
+
+    def stop(self) -> None:
+        """
+        Stop the worker processes
+        :return: None
+        """
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def pages(self, file_path: str) -> Optional[Pages]:
+        """
+        Render each page of file_path.pdf into file_path folder, as
+        love_pdftojpg() does, but yield each image as soon as it and the
+        ones before it are rendered
+        :param file_path: (str) without extension
+        (e.g. ./tmp/file_id for ./tmp/file_id.pdf)
+        :return: (Pages) of (file name, image path) in pages order,
+        None if the rasterizer can not render the file
+        """
+        if not self.enabled:
+            return None
+        self.start()
+        pdf_path = streaming.local(f"{file_path}.pdf")
+        try:
+            count = page_count(pdf_path)
+        except pypdfium2.PdfiumError as exc:
+            logger.warning("can not rasterize %s (%s)", pdf_path, exc)
+            return None
+        name = os.path.basename(file_path)
+        jpg_paths = [os.path.join(file_path, f"{name}-{number + 1}.jpg")
+                     for number in range(count)]
+        futures = [self._pool.submit(render_pages, pdf_path, first,
+                                     jpg_paths[first:first + PAGES_PER_TASK],
+                                     self.dpi, self.quality)
+                   for first in range(0, count, PAGES_PER_TASK)]
+        return Pages(futures, count)
+
+
+rasterizer = Rasterizer()
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from .constants import RESULT_INDEX_PATH, RESULT_INDEX_SIZE
+from .metrics import metrics
+
+# (telegram file_id, caption) of each delivered output
+Results = List[Tuple[str, str]]
+
+
+class ResultIndex:
+    """
+    Persistent index of the outputs already sent to Telegram,
+    keyed by the input file_unique_id, the tool and its parameters,
+    so a repeated request is answered with the stored file_id.
+    The database is opened on first use.
+    :param path: (str) of the sqlite database, ':memory:' to not persist
+    :param max_entries: (int) entries kept, the least recently used
+    are evicted first
+    """
+
+    def __init__(self, path: str = RESULT_INDEX_PATH,
+                 max_entries: int = RESULT_INDEX_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # called with the lock held
+        if self._db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS results ("
+                       "key TEXT PRIMARY KEY, "
+                       "results TEXT NOT NULL, "
+                       "last_used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS results_last_used "
+                       "ON results (last_used)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def key(unique_id: str, tool: str, params: Sequence = ()) -> str:
+        """
+        Return the index key, parameters are hashed so secrets
+        (e.g. passwords) are not stored
+        :param unique_id: (str) telegram file_unique_id of the input
+        :param tool: (str) e.g. 'compress'
+        :param params: (sequence) of the tool parameters
+        :return: (str) sha256 hex digest
+        """
+        raw = json.dumps([unique_id, tool, [str(p) for p in params]])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, unique_id: str, tool: str,
+            params: Sequence = ()) -> Optional[Results]:
+        """
+        Return the stored outputs of a request, None if there are not
+        :param unique_id: (str) telegram file_unique_id of the input
+        :param tool: (str) e.g. 'compress'
+        :param params: (sequence) of the tool parameters
+        :return: (list) of (file_id, caption) or None
+        """
+        key = self.key(unique_id, tool, params)
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT results FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE results SET last_used = ? WHERE key = ?",
+                             (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+        return [tuple(result) for result in json.loads(row[0])]
+
+    def put(self, unique_id: str, tool: str, results: Results,
+            params: Sequence = ()) -> None:
+        """
+        Store the outputs sent for a request
+        :param unique_id: (str) telegram file_unique_id of the input
+        :param tool: (str) e.g. 'compress'
+        :param results: (list) of (file_id, caption)
+        :param params: (sequence) of the tool parameters
+        :return: None
+        """
+        if not results:
+            return
+        key = self.key(unique_id, tool, params)
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO results "
+                             "(key, results, last_used) VALUES (?, ?, ?)",
+                             (key, json.dumps(results), time.time()))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        extra = count - self.max_entries
+        if extra > 0:
+            self._db.execute("DELETE FROM results WHERE key IN ("
+                             "SELECT key FROM results "
+                             "ORDER BY last_used LIMIT ?)", (extra,))
+            self.evictions += extra
+
+    def stats(self) -> dict:
+        """
+        Return the index counters
+        :return: (dict) with entries, hits, misses and evictions
+        """
+        with self._lock:
+            entries = self._connect().execute(
+                "SELECT COUNT(*) FROM results").fetchone()[0]
+        return {'entries': entries, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+index = ResultIndex()
+metrics.gauge('results_reused_total', lambda: index.hits)
+
+
+class InFlight:
+    """
+    Requests being processed, keyed as the index (input file_unique_id,
+    tool and parameters), with the updates of the identical requests
+    which arrived meanwhile: they are answered with the outputs of the
+    running one instead of downloading and processing the same file
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        # key -> updates waiting for the outputs
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def join(self, unique_id: str, tool: str, params: Sequence,
+             update) -> bool:
+        """
+        Attach update to the identical request running, or mark the
+        request as running if there is none (call finish() when it ends)
+        :param unique_id: (str) telegram file_unique_id of the input
+        :param tool: (str) e.g. 'compress'
+        :param params: (sequence) of the tool parameters
+        :param update: (telegram.update.Update) of the request
+        :return: (bool) True if update was attached to the running request
+        """
+        key = index.key(unique_id, tool, params)
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if waiting is None:
+                self._waiting[key] = []
+                return False
+            waiting.append(update)
+            self.coalesced += 1
+            return True
+
+    def finish(self, unique_id: str, tool: str, params: Sequence) -> list:
+        """
+        Mark a request as ended
+        :param unique_id: (str) telegram file_unique_id of the input
+        :param tool: (str) e.g. 'compress'
+        :param params: (sequence) of the tool parameters
+        :return: (list) of the updates waiting for its outputs
+        """
+        key = index.key(unique_id, tool, params)
+        with self._lock:
+            return self._waiting.pop(key, [])
+
+    def stats(self) -> dict:
+        """
+        Return the single flight counters
+        :return: (dict) with the running requests, the requests waiting
+        for them and the requests coalesced so far
+        """
+        with self._lock:
+            return {'running': len(self._waiting),
+                    'waiting': sum(len(waiting)
+                                   for waiting in self._waiting.values()),
+                    'coalesced': self.coalesced}
+
+
+flights = InFlight()
+metrics.gauge('jobs_coalesced_total', lambda: flights.coalesced)
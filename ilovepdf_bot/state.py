@@ -0,0 +1,360 @@
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Dict, List
+
+from telegram.ext import BasePersistence
+from telegram.ext.utils.promise import Promise
+
+from .constants import (STATE_BACKEND, STATE_MAX_BYTES, STATE_MAX_FILES,
+                        STATE_PATH, STATE_TTL)
+
+# what the conversations keep of a user file (telegram Document or
+# PhotoSize), enough for a job to download it
+FileRef = namedtuple('FileRef', ['file_id', 'file_unique_id', 'file_size'])
+
+
+def file_ref(usr_file) -> FileRef:
+    """
+    Return the FileRef of a telegram file
+    :param usr_file: (telegram.Document or telegram.PhotoSize)
+    :return: (FileRef)
+    """
+    return FileRef(usr_file.file_id, usr_file.file_unique_id,
+                   usr_file.file_size or 0)
+
+
+class StateStore(ABC):
+    """
+    Per-chat state of the conversations (e.g. the PDF file waiting for
+    its password), so concurrent users never see each other's files.
+    Values are JSON, they expire ttl seconds after their last update.
+    Subclasses store them, see MemoryStore and SQLiteStore.
+    :param ttl: (float) seconds an abandoned value is kept
+    :param max_files: (int) files a chat may buffer (e.g. imgtopdf images)
+    :param max_bytes: (int) bytes of the files a chat may buffer
+    """
+
+    # ptb conversations states are stored too (see StatePersistence)
+    persistent = False
+
+    def __init__(self, ttl: float = STATE_TTL,
+                 max_files: int = STATE_MAX_FILES,
+                 max_bytes: int = STATE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._last_expire = time.time()
+
+    @abstractmethod
+    def _load(self, chat_id: int, name: str) -> Any:
+        pass
+
+    @abstractmethod
+    def _save(self, chat_id: int, name: str, value: Any) -> None:
+        pass
+
+    @abstractmethod
+    def _delete(self, chat_id: int, name: str) -> None:
+        pass
+
+    @abstractmethod
+    def _expire(self, now: float) -> int:
+        pass
+
+    def _atomic(self, func: Callable) -> Any:
+        with self._lock:
+            return func()
+
+    def get(self, chat_id: int, name: str, default: Any = None) -> Any:
+        """
+        Return the value of name for a chat
+        :param chat_id: (int) telegram chat id
+        :param name: (str) e.g. 'protect'
+        :param default: returned if there is no value or it expired
+        :return: the value
+        """
+        value = self._atomic(lambda: self._load(chat_id, name))
+        return default if value is None else value
+
+    def set(self, chat_id: int, name: str, value: Any) -> None:
+        """
+        Store the value of name for a chat
+        :param chat_id: (int) telegram chat id
+        :param name: (str) e.g. 'protect'
+        :param value: JSON serializable
+        :return: None
+        """
+        self._atomic(lambda: self._save(chat_id, name, value))
+        self._maybe_expire()
+
+    def pop(self, chat_id: int, name: str, default: Any = None) -> Any:
+        """
+        Return and remove the value of name for a chat
+        :param chat_id: (int) telegram chat id
+        :param name: (str) e.g. 'protect'
+        :param default: returned if there is no value or it expired
+        :return: the value
+        """
+        def pop():
+            value = self._load(chat_id, name)
+            self._delete(chat_id, name)
+            return value
+
+        value = self._atomic(pop)
+        return default if value is None else value
+
+    def set_file(self, chat_id: int, name: str, usr_file) -> None:
+        """
+        Store a user file for a chat, e.g. the PDF file to protect
+        :param chat_id: (int) telegram chat id
+        :param name: (str) e.g. 'protect'
+        :param usr_file: (telegram.Document)
+        :return: None
+        """
+        self.set(chat_id, name, list(file_ref(usr_file)))
+
+    def pop_file(self, chat_id: int, name: str) -> FileRef:
+        """
+        Return and remove the file stored by set_file()
+        :param chat_id: (int) telegram chat id
+        :param name: (str) e.g. 'protect'
+        :return: (FileRef) or None
+        """
+        value = self.pop(chat_id, name)
+        return FileRef(*value) if value else None
+
+    def add_file(self, chat_id: int, name: str, usr_file) -> bool:
+        """
+        Append a user file to the buffer of a chat, unless the buffer
+        already has max_files files or max_bytes bytes
+        :param chat_id: (int) telegram chat id
+        :param name: (str) e.g. 'imgtopdf'
+        :param usr_file: (telegram.Document or telegram.PhotoSize)
+        :return: (bool) False if the buffer is full
+        """
+        ref = file_ref(usr_file)
+
+        def add():
+            refs = self._load(chat_id, name) or []
+            size = sum(r[2] for r in refs) + ref.file_size
+            if len(refs) >= self.max_files or size > self.max_bytes:
+                return False
+            self._save(chat_id, name, refs + [list(ref)])
+            return True
+
+        added = self._atomic(add)
+        self._maybe_expire()
+        return added
+
+    def files(self, chat_id: int, name: str) -> List[FileRef]:
+        """
+        Return the buffer of a chat
+        :param chat_id: (int) telegram chat id
+        :param name: (str) e.g. 'imgtopdf'
+        :return: (list) of FileRef
+        """
+        return [FileRef(*ref) for ref in self.get(chat_id, name, [])]
+
+    def pop_files(self, chat_id: int, name: str) -> List[FileRef]:
+        """
+        Return and remove the buffer of a chat
+        :param chat_id: (int) telegram chat id
+        :param name: (str) e.g. 'imgtopdf'
+        :return: (list) of FileRef
+        """
+        return [FileRef(*ref) for ref in self.pop(chat_id, name, [])]
+
+    def expire(self) -> int:
+        """
+        Remove the values not updated for ttl seconds
+        :return: (int) values removed
+        """
+        self._last_expire = time.time()
+        return self._atomic(lambda: self._expire(self._last_expire))
+
+    def _maybe_expire(self) -> None:
+        if time.time() - self._last_expire > min(self.ttl, 60):
+            self.expire()
+
+    @abstractmethod
+    def conversations(self, name: str) -> Dict[tuple, object]:
+        """
+        Return the ptb conversations states of a ConversationHandler
+        """
+
+    @abstractmethod
+    def set_conversation(self, name: str, key: tuple, state) -> None:
+        """
+        Store (or remove if state is None) a ptb conversation state
+        """
+
+
+class MemoryStore(StateStore):
+    """
+    StateStore in a dict, for a single process
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (chat_id, name) -> (expires, value)
+        self._values = {}
+
+    def _load(self, chat_id, name):
+        expires, value = self._values.get((chat_id, name), (0, None))
+        return value if expires > time.time() else None
+
+    def _save(self, chat_id, name, value):
+        self._values[(chat_id, name)] = (time.time() + self.ttl, value)
+
+    def _delete(self, chat_id, name):
+        self._values.pop((chat_id, name), None)
+
+    def _expire(self, now):
+        expired = [key for key, (expires, _) in self._values.items()
+                   if expires <= now]
+        for key in expired:
+            del self._values[key]
+        return len(expired)
+
+    def conversations(self, name):
+        # ConversationHandler keeps them itself, for this process only
+        return {}
+
+    def set_conversation(self, name, key, state):
+        pass
+
+
+class SQLiteStore(StateStore):
+    """
+    StateStore in a sqlite database, shared by the bot processes of a host
+    and kept across restarts, together with the conversations states
+    :param path: (str) of the sqlite database
+    """
+
+    persistent = True
+
+    def __init__(self, path: str = STATE_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self._db = sqlite3.connect(path, timeout=30,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS state ("
+                         "chat_id INTEGER NOT NULL, "
+                         "name TEXT NOT NULL, "
+                         "value TEXT NOT NULL, "
+                         "expires REAL NOT NULL, "
+                         "PRIMARY KEY (chat_id, name))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS state_expires "
+                         "ON state (expires)")
+
+    def _atomic(self, func):
+        # BEGIN IMMEDIATE also locks out the other processes
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func()
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def _load(self, chat_id, name):
+        row = self._db.execute("SELECT value FROM state WHERE chat_id = ? "
+                               "AND name = ? AND expires > ?",
+                               (chat_id, name, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, chat_id, name, value):
+        self._db.execute("INSERT OR REPLACE INTO state "
+                         "(chat_id, name, value, expires) VALUES (?, ?, ?, ?)",
+                         (chat_id, name, json.dumps(value),
+                          time.time() + self.ttl))
+
+    def _delete(self, chat_id, name):
+        self._db.execute("DELETE FROM state WHERE chat_id = ? AND name = ?",
+                         (chat_id, name))
+
+    def _expire(self, now):
+        return self._db.execute("DELETE FROM state WHERE expires <= ?",
+                                (now,)).rowcount
+
+    def conversations(self, name):
+        # stored with chat_id 0 as 'conversation:<handler>:<key>'
+        prefix = f"conversation:{name}:"
+        rows = self._atomic(lambda: self._db.execute(
+            "SELECT name, value FROM state WHERE chat_id = 0 AND "
+            "substr(name, 1, ?) = ? AND expires > ?",
+            (len(prefix), prefix, time.time())).fetchall())
+        return {tuple(json.loads(key[len(prefix):])): json.loads(value)
+                for key, value in rows}
+
+    def set_conversation(self, name, key, state):
+        name = f"conversation:{name}:{json.dumps(list(key))}"
+        if state is None:
+            self._atomic(lambda: self._delete(0, name))
+        else:
+            self.set(0, name, state)
+
+
+class StatePersistence(BasePersistence):
+    """
+    ptb persistence of the conversations states in a StateStore, so a
+    conversation goes on after a restart (user, chat and bot data are not
+    used by the bot, so they are not stored)
+    :param store: (StateStore) with persistent conversations
+    """
+
+    def __init__(self, store: StateStore):
+        super().__init__(store_user_data=False, store_chat_data=False,
+                         store_bot_data=False)
+        self.store = store
+
+    def get_conversations(self, name):
+        return self.store.conversations(name)
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple) and \
+                isinstance(new_state[-1], Promise):
+            # (old state, Promise) of a run_async handler still running,
+            # ConversationHandler stores its state once it resolved it
+            return
+        self.store.set_conversation(name, key, new_state)
+
+    def get_user_data(self):
+        return {}
+
+    def get_chat_data(self):
+        return {}
+
+    def get_bot_data(self):
+        return {}
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+
+def create_store(backend: str = STATE_BACKEND) -> StateStore:
+    """
+    Return the StateStore of a backend
+    :param backend: (str) 'memory' or 'sqlite'
+    :return: (StateStore)
+    """
+    if backend == 'sqlite':
+        return SQLiteStore()
+    return MemoryStore()
+
+
+store = create_store()
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import threading
+import uuid
+from typing import Iterator, Optional
+
+import requests
+
+from .constants import STREAM_CHUNK_SIZE, STREAM_SPILL
+from .metrics import metrics
+
+_pending = {}
+_lock = threading.Lock()
+
+
+class TelegramSource:
+    """
+    Content of a Telegram file read in chunks, without storing it on disk
+    :param usr_file: (telegram.File) returned by bot.getFile()
+    :param chunk_size: (int) bytes read at once
+    """
+
+    def __init__(self, usr_file, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.usr_file = usr_file
+        self.size = usr_file.file_size
+        self.chunk_size = chunk_size
+
+    def chunks(self) -> Iterator[bytes]:
+        """
+        Yield the file content
+        """
+        file_path = self.usr_file.file_path
+        if os.path.isfile(file_path):
+            # bot API server running in local mode
+            with open(file_path, 'rb') as f:
+                yield from iter(lambda: f.read(self.chunk_size), b'')
+            return
+        with requests.get(file_path, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(self.chunk_size):
+                metrics.inc('bytes_in_total', len(chunk), peer='telegram')
+                yield chunk
+
+    def download(self, path: str) -> None:
+        """
+        Save the file content in path
+        :param path: (str) where the file is saved
+        :return: None
+        """
+        with open(path, 'wb') as f:
+            for chunk in self.chunks():
+                f.write(chunk)
+
+
+def defer(path: str, source: TelegramSource) -> None:
+    """
+    Register that the file expected in path is not downloaded, so the
+    ilovepdf task streams it from Telegram when it uploads it
+    :param path: (str) where the file would be downloaded
+    :param source: (TelegramSource) of the file
+    :return: None
+    """
+    with _lock:
+        _pending[path] = source
+
+
+def take(path: str) -> Optional[TelegramSource]:
+    """
+    Return (and forget) the source registered for path, None if the file
+    is on disk
+    :param path: (str) of the file
+    :return: (TelegramSource) or None
+    """
+    with _lock:
+        return _pending.pop(path, None)
+
+
+def forget(folder: str) -> None:
+    """
+    Forget the sources registered for files inside folder
+    (e.g. when the job workspace is removed)
+    :param folder: (str) path of the folder
+    :return: None
+    """
+    prefix = os.path.join(folder, '')
+    with _lock:
+        for path in [path for path in _pending if path.startswith(prefix)]:
+            del _pending[path]
+
+
+def local(path: str) -> str:
+    """
+    Download the file registered for path, for the stages which need it
+    on disk (it does nothing if the file was not deferred)
+    :param path: (str) of the file
+    :return: (str) path
+    """
+    source = take(path)
+    if source:
+        source.download(path)
+    return path
+
+
+class MultipartStream:
+    """
+    multipart/form-data body of an upload read on the fly from a source,
+    so only one chunk is in memory. The SHA-256 of the file is computed
+    while it is sent, and it is also written to spill_path if given.
+    :param fields: (dict) of the form fields, e.g. {'task': task_id}
+    :param filename: (str) of the file field
+    :param chunks: (iterator) of the file content
+    :param size: (int) of the file if known (to send a Content-Length)
+    :param spill_path: (str) where to keep a copy of the file, or None
+    """
+
+    def __init__(self, fields: dict, filename: str, chunks: Iterator[bytes],
+                 size: Optional[int] = None, spill_path: Optional[str] = None):
+        self.fields = fields
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        head = ''
+        for name, value in fields.items():
+            head += f"--{self.boundary}\r\n" \
+                    f"Content-Disposition: form-data; name=\"{name}\"" \
+                    f"\r\n\r\n{value}\r\n"
+        head += f"--{self.boundary}\r\n" \
+                f"Content-Disposition: form-data; name=\"file\"; " \
+                f"filename=\"{os.path.basename(filename)}\"\r\n" \
+                f"Content-Type: application/octet-stream\r\n\r\n"
+        self.head = head.encode()
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode()
+        if size is not None:
+            # read by requests to send a Content-Length instead of chunks
+            self.len = len(self.head) + size + len(self.tail)
+        self.digest = hashlib.sha256()
+        self.spill_path = spill_path
+        self._chunks = chunks
+        self._parts = self._iter()
+        self._buffer = b''
+
+    def _iter(self) -> Iterator[bytes]:
+        spill = open(self.spill_path, 'wb') if self.spill_path else None
+        try:
+            yield self.head
+            for chunk in self._chunks:
+                self.digest.update(chunk)
+                if spill:
+                    spill.write(chunk)
+                yield chunk
+            yield self.tail
+        finally:
+            if spill:
+                spill.close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self._buffer:
+            yield self._buffer
+            self._buffer = b''
+        yield from self._parts
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            part = next(self._parts, None)
+            if part is None:
+                break
+            self._buffer += part
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def stream_upload(task, file, source: TelegramSource,
+                  spill: bool = STREAM_SPILL) -> str:
+    """
+    Upload a file of a task streaming it from Telegram
+    :param task: (pylovepdf.task.Task) started task using a LoveClient
+    :param file: (pylovepdf.file.File) added to the task
+    :param source: (TelegramSource) of the file content
+    :param spill: (bool) also save the file in its path
+    :return: (str) sha256 hex digest of the file content
+    """
+    body = MultipartStream({'task': task.task}, file.filename,
+                           source.chunks(), size=source.size,
+                           spill_path=file.filename if spill else None)
+    headers = dict(task.headers, **{'Content-Type': body.content_type})
+    response = task._send_request('post', 'upload', payload=body,
+                                  headers=headers)
+    file.server_filename = response.server_filename
+    return body.digest.hexdigest()
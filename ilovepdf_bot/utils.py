@@ -1,11 +1,30 @@
 import os
+import re
 import shutil
+import tempfile
 import zipfile
-from typing import List, Union
+from typing import IO, Iterator, Tuple, Union
 
-from telegram import ParseMode, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import (ChatAction, ParseMode, ReplyKeyboardMarkup,
+                      ReplyKeyboardRemove)
 from telegram.constants import MAX_FILESIZE_DOWNLOAD
 
+from .constants import ZIP_SPOOL_SIZE
+from .metrics import metrics
+from .outbox import FILE, outbox
+
+
+def reply_text(update, text: str, **kwargs) -> None:
+    """
+    Queue a text message to the user, without waiting for it to be sent
+    :param update: (telegram.update.Update) the update object
+    :param text: (str) of the message
+    :param kwargs: of telegram.Message.reply_text, e.g. reply_markup
+    :return: None
+    """
+    outbox.send(update.effective_chat.id, update.effective_message.reply_text,
+                text, **kwargs)
+
 
 def ask_file(update: str, msg: str, const_state: int) -> int:
     """
@@ -20,7 +39,8 @@ def ask_file(update: str, msg: str, const_state: int) -> int:
         [["Cancel"]], resize_keyboard=True,
         one_time_keyboard=True
     )
-    update.effective_message.reply_text(
+    reply_text(
+        update,
         msg,
         reply_markup=reply_markup,
         parse_mode=ParseMode.MARKDOWN,
@@ -50,13 +70,15 @@ def usr_msg(update, msg: str = '', error: bool = True) -> None:
     :return: None
     """
     if error:
-        update.effective_message.reply_text(
+        reply_text(
+            update,
             "An error occured 😔, sorry.",
             reply_markup=ReplyKeyboardRemove(),
             parse_mode=ParseMode.MARKDOWN,
         )
     if msg:
-        update.effective_message.reply_text(
+        reply_text(
+            update,
             msg,
             reply_markup=ReplyKeyboardRemove(),
             parse_mode=ParseMode.MARKDOWN,
@@ -72,22 +94,26 @@ def status_usr_msg(update, status='ok', obj='PDF file') -> None:
     :return: None
     """
     if status == 'ok':
-        update.effective_message.reply_text(
+        reply_text(
+            update,
             f"I received your {obj} correctly 😄",
             reply_markup=ReplyKeyboardRemove()
         )
     elif status == 'too large':
-        update.effective_message.reply_text(
+        reply_text(
+            update,
             f"The {obj} you sent is {status} 😔, try again",
             reply_markup=ReplyKeyboardRemove()
         )
     elif status == 'invalid':
-        update.effective_message.reply_text(
+        reply_text(
+            update,
             f"What you sent is not a valid {obj} 😔, try again",
             reply_markup=ReplyKeyboardRemove()
         )
     else:
-        update.effective_message.reply_text(
+        reply_text(
+            update,
             f"Something went wrong with the {obj} you sent me 😔: {status}",
             reply_markup=ReplyKeyboardRemove()
         )
@@ -100,23 +126,67 @@ def bye(update) -> None:
     :param update: (telegram.update.Update) the update object
     :return: None
     """
-    update.effective_message.reply_text(
+    reply_text(
+        update,
         "Thank you, see you soon! 👋",
         reply_markup=ReplyKeyboardRemove()
     )
 
 
-def del_tmp() -> None:
+def sent_size(document) -> int:
     """
-    Remove tmp file content
-    :return: None
+    Return the bytes of a document sent to the user
+    :param document: (str) path, file object or telegram.InputFile
+    :return: (int) bytes, 0 if unknown
     """
-    for elem in os.listdir('./tmp'):
-        path = f"./tmp/{elem}"
-        if os.path.isfile(path):
-            os.remove(path)
-        else:
-            shutil.rmtree(path)
+    if isinstance(document, str):
+        return os.path.getsize(document)
+    content = getattr(document, 'input_file_content', None)
+    if content is not None:
+        return len(content)
+    try:
+        position = document.tell()
+        document.seek(0, os.SEEK_END)
+        size = document.tell() - position
+        document.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def send_file(update, file_path, caption: str,
+              action: str = ChatAction.UPLOAD_DOCUMENT, filename: str = None):
+    """
+    Send a result file to the user as a document
+    :param update: (telegram.update.Update) the update object
+    :param file_path: (str) path of the file to send,
+    or an open file object
+    :param caption: (str) to show with the file
+    :param action: (str) chat action shown while uploading
+    :param filename: (str) shown to the user, the file name if None
+    :return: (telegram.Message) the message sent
+    """
+    chat_id = update.effective_chat.id
+    outbox.send(chat_id, update.effective_message.chat.send_action, action,
+                priority=FILE)
+    metrics.inc('bytes_out_total', sent_size(file_path), peer='telegram')
+    with metrics.stage('reply_upload'):
+        if not isinstance(file_path, str):
+            return outbox.call(
+                chat_id,
+                update.effective_message.reply_document,
+                document=file_path,
+                caption=caption,
+                filename=filename,
+            )
+        with open(file_path, "rb") as document:
+            return outbox.call(
+                chat_id,
+                update.effective_message.reply_document,
+                document=document,
+                caption=caption,
+                filename=filename,
+            )
 
 
 def file_ok(update, usr_file, ext=('pdf',), obj='PDF file', send_msg=True) -> str:
@@ -204,19 +274,35 @@ def result_file(file_path: str) -> Union[str, None]:
             return file_list[0]
 
 
-UnzipFiles = List[str]
+def natural_key(name: str) -> list:
+    """
+    Return a sort key ordering the numbers inside names by value
+    (e.g. page-2.jpg before page-10.jpg)
+    :param name: (str) of the file
+    :return: (list) the sort key
+    """
+    return [int(part) if part.isdigit() else part.lower()
+            for part in re.split(r'(\d+)', name)]
+
+
+ZipMembers = Iterator[Tuple[str, IO[bytes]]]
 
 
-def unzip_file(zip_path: str, output_dir: str) -> UnzipFiles:
+def iter_zip(zip_path: str, spool_size: int = ZIP_SPOOL_SIZE) -> ZipMembers:
     """
-    Return a list of each file paths after unzip
-    :param output_dir: (str) where files will be saved
+    Yield the files of a zip one at a time, in page order, each one
+    decompressed to a buffer (in memory up to spool_size bytes, on disk
+    beyond) which is closed when the next file is asked
     :param zip_path: (str) path of zip file
-    :return files: (list) of each file paths
+    :param spool_size: (int) bytes kept in memory per file
+    :return: (iterator) of (file name, file object) tuples
     """
-    files = []
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(output_dir)
-    for file_path in os.listdir(output_dir):
-        files.append(f"{output_dir}/{file_path}")
-    return files
+        members = [info for info in zip_ref.infolist() if not info.is_dir()]
+        members.sort(key=lambda info: natural_key(info.filename))
+        for info in members:
+            with tempfile.SpooledTemporaryFile(max_size=spool_size) as buffer:
+                with metrics.stage('unzip'), zip_ref.open(info) as member:
+                    shutil.copyfileobj(member, buffer)
+                buffer.seek(0)
+                yield os.path.basename(info.filename), buffer
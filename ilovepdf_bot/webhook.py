@@ -0,0 +1,150 @@
+import hmac
+import json
+import logging
+import signal
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+from .constants import (WEBHOOK_CERT, WEBHOOK_KEY, WEBHOOK_LISTEN,
+                        WEBHOOK_MAX_CONNECTIONS, WEBHOOK_PATH, WEBHOOK_PORT,
+                        WEBHOOK_SECRET, WEBHOOK_URL)
+
+logger = logging.getLogger(__name__)
+
+# header where Telegram sends the secret_token given to setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# bigger bodies are not updates
+MAX_BODY = 1024 * 1024
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Receive the updates POSTed by Telegram and put them in the dispatcher
+    queue, answering at once so Telegram can send the next one
+    """
+
+    server_version = 'ilovepdfbot'
+
+    def do_POST(self):
+        server = self.server
+        if self.path.split('?')[0] != server.path:
+            self.send_error(404)
+            return
+        if server.secret and not hmac.compare_digest(
+                self.headers.get(SECRET_HEADER, ''), server.secret):
+            self.send_error(403)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if not 0 < length <= MAX_BODY:
+            self.send_error(413 if length else 411)
+            return
+        try:
+            data = json.loads(self.rfile.read(length))
+            update = Update.de_json(data, server.dispatcher.bot)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("invalid update received by the webhook")
+            self.send_error(400)
+            return
+        server.dispatcher.update_queue.put(update)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    HTTP endpoint feeding the dispatcher with the updates sent by Telegram,
+    an alternative to updater.start_polling(). Unlike the ptb webhook it
+    checks the secret token of each request.
+    :param dispatcher: (telegram.ext.Dispatcher) with the handlers
+    :param listen: (str) address to bind
+    :param port: (int) port to bind
+    :param path: (str) url path of the endpoint, e.g. '/telegram'
+    :param secret: (str) token Telegram must send (empty to not check it)
+    :param cert: (str) path of the certificate, to serve https
+    :param key: (str) path of the certificate private key
+    """
+
+    daemon_threads = True
+
+    def __init__(self, dispatcher, listen: str = WEBHOOK_LISTEN,
+                 port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 secret: str = WEBHOOK_SECRET, cert: str = WEBHOOK_CERT,
+                 key: str = WEBHOOK_KEY):
+        super().__init__((listen, port), WebhookHandler)
+        self.dispatcher = dispatcher
+        self.path = '/' + path.strip('/')
+        self.secret = secret
+        self.cert = cert
+        if cert and key:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        self._dispatcher_thread = None
+        self._thread = None
+
+    def set_webhook(self, url: str = WEBHOOK_URL,
+                    max_connections: int = WEBHOOK_MAX_CONNECTIONS) -> None:
+        """
+        Tell Telegram to send the updates to this endpoint
+        :param url: (str) public base url, e.g. 'https://bot.example.com'
+        :param max_connections: (int) simultaneous connections Telegram
+        opens to deliver updates (1 to 100)
+        :return: None
+        """
+        certificate = open(self.cert, 'rb') if self.cert else None
+        try:
+            self.dispatcher.bot.set_webhook(
+                url=url.rstrip('/') + self.path, certificate=certificate,
+                max_connections=max_connections,
+                secret_token=self.secret or None)
+        finally:
+            if certificate:
+                certificate.close()
+
+    def start(self) -> None:
+        """
+        Start the dispatcher (and its job queue) and serve the endpoint
+        in background threads
+        :return: None
+        """
+        self._dispatcher_thread = threading.Thread(
+            target=self.dispatcher.start, name='dispatcher', daemon=True)
+        self._dispatcher_thread.start()
+        if self.dispatcher.job_queue:
+            # conversations timeouts run in the job queue
+            self.dispatcher.job_queue.start()
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='webhook', daemon=True)
+        self._thread.start()
+        logger.info("webhook listening on %s:%s%s", *self.server_address[:2],
+                    self.path)
+
+    def stop(self) -> None:
+        """
+        Stop serving the endpoint and the dispatcher
+        :return: None
+        """
+        self.shutdown()
+        self.server_close()
+        if self.dispatcher.job_queue:
+            self.dispatcher.job_queue.stop()
+        self.dispatcher.stop()
+
+    def idle(self) -> None:
+        """
+        Block until SIGINT or SIGTERM, then stop
+        :return: None
+        """
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stopped.set())
+        stopped.wait()
+        logger.info("stopping the webhook")
+        self.stop()
@@ -0,0 +1,135 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from . import streaming
+from .constants import WORKSPACE_DIR, WORKSPACE_QUOTA
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """
+    Raised when a job needs more disk than its workspace quota
+    """
+
+
+def tree_size(path: str) -> int:
+    """
+    Return the size in bytes of every file under path
+    :param path: (str) of the folder
+    :return: (int) bytes
+    """
+    size = 0
+    for folder, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                size += os.path.getsize(os.path.join(folder, file_name))
+            except OSError:
+                pass
+    return size
+
+
+class Workspace:
+    """
+    Private folder of a job, removed (only it) when the job ends.
+    Use it as a context manager:
+        with workspaces.create() as ws:
+            file_path = ws.file('file_id')
+    :param root: (str) folder where the workspace is created
+    :param quota: (int) max bytes the job may store (0 for no limit)
+    """
+
+    def __init__(self, root: str, quota: int):
+        self.quota = quota
+        self.path = tempfile.mkdtemp(prefix='job-', dir=root)
+
+    def file(self, name: str) -> str:
+        """
+        Return the path of name inside the workspace
+        :param name: (str) e.g. the telegram file_id
+        :return: (str) path
+        """
+        return os.path.join(self.path, name)
+
+    def used(self) -> int:
+        """
+        Return the bytes stored in the workspace
+        """
+        return tree_size(self.path)
+
+    def reserve(self, size: int) -> None:
+        """
+        Raise QuotaExceeded if size bytes more do not fit in the quota,
+        call it before downloading a file
+        :param size: (int) bytes about to be stored
+        :return: None
+        """
+        if self.quota and self.used() + (size or 0) > self.quota:
+            raise QuotaExceeded(f"{size} bytes do not fit in the "
+                                f"{self.quota} bytes workspace quota")
+
+    def check(self) -> None:
+        """
+        Raise QuotaExceeded if the workspace went over its quota,
+        call it after a stage stored its output
+        :return: None
+        """
+        self.reserve(0)
+
+    def close(self) -> None:
+        """
+        Remove the workspace and everything in it
+        :return: None
+        """
+        streaming.forget(self.path)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class WorkspaceManager:
+    """
+    Create per-job workspaces under root, which may be on tmpfs
+    (e.g. /dev/shm/ilovepdfbot)
+    :param root: (str) folder of the workspaces
+    :param quota: (int) max bytes per workspace (0 for no limit)
+    """
+
+    def __init__(self, root: str = WORKSPACE_DIR,
+                 quota: int = WORKSPACE_QUOTA):
+        self.root = root
+        self.quota = quota
+
+    def create(self) -> Workspace:
+        """
+        Return a new, empty workspace
+        :return: (Workspace)
+        """
+        os.makedirs(self.root, exist_ok=True)
+        return Workspace(self.root, self.quota)
+
+    def sweep(self, max_age: float = 0) -> None:
+        """
+        Remove workspaces left by jobs of a previous run
+        :param max_age: (float) seconds, only older workspaces are removed
+        :return: None
+        """
+        if not os.path.isdir(self.root):
+            return
+        now = time.time()
+        for entry in os.scandir(self.root):
+            if not entry.name.startswith('job-') or not entry.is_dir():
+                continue
+            if now - entry.stat().st_mtime >= max_age:
+                logger.info("removing stale workspace %s", entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+workspaces = WorkspaceManager()
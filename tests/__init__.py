@@ -0,0 +1,19 @@
+"""
+Tests of the bot, run with:
+
+    python -m pytest tests
+
+The settings are read by ilovepdf_bot.constants when it is imported, so
+they are set here, before any test module imports the bot: no ilovepdf
+account is used and the state of the tests is kept in a temporary folder.
+"""
+import os
+import tempfile
+
+folder = tempfile.mkdtemp(prefix='ilovepdfbot-tests-')
+os.environ.update(BOT_TOKEN='123:test', PUBLIC_KEY='test',
+                  STATE_BACKEND='sqlite',
+                  STATE_PATH=os.path.join(folder, 'state.db'),
+                  RESULT_INDEX_PATH=':memory:', CACHE_MAX_BYTES='0',
+                  CACHE_DIR=os.path.join(folder, 'cache'),
+                  WORKSPACE_DIR=os.path.join(folder, 'tmp'))
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ilovepdf_bot.cache import OutputCache
+
+
+class OutputCacheTest(unittest.TestCase):
+    """
+    Outputs copied from the cache into the output dir of a job
+    """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache = OutputCache(os.path.join(self.folder.name, 'cache'),
+                                 max_bytes=1024 * 1024)
+        outputs = self.make_dir('outputs')
+        for num in range(3):
+            with open(os.path.join(outputs, f"file-{num}.jpg"), 'wb') as f:
+                f.write(os.urandom(1024))
+        self.key = self.cache.key(['digest'], 'pdftojpg')
+        self.cache.put(self.key, outputs)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def make_dir(self, name: str) -> str:
+        path = os.path.join(self.folder.name, name)
+        os.mkdir(path)
+        return path
+
+    def test_hit(self):
+        output_dir = self.make_dir('job')
+        self.assertTrue(self.cache.get(self.key, output_dir))
+        self.assertEqual(sorted(os.listdir(output_dir)),
+                         ['file-0.jpg', 'file-1.jpg', 'file-2.jpg'])
+        # no temporary folder left beside it
+        self.assertEqual(sorted(os.listdir(self.folder.name)),
+                         ['cache', 'job', 'outputs'])
+
+    def test_created_on_first_use(self):
+        root = os.path.join(self.folder.name, 'lazy')
+        cache = OutputCache(root, max_bytes=1024 * 1024)
+        self.assertFalse(os.path.exists(root))
+        self.assertFalse(cache.get(self.key, self.make_dir('job')))
+        self.assertTrue(os.path.isdir(root))
+
+    def test_evicted_while_copied(self):
+        output_dir = self.make_dir('job')
+        copyfile = shutil.copyfile
+
+        def evicting_copyfile(src, dst):
+            # the entry is evicted after its first file was copied
+            copyfile(src, dst)
+            shutil.rmtree(os.path.dirname(src))
+
+        with mock.patch('ilovepdf_bot.cache.shutil.copyfile',
+                        evicting_copyfile):
+            self.assertFalse(self.cache.get(self.key, output_dir))
+        # nothing left for the job, which fetches the real output
+        self.assertEqual(os.listdir(output_dir), [])
+        self.assertEqual(sorted(os.listdir(self.folder.name)),
+                         ['cache', 'job', 'outputs'])
+
+
+if __name__ == '__main__':
+    unittest.main()
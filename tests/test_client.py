@@ -0,0 +1,103 @@
+import os
+import tempfile
+import time
+import unittest
+import uuid
+
+from pylovepdf.tools.compress import Compress
+
+from benchmarks.fake_ilovepdf import FakeHandler, FakeILovePdf, fake_token
+from ilovepdf_bot import jobs
+from ilovepdf_bot.client import LoveClient, request_timeout
+from ilovepdf_bot.constants import (ILOVEPDF_CONNECT_TIMEOUT,
+                                    ILOVEPDF_PROCESS_TIMEOUT,
+                                    ILOVEPDF_READ_TIMEOUT)
+
+
+class RequestTimeoutTest(unittest.TestCase):
+    """
+    Timeouts of the ilovepdf requests
+    """
+
+    def tearDown(self):
+        jobs._local.job = None
+
+    def run_as_job(self, timeout: float) -> None:
+        job = jobs.Job(lambda: None, (), {}, timeout=timeout, chat_id=7)
+        job.deadline = time.monotonic() + timeout
+        jobs._local.job = job
+
+    def test_short_request(self):
+        self.assertEqual(request_timeout('auth'),
+                         (ILOVEPDF_CONNECT_TIMEOUT, ILOVEPDF_READ_TIMEOUT))
+        self.assertEqual(request_timeout('task/abc'),
+                         (ILOVEPDF_CONNECT_TIMEOUT, ILOVEPDF_READ_TIMEOUT))
+
+    def test_long_request(self):
+        self.assertEqual(request_timeout('download/abc'),
+                         (ILOVEPDF_CONNECT_TIMEOUT, ILOVEPDF_PROCESS_TIMEOUT))
+
+    def test_long_request_within_job_timeout(self):
+        self.run_as_job(20)
+        connect, read = request_timeout('process')
+        self.assertEqual(connect, ILOVEPDF_CONNECT_TIMEOUT)
+        self.assertLessEqual(read, 20)
+        self.assertGreater(read, 19)
+
+
+class RevokingHandler(FakeHandler):
+    """
+    Fake ilovepdf answering 401 to the revoked tokens, and a new token to
+    each auth request
+    """
+
+    def _route(self, method: str):
+        token = self.headers.get('Authorization', '')[7:]
+        if token in self.server.revoked:
+            self._body()
+            self.server.count('rejected')
+            self._json({'error': {'message': 'Invalid token'}}, 401)
+            return
+        super()._route(method)
+
+    def _auth(self, path, body):
+        self._json({'token': f"{fake_token()}{uuid.uuid4().hex}"})
+
+
+class TokenRejectedTest(unittest.TestCase):
+    """
+    A task whose token was rejected goes on with a new one
+    """
+
+    def setUp(self):
+        self.server = FakeILovePdf()
+        self.server.RequestHandlerClass = RevokingHandler
+        self.server.revoked = set()
+        self.server.start()
+        self.client = LoveClient('test', base_url=self.server.url)
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.stop()
+        self.folder.cleanup()
+
+    def test_new_token_kept(self):
+        task = self.client.task(Compress)
+        self.server.revoked.add(task.token)
+        path = os.path.join(self.folder.name, 'file.pdf')
+        with open(path, 'wb') as f:
+            f.write(b'%PDF-1.4 test')
+        task.add_file(path)
+        task.upload()
+        self.assertEqual(self.server.requests['rejected'], 1)
+        self.assertNotIn(task.token, self.server.revoked)
+        self.assertEqual(task.headers['Authorization'],
+                         f"Bearer {self.client.token()}")
+        # the next requests of the task use the new token
+        task.delete_current_task()
+        self.assertEqual(self.server.requests['rejected'], 1)
+        self.assertEqual(self.server.requests['delete'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
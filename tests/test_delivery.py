@@ -0,0 +1,67 @@
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+
+from telegram import Bot, Update
+
+from benchmarks.load import FakeApi
+from ilovepdf_bot.delivery import send_pages
+
+
+class DeliveryTest(unittest.TestCase):
+    """
+    Files made locally sent as the delivery mode tells
+    """
+
+    def setUp(self):
+        self.api = FakeApi({}, {})
+        self.bot = Bot('123:test', request=self.api)
+        message = {'message_id': 1, 'date': int(time.time()), 'text': 'x',
+                   'chat': {'id': 7, 'type': 'private'},
+                   'from': {'id': 7, 'is_bot': False, 'first_name': 'u'}}
+        self.update = Update.de_json({'update_id': 1, 'message': message},
+                                     self.bot)
+        self.folder = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.folder.name, 'pages.zip')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def make_pages(self, count: int) -> list:
+        pages = []
+        for num in range(count):
+            path = os.path.join(self.folder.name, f"page-{num + 1}.jpg")
+            with open(path, 'wb') as f:
+                f.write(os.urandom(512))
+            pages.append((os.path.basename(path), path))
+        return pages
+
+    def send(self, count: int, mode: str) -> list:
+        return send_pages(self.update, self.make_pages(count), self.zip_path,
+                          "{0} pages", "page {0}", mode=mode, threshold=5)
+
+    def test_few_pages_in_groups(self):
+        results = self.send(5, 'auto')
+        self.assertEqual([caption for _, caption in results],
+                         [f"page {num}" for num in range(1, 6)])
+        self.assertEqual(len(self.api.calls['sendMediaGroup']), 1)
+        self.assertFalse(os.path.exists(self.zip_path))
+
+    def test_many_pages_zipped(self):
+        results = self.send(6, 'auto')
+        self.assertEqual([caption for _, caption in results], ['6 pages'])
+        self.assertEqual(len(self.api.calls['sendDocument']), 1)
+        with zipfile.ZipFile(self.zip_path) as zip_ref:
+            self.assertEqual(zip_ref.namelist(),
+                             [f"page-{num}.jpg" for num in range(1, 7)])
+
+    def test_document_mode_never_zipped(self):
+        results = self.send(6, 'document')
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len(self.api.calls['sendDocument']), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
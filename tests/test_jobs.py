@@ -0,0 +1,98 @@
+import threading
+import time
+import unittest
+from collections import defaultdict
+
+from ilovepdf_bot.jobs import JobEngine, JobTimeout, checkpoint
+
+
+class JobEngineTest(unittest.TestCase):
+    """
+    Jobs of the chats scheduled by the job engine
+    """
+
+    def setUp(self):
+        self.order = []
+        self.running = defaultdict(int)
+        self.peak = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def job(self, name: str, seconds: float = 0) -> None:
+        """
+        Record the job start and how many jobs of its chat run with it
+        """
+        chat = name[0]
+        with self.lock:
+            self.order.append(name)
+            self.running[chat] += 1
+            self.peak[chat] = max(self.peak[chat], self.running[chat])
+        time.sleep(seconds)
+        with self.lock:
+            self.running[chat] -= 1
+
+    def run_jobs(self, engine: JobEngine, jobs: list) -> None:
+        """
+        Queue (chat_id, name, seconds, size) jobs, then run them all
+        """
+        for chat_id, name, seconds, size in jobs:
+            self.assertTrue(engine.submit(self.job, name, seconds,
+                                          chat_id=chat_id, size=size))
+        engine.start()
+        engine.stop(wait=True)
+
+    def test_queue_full(self):
+        engine = JobEngine(workers=1, queue_size=2)
+        self.assertTrue(engine.submit(self.job, 'a1', chat_id=1))
+        self.assertTrue(engine.submit(self.job, 'b1', chat_id=2))
+        self.assertFalse(engine.submit(self.job, 'a2', chat_id=1))
+        self.assertEqual(engine.depth, 2)
+
+    def test_chats_in_turn(self):
+        engine = JobEngine(workers=1, chat_workers=0, chat_bytes=0,
+                           weights={})
+        self.run_jobs(engine, [(1, f"a{num}", 0, 0) for num in range(4)] +
+                      [(2, f"b{num}", 0, 0) for num in range(2)])
+        self.assertEqual(self.order, ['a0', 'b0', 'a1', 'b1', 'a2', 'a3'])
+
+    def test_weights(self):
+        engine = JobEngine(workers=1, chat_workers=0, chat_bytes=0,
+                           weights={1: 2})
+        self.run_jobs(engine, [(1, f"a{num}", 0, 0) for num in range(4)] +
+                      [(2, f"b{num}", 0, 0) for num in range(2)])
+        self.assertEqual(self.order, ['a0', 'a1', 'b0', 'a2', 'a3', 'b1'])
+
+    def test_chat_workers(self):
+        engine = JobEngine(workers=4, chat_workers=1, chat_bytes=0,
+                           weights={})
+        self.run_jobs(engine, [(1, f"a{num}", 0.05, 0) for num in range(4)] +
+                      [(2, f"b{num}", 0.05, 0) for num in range(4)])
+        self.assertEqual(self.peak, {'a': 1, 'b': 1})
+
+    def test_chat_bytes(self):
+        engine = JobEngine(workers=4, chat_workers=0, chat_bytes=100,
+                           weights={})
+        # a job larger than the budget still runs, alone
+        self.run_jobs(engine, [(1, 'a0', 0.05, 60), (1, 'a1', 0.05, 60),
+                               (1, 'a2', 0.05, 500), (2, 'b0', 0.05, 30),
+                               (2, 'b1', 0.05, 30), (2, 'b2', 0.05, 30)])
+        self.assertEqual(self.peak, {'a': 1, 'b': 3})
+        self.assertEqual(len(self.order), 6)
+
+    def test_timeout(self):
+        errors = []
+
+        def slow_job():
+            time.sleep(0.2)
+            checkpoint()
+
+        engine = JobEngine(workers=1)
+        engine.submit(slow_job, timeout=0.1, on_error=errors.append,
+                      chat_id=1)
+        engine.start()
+        engine.stop(wait=True)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], JobTimeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
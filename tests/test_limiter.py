@@ -0,0 +1,70 @@
+import itertools
+import random
+import unittest
+from unittest import mock
+
+from ilovepdf_bot.client import size_class
+from ilovepdf_bot.limiter import AdaptiveLimiter
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    """
+    Limit of the ilovepdf tasks at once following their latency
+    """
+
+    def setUp(self):
+        self.limiter = AdaptiveLimiter(initial=8, minimum=1, maximum=32,
+                                       tolerance=2.0)
+        # every cut is far enough from the previous one to be allowed
+        clock = mock.patch('ilovepdf_bot.limiter.time.monotonic',
+                           side_effect=itertools.count(step=100))
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.random = random.Random(0)
+
+    def observe(self, latency: float, kind) -> None:
+        # the limit is in use, as when it holds the tasks back
+        self.limiter.inflight = int(self.limiter.limit)
+        jitter = self.random.uniform(0.8, 1.2)
+        self.limiter.observe(latency * jitter, kind)
+
+    def test_steady_mixed_workload(self):
+        for _ in range(1000):
+            if self.random.random() < 0.8:
+                self.observe(0.3, ('compress', size_class(100 * 1024)))
+            else:
+                self.observe(4.0, ('officepdf', size_class(8 << 20)))
+        self.assertGreaterEqual(self.limiter.limit, 8)
+
+    def test_fast_requests_jitter(self):
+        for _ in range(1000):
+            self.observe(self.random.choice([0.002, 0.01]), ('merge', 0))
+        self.assertGreaterEqual(self.limiter.limit, 8)
+
+    def test_latency_rising(self):
+        for _ in range(50):
+            self.observe(0.3, ('compress', 0))
+            self.observe(4.0, ('officepdf', 3))
+        limit = self.limiter.limit
+        # only the compress tasks slow down
+        for _ in range(10):
+            self.observe(1.5, ('compress', 0))
+        self.assertLess(self.limiter.limit, limit)
+
+    def test_overloaded(self):
+        self.limiter.overloaded()
+        self.assertEqual(int(self.limiter.limit), 4)
+        self.limiter.overloaded()
+        self.limiter.overloaded()
+        self.limiter.overloaded()
+        self.assertEqual(int(self.limiter.limit), 1)
+
+    def test_size_class(self):
+        self.assertEqual(size_class(0), 0)
+        self.assertEqual(size_class(256 * 1024), 0)
+        self.assertEqual(size_class(1024 * 1024), 1)
+        self.assertEqual(size_class(8 << 20), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
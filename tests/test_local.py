@@ -0,0 +1,201 @@
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from PIL import Image
+from pypdf import PdfReader, PdfWriter
+
+try:
+    import cryptography
+except ImportError:
+    # an optional requirement of the local protect
+    cryptography = None
+
+from ilovepdf_bot.ilovepdf import local_first
+from ilovepdf_bot.jobs import JobTimeout
+from ilovepdf_bot.local import (LocalError, local_imgtopdf, local_merge,
+                                local_protect, local_rotate, local_split,
+                                local_unlock)
+
+
+def make_pdf(path: str, pages: int, password: str = None) -> str:
+    """
+    Write a PDF file of blank pages, each one its number of points wide
+    """
+    writer = PdfWriter()
+    for num in range(pages):
+        writer.add_blank_page(100 + num, 200)
+    if password:
+        # RC4 needs no cryptography package
+        writer.encrypt(user_password=password, algorithm='RC4-128')
+    writer.write(path)
+    return path
+
+
+class ImgToPdfTest(unittest.TestCase):
+    """
+    Images converted to PDF by the local engine
+    """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.output_dir = os.path.join(self.folder.name, 'output')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def convert(self, image: Image.Image, name: str, **params) -> Image.Image:
+        """
+        Convert an image alone, return the image of its PDF page
+        """
+        path = os.path.join(self.folder.name, name)
+        image.save(path, **params)
+        local_imgtopdf([path], self.output_dir)
+        pdf_path = os.path.join(self.output_dir, os.listdir(self.output_dir)[0])
+        page = PdfReader(pdf_path).pages[0]
+        self.assertEqual((float(page.mediabox.width),
+                          float(page.mediabox.height)),
+                         page.images[0].image.size)
+        return page.images[0].image
+
+    def test_exif_orientation(self):
+        exif = Image.Exif()
+        # rotated 90 degrees clockwise to be displayed
+        exif[0x0112] = 6
+        image = self.convert(Image.new('RGB', (40, 20), 'red'), 'photo.png',
+                             exif=exif)
+        self.assertEqual(image.size, (20, 40))
+
+    def test_transparency_on_white(self):
+        image = Image.new('RGBA', (30, 30), (0, 0, 255, 255))
+        image.paste((0, 0, 0, 0), (0, 0, 10, 10))
+        image = self.convert(image, 'logo.png')
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(image.getpixel((0, 0)), (255, 255, 255))
+        self.assertEqual(image.getpixel((20, 20)), (0, 0, 255))
+
+    def test_large_image_in_bands(self):
+        # more rows than fit in one compressed band
+        image = Image.effect_noise((700, 900), 64).convert('RGB')
+        self.assertEqual(self.convert(image, 'scan.png').tobytes(),
+                         image.tobytes())
+
+
+class LocalEngineTest(unittest.TestCase):
+    """
+    PDF tools run by the local engine
+    """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.output_dir = os.path.join(self.folder.name, 'output')
+        os.mkdir(self.output_dir)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.folder.name, name)
+
+    def output(self) -> str:
+        """
+        Return the only output file
+        """
+        files = os.listdir(self.output_dir)
+        self.assertEqual(len(files), 1)
+        return os.path.join(self.output_dir, files[0])
+
+    @staticmethod
+    def widths(path: str) -> list:
+        return [int(page.mediabox.width) for page in PdfReader(path).pages]
+
+    def test_merge(self):
+        local_merge([make_pdf(self.path('a.pdf'), 2),
+                     make_pdf(self.path('b.pdf'), 1)], self.output_dir)
+        self.assertEqual(self.widths(self.output()), [100, 101, 100])
+
+    @unittest.skipIf(cryptography is None, "needs cryptography")
+    def test_protect(self):
+        local_protect(make_pdf(self.path('a.pdf'), 2), 'secret',
+                      self.output_dir)
+        reader = PdfReader(self.output())
+        self.assertTrue(reader.is_encrypted)
+        self.assertFalse(reader.decrypt('wrong'))
+        self.assertTrue(reader.decrypt('secret'))
+        self.assertEqual(len(reader.pages), 2)
+
+    def test_rotate(self):
+        local_rotate(make_pdf(self.path('a.pdf'), 2), self.output_dir, 180)
+        self.assertEqual([page.rotation for page in
+                          PdfReader(self.output()).pages], [180, 180])
+
+    def test_split(self):
+        local_split(make_pdf(self.path('a.pdf'), 5), self.output_dir, 2)
+        with zipfile.ZipFile(self.output()) as zip_ref:
+            self.assertEqual(zip_ref.namelist(),
+                             ['a-1.pdf', 'a-2.pdf', 'a-3.pdf'])
+            zip_ref.extractall(self.folder.name)
+        self.assertEqual(self.widths(self.path('a-3.pdf')), [104])
+
+    def test_split_in_one_part(self):
+        local_split(make_pdf(self.path('a.pdf'), 2), self.output_dir, 2)
+        self.assertEqual(self.widths(self.output()), [100, 101])
+
+    def test_unlock(self):
+        local_unlock(make_pdf(self.path('a.pdf'), 1), self.output_dir)
+        self.assertFalse(PdfReader(self.output()).is_encrypted)
+
+    def test_encrypted_input(self):
+        with self.assertRaises(LocalError):
+            local_rotate(make_pdf(self.path('a.pdf'), 1, password='secret'),
+                         self.output_dir)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+
+class LocalFirstTest(unittest.TestCase):
+    """
+    Tools run locally, and by ilovepdf when the local engine fails
+    """
+
+    def setUp(self):
+        self.calls = []
+        local_tools = mock.patch('ilovepdf_bot.ilovepdf.LOCAL_TOOLS',
+                                 {'rotate'})
+        local_tools.start()
+        self.addCleanup(local_tools.stop)
+
+    def tool(self, name: str, local_error: Exception = None):
+        def local_func(file_path):
+            self.calls.append(('local', file_path))
+            if local_error:
+                raise local_error
+
+        @local_first(name, local_func)
+        def love_func(file_path):
+            self.calls.append(('ilovepdf', file_path))
+
+        return love_func
+
+    def test_local(self):
+        self.tool('rotate')('file')
+        self.assertEqual(self.calls, [('local', 'file')])
+
+    def test_not_local(self):
+        self.tool('compress')('file')
+        self.assertEqual(self.calls, [('ilovepdf', 'file')])
+
+    def test_fallback(self):
+        self.tool('rotate', LocalError("file.pdf is encrypted"))('file')
+        self.assertEqual(self.calls, [('local', 'file'),
+                                      ('ilovepdf', 'file')])
+
+    def test_timeout_not_retried(self):
+        with self.assertRaises(JobTimeout):
+            self.tool('rotate', JobTimeout("job took too long"))('file')
+        self.assertEqual(self.calls, [('local', 'file')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from telegram import Bot, InputMediaDocument
+from telegram.error import RetryAfter
+
+from benchmarks.load import FakeApi
+from ilovepdf_bot.outbox import CHATTER, FILE, Outbox, TokenBucket
+
+
+class FloodApi(FakeApi):
+    """
+    Fake Bot API answering the first call with a flood wait, and
+    recording the bytes of the files uploaded by each call
+    """
+
+    def __init__(self):
+        super().__init__({}, {})
+        self.uploads = []
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        media = data.get('media') or [data]
+        self.uploads.append([item['document'].input_file_content
+                             if isinstance(item, dict) else
+                             item.media.input_file_content
+                             for item in media])
+        if len(self.uploads) == 1:
+            raise RetryAfter(0)
+        return super().post(url, data, timeout)
+
+
+class RetryAfterTest(unittest.TestCase):
+    """
+    A call answered with a flood wait is sent again with its whole files
+    """
+
+    def setUp(self):
+        self.api = FloodApi()
+        self.bot = Bot('123:test', request=self.api)
+        self.outbox = Outbox(workers=1)
+        self.outbox.start()
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.outbox.stop()
+        self.folder.cleanup()
+
+    def make_file(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.folder.name, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_document_sent_again_whole(self):
+        content = os.urandom(64 * 1024)
+        with open(self.make_file('result.pdf', content), 'rb') as document:
+            msg = self.outbox.call(7, self.bot.send_document, 7,
+                                   document=document)
+        self.assertIsNotNone(msg.document)
+        self.assertEqual(self.api.uploads, [[content], [content]])
+
+    def test_media_group_sent_again_whole(self):
+        contents = [os.urandom(1024), os.urandom(2048)]
+        media = []
+        for num, content in enumerate(contents):
+            with open(self.make_file(f"{num}.pdf", content), 'rb') as f:
+                media.append(InputMediaDocument(f, caption=f"page {num + 1}"))
+        messages = self.outbox.call(7, self.bot.send_media_group, 7,
+                                    media=media)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(self.api.uploads, [contents, contents])
+
+
+class TokenBucketTest(unittest.TestCase):
+    """
+    Calls allowed by a token bucket
+    """
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = bucket.stamp
+        for _ in range(3):
+            self.assertEqual(bucket.delay(1, now), 0)
+            bucket.take(1)
+        self.assertAlmostEqual(bucket.delay(1, now), 0.5)
+        self.assertEqual(bucket.delay(1, now + 0.5), 0)
+
+    def test_cost_above_burst(self):
+        # e.g. a media group of 10 documents to a chat of burst 3
+        bucket = TokenBucket(rate=1, burst=3)
+        now = bucket.stamp
+        self.assertEqual(bucket.delay(10, now), 0)
+        bucket.take(10)
+        self.assertAlmostEqual(bucket.delay(1, now), 8)
+        self.assertFalse(bucket.full(now + 9))
+        self.assertTrue(bucket.full(now + 10))
+
+
+class OutboxTest(unittest.TestCase):
+    """
+    Order, priority and pace of the calls sent by the outbox
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def start(self, **params) -> Outbox:
+        outbox = Outbox(**params)
+        outbox.start()
+        self.addCleanup(outbox.stop)
+        return outbox
+
+    def record(self, name: str, retry_after: float = 0) -> str:
+        with self.lock:
+            self.calls.append((name, time.monotonic()))
+            if retry_after and \
+                    [call for call, _ in self.calls].count(name) == 1:
+                raise RetryAfter(retry_after)
+        return name
+
+    def names(self) -> list:
+        return [name for name, _ in self.calls]
+
+    def test_chat_order(self):
+        outbox = self.start(workers=4, rate=1000, burst=1000,
+                            chat_rate=1000, chat_burst=1000)
+        futures = [outbox.send(7, self.record, f"call-{num}")
+                   for num in range(20)]
+        self.assertEqual([future.result(5) for future in futures],
+                         [f"call-{num}" for num in range(20)])
+        self.assertEqual(self.names(), [f"call-{num}" for num in range(20)])
+
+    def test_files_first(self):
+        outbox = self.start(workers=1, rate=1000, burst=1000,
+                            chat_rate=1000, chat_burst=1000)
+        # the sender is busy while the other calls are queued
+        busy = threading.Event()
+        outbox.send(1, busy.wait, 5)
+        chatter = outbox.send(2, self.record, 'chatter', priority=CHATTER)
+        result = outbox.send(3, self.record, 'file', priority=FILE)
+        busy.set()
+        chatter.result(5), result.result(5)
+        self.assertEqual(self.names(), ['file', 'chatter'])
+
+    def test_global_rate(self):
+        outbox = self.start(workers=4, rate=20, burst=1,
+                            chat_rate=1000, chat_burst=1000)
+        start = time.monotonic()
+        futures = [outbox.send(chat_id, self.record, chat_id)
+                   for chat_id in range(1, 6)]
+        for future in futures:
+            future.result(5)
+        # one call at once, then one per 1/20 s
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_flood_wait_blocks_its_chat_only(self):
+        outbox = self.start(workers=2, rate=1000, burst=1000,
+                            chat_rate=1000, chat_burst=1000)
+        flooded = outbox.send(7, self.record, 'flooded', retry_after=0.5)
+        # queued while chat 7 waits
+        time.sleep(0.1)
+        after = outbox.send(7, self.record, 'after')
+        other = outbox.send(8, self.record, 'other')
+        self.assertEqual(other.result(5), 'other')
+        self.assertFalse(after.done())
+        self.assertEqual(flooded.result(5), 'flooded')
+        self.assertEqual(after.result(5), 'after')
+        self.assertEqual(self.names(), ['flooded', 'other', 'flooded',
+                                        'after'])
+        # sent again once the flood wait ended
+        self.assertGreaterEqual(self.calls[2][1] - self.calls[0][1], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import time
+import unittest
+
+from ilovepdf_bot.prefetch import Prefetcher, Staged
+from ilovepdf_bot.state import FileRef
+
+
+class PrefetcherTest(unittest.TestCase):
+    """
+    Files staged for a conversation, and the jobs of the same chat
+    """
+
+    def setUp(self):
+        self.prefetcher = Prefetcher(workers=0)
+        self.doc = FileRef('file', 'unique', 1024)
+        self.other = FileRef('other-file', 'other-unique', 1024)
+        # as staged by a /protectpdf conversation waiting for the password
+        self.staged = Staged(self.doc, time.monotonic() + 60)
+        self.staged.ready.set()
+        self.prefetcher._staged[(7, 'protect')] = self.staged
+
+    def test_taken_by_its_file(self):
+        self.assertIs(self.prefetcher.take(7, 'protect', self.doc),
+                      self.staged)
+        self.assertIsNone(self.prefetcher.take(7, 'protect', self.doc))
+
+    def test_left_to_its_conversation(self):
+        # e.g. another file sent with "/protectpdf secret" as its caption
+        self.assertIsNone(self.prefetcher.take(7, 'protect', self.other))
+        self.prefetcher.discard(7, 'protect', self.other.file_unique_id)
+        self.assertFalse(self.staged.cancelled)
+        self.assertIs(self.prefetcher.take(7, 'protect', self.doc),
+                      self.staged)
+
+    def test_discarded(self):
+        self.prefetcher.discard(7)
+        self.assertTrue(self.staged.cancelled)
+        self.assertIsNone(self.prefetcher.take(7, 'protect', self.doc))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from pypdf import PdfWriter
+
+from ilovepdf_bot.raster import Rasterizer
+
+
+class RasterizerTest(unittest.TestCase):
+    """
+    Pages of PDF files rendered by the worker processes
+    """
+
+    def setUp(self):
+        local_tools = mock.patch('ilovepdf_bot.raster.LOCAL_TOOLS',
+                                 {'pdftojpg'})
+        local_tools.start()
+        self.addCleanup(local_tools.stop)
+        self.rasterizer = Rasterizer(workers=2, dpi=36)
+        self.rasterizer.start()
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.rasterizer.stop()
+        self.folder.cleanup()
+
+    def make_pdf(self, pages: int) -> str:
+        """
+        Write a PDF file of blank pages, return its path without extension
+        """
+        file_path = os.path.join(self.folder.name, 'file')
+        writer = PdfWriter()
+        for _ in range(pages):
+            writer.add_blank_page(144, 144)
+        writer.write(f"{file_path}.pdf")
+        os.mkdir(file_path)
+        return file_path
+
+    def open_files(self) -> list:
+        """
+        Return the files opened by the worker processes
+        """
+        paths = []
+        for pid in self.rasterizer._pool._processes:
+            fd_dir = f"/proc/{pid}/fd"
+            for fd in os.listdir(fd_dir):
+                try:
+                    paths.append(os.readlink(os.path.join(fd_dir, fd)))
+                except OSError:
+                    pass
+        return paths
+
+    def test_pages_in_order(self):
+        file_path = self.make_pdf(10)
+        pages = self.rasterizer.pages(file_path)
+        self.assertEqual(len(pages), 10)
+        self.assertEqual([name for name, _ in pages],
+                         [f"file-{num}.jpg" for num in range(1, 11)])
+        self.assertEqual(sorted(os.listdir(file_path)),
+                         sorted(f"file-{num}.jpg" for num in range(1, 11)))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc")
+    def test_document_closed(self):
+        file_path = self.make_pdf(5)
+        list(self.rasterizer.pages(file_path))
+        self.assertNotIn(f"{file_path}.pdf", self.open_files())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+
+from ilovepdf_bot.results import ResultIndex
+
+
+class ResultIndexTest(unittest.TestCase):
+    """
+    Outputs already sent, reused by file_unique_id, tool and parameters
+    """
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'results.db')
+        self.index = ResultIndex(self.path, max_entries=2)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_opened_on_first_use(self):
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(self.index.get('unique', 'compress'))
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_put_get(self):
+        self.index.put('unique', 'protect', [('file-id', 'caption')],
+                       ('secret',))
+        self.assertEqual(self.index.get('unique', 'protect', ('secret',)),
+                         [('file-id', 'caption')])
+        self.assertIsNone(self.index.get('unique', 'protect', ('other',)))
+        self.assertEqual(self.index.stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import queue
+import time
+import unittest
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from benchmarks.load import FakeApi
+from ilovepdf_bot.commands import (STORED_FILES, cancel_without_async,
+                                   check_pass, compress_handler)
+from ilovepdf_bot.constants import WAIT_FILE_COMPRESS
+from ilovepdf_bot.state import (FileRef, MemoryStore, SQLiteStore,
+                                StatePersistence, StateStore, store)
+
+
+def command_update(bot: Bot, chat_id: int, text: str) -> Update:
+    """
+    Return the update of a command sent by a user in a private chat
+    """
+    message = {'message_id': 1, 'date': int(time.time()), 'text': text,
+               'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': chat_id, 'is_bot': False, 'first_name': 'u'},
+               'entities': [{'type': 'bot_command', 'offset': 0,
+                             'length': len(text)}]}
+    return Update.de_json({'update_id': 1, 'message': message}, bot)
+
+
+class PersistentConversationTest(unittest.TestCase):
+    """
+    Conversations of the dispatcher stored in the sqlite store
+    """
+
+    def setUp(self):
+        self.api = FakeApi({}, {})
+        self.bot = Bot('123:test', request=self.api)
+        self.dispatcher = Dispatcher(self.bot, queue.Queue(), workers=1,
+                                     persistence=StatePersistence(store))
+        self.dispatcher.add_handler(compress_handler())
+
+    def tearDown(self):
+        store.set_conversation('compress', (7, 7), None)
+
+    def test_store_is_sqlite(self):
+        self.assertIsInstance(store, SQLiteStore)
+
+    def test_compress_state_stored(self):
+        self.dispatcher.process_update(command_update(self.bot, 7,
+                                                      '/compress'))
+        self.assertIn('compress', self.api.messages[7][0])
+        self.assertEqual(store.conversations('compress'),
+                         {(7, 7): WAIT_FILE_COMPRESS})
+        self.dispatcher.process_update(command_update(self.bot, 7, '/cancel'))
+        self.assertEqual(store.conversations('compress'), {})
+
+    def test_running_promise_not_stored(self):
+        persistence = StatePersistence(store)
+        promise = self.dispatcher.run_async(lambda: WAIT_FILE_COMPRESS)
+        persistence.update_conversation('compress', (7, 7), (None, promise))
+        self.assertEqual(store.conversations('compress'), {})
+        persistence.update_conversation('compress', (7, 7),
+                                        WAIT_FILE_COMPRESS)
+        self.assertEqual(store.conversations('compress'),
+                         {(7, 7): WAIT_FILE_COMPRESS})
+        persistence.update_conversation('compress', (7, 7), None)
+        self.assertEqual(store.conversations('compress'), {})
+
+
+class StoreTest(unittest.TestCase):
+    """
+    Stores of the conversations state
+    """
+
+    def setUp(self):
+        self.bot = Bot('123:test', request=FakeApi({}, {}))
+        self.doc = FileRef('file', 'unique', 1024)
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            StateStore()
+
+    def test_memory_conversations(self):
+        memory = MemoryStore()
+        memory.set_conversation('compress', (7, 7), WAIT_FILE_COMPRESS)
+        self.assertEqual(memory.conversations('compress'), {})
+
+    def test_cancel_drops_files(self):
+        for name in STORED_FILES:
+            store.set_file(7, name, self.doc)
+        cancel_without_async(command_update(self.bot, 7, '/cancel'))
+        for name in STORED_FILES:
+            self.assertIsNone(store.get(7, name))
+
+    def test_cancel_password_drops_file(self):
+        store.set_file(7, 'protect', self.doc)
+        check_pass(command_update(self.bot, 7, 'cancel'), None)
+        self.assertIsNone(store.pop_file(7, 'protect'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import http.client
+import json
+import queue
+import threading
+import time
+import unittest
+
+from telegram import Bot
+
+from benchmarks.load import FakeApi
+from ilovepdf_bot.webhook import MAX_BODY, SECRET_HEADER, WebhookServer
+
+
+class StubDispatcher:
+    """
+    What WebhookServer uses of a dispatcher: its bot, its update queue and
+    start() / stop()
+    """
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.update_queue = queue.Queue()
+        self.job_queue = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._stopped.wait()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+class WebhookTest(unittest.TestCase):
+    """
+    Synthetic updates posted to the webhook endpoint
+    """
+
+    def setUp(self):
+        self.dispatcher = StubDispatcher(Bot('123:test',
+                                             request=FakeApi({}, {})))
+        self.server = WebhookServer(self.dispatcher, listen='127.0.0.1',
+                                    port=0, path='telegram', secret='s3cr3t',
+                                    cert='', key='')
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def post(self, body: bytes, path: str = '/telegram',
+             secret: str = 's3cr3t', length: int = None) -> int:
+        """
+        POST body to the endpoint, return the response status
+        """
+        connection = http.client.HTTPConnection(
+            *self.server.server_address[:2], timeout=10)
+        try:
+            connection.putrequest('POST', path)
+            connection.putheader('Content-Type', 'application/json')
+            connection.putheader(SECRET_HEADER, secret)
+            connection.putheader('Content-Length',
+                                 str(len(body) if length is None else length))
+            connection.endheaders(body)
+            return connection.getresponse().status
+        finally:
+            connection.close()
+
+    @staticmethod
+    def update(update_id: int) -> bytes:
+        return json.dumps({'update_id': update_id, 'message': {
+            'message_id': 1, 'date': int(time.time()), 'text': '/compress',
+            'chat': {'id': 7, 'type': 'private'},
+            'from': {'id': 7, 'is_bot': False, 'first_name': 'u'}}}).encode()
+
+    def test_update_queued(self):
+        self.assertEqual(self.post(self.update(42)), 200)
+        update = self.dispatcher.update_queue.get(timeout=5)
+        self.assertEqual(update.update_id, 42)
+        self.assertEqual(update.message.text, '/compress')
+
+    def test_wrong_secret(self):
+        self.assertEqual(self.post(self.update(1), secret='wrong'), 403)
+        self.assertTrue(self.dispatcher.update_queue.empty())
+
+    def test_wrong_path(self):
+        self.assertEqual(self.post(self.update(1), path='/other'), 404)
+        self.assertTrue(self.dispatcher.update_queue.empty())
+
+    def test_bad_json(self):
+        self.assertEqual(self.post(b'{"update_id": '), 400)
+        self.assertTrue(self.dispatcher.update_queue.empty())
+
+    def test_oversized_body(self):
+        # refused from its Content-Length, before it is read
+        self.assertEqual(self.post(b'', length=MAX_BODY + 1), 413)
+        self.assertTrue(self.dispatcher.update_queue.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()